@@ -42,6 +42,15 @@ module MegaHit_Sets {
                  overrides '--k-min', '--k-max', and '--k-step'
 
 	     min_contig_length - minimum length of contigs to output, default 200
+
+	     num_cpu_threads - number of CPU threads, default all the CPUs available to the container
+	     memory - max memory for SdBG construction: a fraction (0-1) of the memory available
+	         to the container, or else a number of bytes, at least 1 GiB (1073741824); values
+	         in between are refused.  Default 0.9
+	     mem_flag - SdBG builder memory mode: 0 = minimum, 1 = moderate (default), 2 = all of memory
+
+	     num_cpu_threads and memory are shared by all the MEGAHIT runs that happen at once,
+	         and are capped at what the container's cgroup and cpu affinity allow
         */
 
 	/* Kmer Params
@@ -63,6 +72,9 @@ module MegaHit_Sets {
 	**
 	**     @optional megahit_parameter_preset
 	**     @optional min_contig_len
+	**     @optional num_cpu_threads
+	**     @optional memory
+	**     @optional mem_flag
 	*/
 	typedef structure {
 		string workspace_name;
@@ -73,6 +85,10 @@ module MegaHit_Sets {
 
 		int min_contig_len;
 		Kmer_Params kmer_params;
+
+		int num_cpu_threads;
+		float memory;
+		int mem_flag;
 	} MegaHitParams;
 
 	typedef structure {
@@ -108,10 +124,17 @@ module MegaHit_Sets {
 		int k_step;
 		list <int> k_list;
 		int min_contig_len;
+
+		int num_cpu_threads;
+		float memory;
+		int mem_flag;
 	} ExecMegaHitParams;
 
+	/* report_html - per-library summary table of the assemblies, as an html page
+	*/
 	typedef structure {
 	        string       report_text;
+	        string       report_html;
 		list<string> output_contigset_ref;
 	} ExecMegaHitOutput;
 
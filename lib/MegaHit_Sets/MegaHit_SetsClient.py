@@ -37,9 +37,10 @@ class MegaHit_Sets(object):
         """
         :param params: instance of type "MegaHitParams" (run_megahit() ** ** 
            @optional megahit_parameter_preset **     @optional
-           min_contig_len) -> structure: parameter "workspace_name" of
-           String, parameter "input_reads_ref" of String, parameter
-           "output_contigset_name" of String, parameter
+           min_contig_len **     @optional num_cpu_threads **     @optional
+           memory **     @optional mem_flag) -> structure: parameter
+           "workspace_name" of String, parameter "input_reads_ref" of String,
+           parameter "output_contigset_name" of String, parameter
            "combined_assembly_flag" of Long, parameter
            "megahit_parameter_preset" of String, parameter "min_contig_len"
            of Long, parameter "kmer_params" of type "Kmer_Params" (Kmer
@@ -47,7 +48,8 @@ class MegaHit_Sets(object):
            @optional k_max **     @optional k_step **     @optional k_list)
            -> structure: parameter "min_count" of Long, parameter "k_min" of
            Long, parameter "k_max" of Long, parameter "k_step" of Long,
-           parameter "k_list" of list of Long
+           parameter "k_list" of list of Long, parameter "num_cpu_threads" of
+           Long, parameter "memory" of Double, parameter "mem_flag" of Long
         :returns: instance of type "MegaHitOutput" -> structure: parameter
            "report_name" of String, parameter "report_ref" of String
         """
@@ -68,10 +70,13 @@ class MegaHit_Sets(object):
            "megahit_parameter_preset" of String, parameter "min_count" of
            Long, parameter "k_min" of Long, parameter "k_max" of Long,
            parameter "k_step" of Long, parameter "k_list" of list of Long,
-           parameter "min_contig_len" of Long
-        :returns: instance of type "ExecMegaHitOutput" -> structure:
-           parameter "report_text" of String, parameter
-           "output_contigset_ref" of list of String
+           parameter "min_contig_len" of Long, parameter "num_cpu_threads" of
+           Long, parameter "memory" of Double, parameter "mem_flag" of Long
+        :returns: instance of type "ExecMegaHitOutput" (report_html -
+           per-library summary table of the assemblies, as an html page) ->
+           structure: parameter "report_text" of String, parameter
+           "report_html" of String, parameter "output_contigset_ref" of list
+           of String
         """
         return self._client.call_method(
             'MegaHit_Sets.exec_megahit',
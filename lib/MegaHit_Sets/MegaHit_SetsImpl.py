@@ -4,22 +4,45 @@ import os
 import sys
 import shutil
 import hashlib
+import fcntl
 import subprocess
 import requests
 import re
 import traceback
 import uuid
+from multiprocessing.pool import ThreadPool
 from datetime import datetime
 from pprint import pprint, pformat
 
-import numpy as np
-from Bio import SeqIO
-
 from biokbase.workspace.client import Workspace as workspaceService
 from ReadsUtils.ReadsUtilsClient import ReadsUtils
 from SetAPI.SetAPIServiceClient import SetAPI
 from AssemblyUtil.AssemblyUtilClient import AssemblyUtil
 from KBaseReport.KBaseReportClient import KBaseReport
+from MegaHit_Sets.prefetch import ReadsPrefetcher
+from MegaHit_Sets.concat import FileConcatenator
+from MegaHit_Sets.fifo import FifoFeeder
+from MegaHit_Sets.report import AssemblyReport
+from MegaHit_Sets.saver import AssemblySaver
+from MegaHit_Sets.metrics import REGISTRY as METRICS
+from MegaHit_Sets.spans import SpanRecorder
+from MegaHit_Sets.resources import AvailableResources
+from MegaHit_Sets.assembly_cache import AssemblyCache
+from MegaHit_Sets.reads_cache import ReadsCache
+
+# libraries being downloaded, assembled and saved right now, across all calls in this process.
+# The server's /metrics only sees calls run in its own process: run_megahit runs as an SDK job in
+# another process, so the job logs these sizes instead, with each download, megahit and save span
+PIPELINE_STAGES = ['download', 'assemble', 'save']
+PIPELINE_STAGE_SIZE = METRICS.gauge('megahit_sets_pipeline_stage_size',
+                                    'Libraries currently in each exec_megahit stage', ['stage'])
+for stage in PIPELINE_STAGES:
+    PIPELINE_STAGE_SIZE.labels(stage)  # reported from the start, as zero
+
+
+# the libraries in each stage right now, for a span's record
+def pipeline_stage_sizes ():
+    return dict((stage, int(PIPELINE_STAGE_SIZE.labels(stage).value)) for stage in PIPELINE_STAGES)
 
 #END_HEADER
 
@@ -46,6 +69,20 @@ class MegaHit_Sets:
     #BEGIN_CLASS_HEADER
     MegaHit_Sets = '/kb/module/megahit/megahit'
 
+    # Linux caps a single argv string at 128 KiB (MAX_ARG_STRLEN), so long
+    # comma-separated input lists are staged as short symlinks instead
+    MEGAHIT_MAX_INPUT_ARG_LEN = 32 * 1024
+
+    # a memory param is a fraction up to 1, or bytes from here up: anything in between (e.g. 16,
+    # meant as GB) would be taken by MEGAHIT as a handful of bytes, so it is refused
+    MEGAHIT_MIN_MEMORY_BYTES = 1 << 30
+
+    COMBINED_INPUT_MODES = ['concat', 'multifile', 'fifo']
+
+    # the files of a PE library: fwd and rev, or both ends interleaved in one file
+    READS_DIRECTIONS = ['fwd', 'rev', 'interleaved']
+    MEGAHIT_INPUT_FLAGS = {'fwd': '-1', 'rev': '-2', 'interleaved': '--12'}
+
     # target is a list for collecting log messages
     def log(self, target, message):
         # we should do something better here...
@@ -54,89 +91,328 @@ class MegaHit_Sets:
         print(message)
         sys.stdout.flush()
 
+    # total size of the regular files in paths (named pipes count as 0)
+    def files_size(self, paths):
+        return sum([os.path.getsize(path) for path in paths if os.path.isfile(path)])
+
     # run megahit on the fastq files and return contig file path
-    def exec_megahit_single_library (self, params):
+    def exec_megahit_single_library (self, params, spans=None):
+        if spans is None:
+            spans = SpanRecorder()
 
         print('RUNNING MegaHit_Sets')
         print('Input reads files:')
         #fwd = reads[input_ref]['files']['fwd']
         #rev = reads[input_ref]['files']['rev']
-        fwd = params['input_fwd_path']
-        rev = params['input_rev_path']
-        pprint('forward: '+fwd)
-        pprint('reverse: '+rev)
+        # several files per direction (e.g. ReadsSet members) are passed straight to megahit
+        input_path_lists = {}
+        for direction in self.READS_DIRECTIONS:
+            path_list = params.get('input_'+direction+'_paths')
+            if not path_list and params.get('input_'+direction+'_path'):
+                path_list = [params['input_'+direction+'_path']]
+            if path_list:
+                input_path_lists[direction] = path_list
+                pprint(direction+': '+', '.join(path_list))
 
 
         ### STEP 4: run megahit
         # construct the command
         megahit_cmd = [self.MegaHit_Sets]
 
-        # we only support PE reads, so add that
-        megahit_cmd.append('-1')
-        megahit_cmd.append(fwd)
-        megahit_cmd.append('-2')
-        megahit_cmd.append(rev)
+        # we only support PE reads, so add that (-1/-2, or --12 for interleaved files)
+        input_args, staging_dir = self.megahit_input_args (input_path_lists)
+        for direction in self.READS_DIRECTIONS:
+            if direction in input_args:
+                megahit_cmd.append(self.MEGAHIT_INPUT_FLAGS[direction])
+                megahit_cmd.append(input_args[direction])
+
+        # the options that change the assembly
+        assembly_options = self.megahit_assembly_options (params)
+        megahit_cmd.extend (assembly_options)
+
+        # this run's share of the container's cpus and memory (megahit would size itself by the whole node)
+        num_threads, memory, mem_flag = self.megahit_resources (params, params.get('megahit_concurrent_runs', 1))
+        megahit_cmd.append('-t')
+        megahit_cmd.append(str(num_threads))
+        megahit_cmd.append('-m')
+        megahit_cmd.append(str(memory))
+        megahit_cmd.append('--mem-flag')
+        megahit_cmd.append(str(mem_flag))
+
+        # set the output location.  The same reads and options get the same dir, so a rerun of an
+        # assembly that didn't finish (e.g. the job was restarted) goes on from megahit's last checkpoint
+        # (input_reads_refs are the versioned refs of the reads, set by exec_megahit)
+        output_dir, output_dir_lock = self.megahit_output_dir (params.get('input_reads_refs'), assembly_options)
+        if os.path.exists(os.path.join(output_dir, 'checkpoints.txt')):
+            print('continuing the earlier megahit run in '+output_dir)
+            megahit_cmd.append('--continue')
+        elif os.path.exists(output_dir):
+            shutil.rmtree(output_dir)  # megahit won't start in an existing dir, and there's nothing to keep
+        megahit_cmd.append('-o')
+        megahit_cmd.append(output_dir)
+
+        # run megahit
+        print('running megahit:')
+        print('    '+' '.join(megahit_cmd))
+        try:
+            with PIPELINE_STAGE_SIZE.labels('assemble').track_inprogress(), \
+                    spans.span('megahit', output_dir=os.path.basename(output_dir)) as span:
+                span.add_bytes (self.files_size(sum(input_path_lists.values(), [])))
+                span.set('resumed', '--continue' in megahit_cmd)
+                span.set('pipeline', pipeline_stage_sizes())
+                p = subprocess.Popen(megahit_cmd, cwd=self.scratch, shell=False)
+                retcode = p.wait()
+                span.set('returncode', retcode)
+        finally:
+            if output_dir_lock:
+                output_dir_lock.close()
+        if staging_dir:
+            shutil.rmtree(staging_dir)  # only symlinks
+
+        print('Return code: ' + str(retcode))
+        if p.returncode != 0:
+            raise ValueError('Error running MegaHit_Sets, return code: ' +
+                             str(retcode) + '\n')
+
+        output_contigs = os.path.join(output_dir, 'final.contigs.fa')
+        if self.mac_mode: # on macs, we cannot run megahit in the shared host scratch space, so we need to copy the file there
+            # (copied, not moved: a later --continue in output_dir finds megahit's checkpoints all done, and
+            # expects the contigs still beside them)
+            host_output_contigs = os.path.join(self.host_scratch, os.path.basename(output_dir)+'.final.contigs.fa')
+            shutil.copyfile(output_contigs, host_output_contigs)
+            output_contigs = host_output_contigs
+
+        # send back path to contigs fasta file
+        return output_contigs
+
+    # the megahit arguments that change the assembly, from the preset, kmer_params and min_contig_len
+    def megahit_assembly_options (self, params):
+        options = []
 
         # if a preset is defined, use that:
         if 'megahit_parameter_preset' in params:
             if params['megahit_parameter_preset']:
-                megahit_cmd.append('--presets')
-                megahit_cmd.append(params['megahit_parameter_preset'])
+                options.append('--presets')
+                options.append(params['megahit_parameter_preset'])
 
         if 'kmer_params' in params and params['kmer_params'] != None:
             if 'min_count' in params['kmer_params']:
                 if params['kmer_params']['min_count']:
-                    megahit_cmd.append('--min-count')
-                    megahit_cmd.append(str(params['kmer_params']['min_count']))
+                    options.append('--min-count')
+                    options.append(str(params['kmer_params']['min_count']))
             if 'k_min' in params['kmer_params']:
                 if params['kmer_params']['k_min']:
-                    megahit_cmd.append('--k-min')
-                    megahit_cmd.append(str(params['kmer_params']['k_min']))
+                    options.append('--k-min')
+                    options.append(str(params['kmer_params']['k_min']))
             if 'k_max' in params['kmer_params']:
                 if params['kmer_params']['k_max']:
-                    megahit_cmd.append('--k-max')
-                    megahit_cmd.append(str(params['kmer_params']['k_max']))
+                    options.append('--k-max')
+                    options.append(str(params['kmer_params']['k_max']))
             if 'k_step' in params['kmer_params']:
                 if params['kmer_params']['k_step']:
-                    megahit_cmd.append('--k-step')
-                    megahit_cmd.append(str(params['kmer_params']['k_step']))
+                    options.append('--k-step')
+                    options.append(str(params['kmer_params']['k_step']))
             if 'k_list' in params['kmer_params']:
                 if params['kmer_params']['k_list']:
                     k_list = []
                     for k_val in params['kmer_params']['k_list']:
                         k_list.append(str(k_val))
-                    megahit_cmd.append('--k-list')
-                    megahit_cmd.append(','.join(k_list))
+                    options.append('--k-list')
+                    options.append(','.join(k_list))
 
         if 'min_contig_len' in params:
             if params['min_contig_len']:
-                megahit_cmd.append('--min-contig-len')
-                megahit_cmd.append(str(params['min_contig_len']))
+                options.append('--min-contig-len')
+                options.append(str(params['min_contig_len']))
 
-        # set the output location
-        timestamp = int((datetime.utcnow() - datetime.utcfromtimestamp(0)).total_seconds()*1000)
-        output_dir = os.path.join(self.scratch,'output.'+str(timestamp))
-        megahit_cmd.append('-o')
-        megahit_cmd.append(output_dir)
+        return options
 
-        # run megahit
-        print('running megahit:')
-        print('    '+' '.join(megahit_cmd))
-        p = subprocess.Popen(megahit_cmd, cwd=self.scratch, shell=False)
-        retcode = p.wait()
+    # the version megahit reports, or None if it can't be run
+    def megahit_version (self):
+        if self._megahit_version is None:
+            try:
+                self._megahit_version = subprocess.check_output([self.MegaHit_Sets, '--version']).decode('utf-8').strip()
+            except (OSError, subprocess.CalledProcessError):
+                return None
+        return self._megahit_version
+
+    # the result cache key for each assembly of exec_megahit, from the versioned reads refs that go
+    # into it, the assembly options and the megahit version.  Keys are None when there's no cache
+    def assembly_cache_keys (self, versioned_refs_per_assembly, params):
+        megahit_version = self.megahit_version()
+        if self.assembly_cache is None or megahit_version is None:
+            return [None for refs in versioned_refs_per_assembly]
+        options = self.megahit_assembly_options (params)
+        return [AssemblyCache.key(refs, options, megahit_version) for refs in versioned_refs_per_assembly]
+
+    # the output dir for a megahit run of versioned_reads_refs with assembly_options, and the open lock
+    # file that keeps it this run's until closed.  The dir is named by a hash of the refs and options,
+    # unless there are no refs or another run of the same assembly has it right now, when it's a new one.
+    # The refs must carry their versions, so a library saved again since is never resumed from the old one
+    def megahit_output_dir (self, versioned_reads_refs, assembly_options):
+        if versioned_reads_refs:
+            key = hashlib.sha1('\n'.join(list(versioned_reads_refs) + ['--'] + assembly_options).encode('utf-8')).hexdigest()
+            output_dir = os.path.join(self.scratch, 'output.'+key[:16])
+            lock = open(output_dir+'.lock', 'a')
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return output_dir, lock
+            except IOError:
+                lock.close()  # the same assembly is running right now
 
-        print('Return code: ' + str(retcode))
-        if p.returncode != 0:
-            raise ValueError('Error running MegaHit_Sets, return code: ' +
-                             str(retcode) + '\n')
+        # suffix keeps concurrent runs from colliding
+        timestamp = int((datetime.utcnow() - datetime.utcfromtimestamp(0)).total_seconds()*1000)
+        return os.path.join(self.scratch,'output.'+str(timestamp)+'.'+uuid.uuid4().hex[:8]), None
+
+    # the -t, -m and --mem-flag values for each of n_runs MEGAHIT runs at once.  The num_cpu_threads
+    # and memory params, or else the deploy.cfg settings, are shared between the runs, and are capped
+    # at what the container actually has (self.resources).  As for megahit, a memory up to 1 is a
+    # fraction of the available memory, and is turned into bytes; if the container's memory is
+    # unknown, the fraction itself is passed, which megahit takes of the whole node's memory
+    def megahit_resources (self, params, n_runs=1):
+        num_threads = min(int(params.get('num_cpu_threads') or self.megahit_num_threads or self.resources.cpus),
+                          self.resources.cpus)
+        memory = float(params.get('memory') or self.megahit_memory_bytes or self.megahit_memory_fraction)
+        if memory < 0 or 1 < memory < self.MEGAHIT_MIN_MEMORY_BYTES:
+            raise ValueError ("memory must be a fraction (0-1) of the available memory, or at least "+
+                              str(self.MEGAHIT_MIN_MEMORY_BYTES)+" bytes, not "+str(params.get('memory') or memory))
+        if self.resources.memory_bytes is not None:
+            if memory <= 1:
+                memory *= self.resources.memory_bytes
+            memory = min(memory, self.resources.memory_bytes)
+        memory = memory / n_runs if memory <= 1 else int(memory // n_runs)
+        mem_flag = params.get('mem_flag')
+        if mem_flag is None or mem_flag == '':  # '' is the dropdown's unset value, while 0 is a choice
+            mem_flag = self.megahit_mem_flag
+        return max(1, num_threads // n_runs), memory, int(mem_flag)
+
+    # build the -1/-2 (or --12) megahit arguments for the lists of files of each direction.  If
+    # the comma separated lists get too long for the command line (or a path has a comma in it),
+    # the files are symlinked under short names relative to scratch, which is megahit's cwd.
+    # returns the args by direction and the staging dir to remove afterwards (or None)
+    def megahit_input_args (self, input_path_lists):
+        input_args = dict((direction, ','.join(path_list))
+                          for direction, path_list in input_path_lists.items())
+        if all(len(input_args[direction]) <= self.MEGAHIT_MAX_INPUT_ARG_LEN and
+               input_args[direction].count(',') == len(input_path_lists[direction]) - 1
+               for direction in input_args):
+            return input_args, None
+
+        staging_name = 'in.'+uuid.uuid4().hex[:6]
+        staging_dir = os.path.join(self.scratch, staging_name)
+        os.makedirs(staging_dir)
+        staged = {}
+        for direction, path_list in input_path_lists.items():
+            staged[direction] = []
+            for i,path in enumerate(path_list):
+                link_name = str(i)+'.'+direction+('.fq.gz' if path.endswith('.gz') else '.fq')
+                os.symlink(os.path.abspath(path), os.path.join(staging_dir, link_name))
+                staged[direction].append(staging_name+'/'+link_name)
+        return dict((direction, ','.join(links)) for direction, links in staged.items()), staging_dir
+
+    # save one assembly to the workspace and return its ref
+    def save_assembly (self, ctx, contigs_path, workspace_name, assembly_name, service_ver, spans=None):
+        if spans is None:
+            spans = SpanRecorder()
+        assemblyUtil = AssemblyUtil(self.callbackURL, token=ctx['token'], service_ver=service_ver)
+        with PIPELINE_STAGE_SIZE.labels('save').track_inprogress(), \
+                spans.span('save', assembly_name=assembly_name) as span:
+            span.add_bytes (self.files_size([contigs_path]))
+            span.set('pipeline', pipeline_stage_sizes())
+            return assemblyUtil.save_assembly_from_fasta({
+                                        'file':{'path':contigs_path},
+                                        'workspace_name':workspace_name,
+                                        'assembly_name':assembly_name
+                                        })
+
+    # the fastq files of one library (by versioned ref), by direction, from the reads cache or else
+    # downloaded.  Each file goes back to self.reads_cache.release() once it's no longer needed
+    def download_reads_library (self, ctx, reads_ref, console, spans=None):
+        if spans is None:
+            spans = SpanRecorder()
+
+        def download (reads_ref):
+            self.log (console, "MegaHit_Sets:run_megahit(): DOWNLOADING FASTQ FILES FOR ReadsLibrary: "+str(reads_ref))
+            span.set('cached', False)
+            readsUtils_Client = ReadsUtils (url=self.callbackURL, token=ctx['token'])  # SDK local
+            download_params = {'read_libraries': [reads_ref],
+                               'interleaved': ('true' if self.reads_interleaved else 'false')
+                               }
+            if self.reads_gzipped:
+                download_params['gzipped'] = 'true'
+            readsLibrary = readsUtils_Client.download_reads (download_params)
+            if self.reads_interleaved:
+                # the one interleaved file comes back as fwd
+                return { 'interleaved': readsLibrary['files'][reads_ref]['files']['fwd'] }
+            return { 'fwd': readsLibrary['files'][reads_ref]['files']['fwd'],
+                     'rev': readsLibrary['files'][reads_ref]['files']['rev']
+                   }
 
-        output_contigs = os.path.join(output_dir, 'final.contigs.fa')
-        if self.mac_mode: # on macs, we cannot run megahit in the shared host scratch space, so we need to move the file there
-            shutil.move(output_contigs, os.path.join(self.host_scratch, 'final.contigs.fa'))
-            output_contigs = os.path.join(self.host_scratch, 'final.contigs.fa')
+        try:
+            with PIPELINE_STAGE_SIZE.labels('download').track_inprogress(), \
+                    spans.span('download', reads_ref=reads_ref, cached=True) as span:
+                span.set('pipeline', pipeline_stage_sizes())
+                reads_files = self.reads_cache.fetch (reads_ref, download, form=self.reads_form)
+                span.add_bytes (self.files_size(reads_files.values()))
+        except Exception as e:
+            raise ValueError('Unable to get reads object from workspace: (' + reads_ref +")\n" + str(e))
+
+        return reads_files
+
+    # assemble one downloaded library, and release the reads once MEGAHIT is done with them
+    def exec_megahit_reads_library (self, reads_files, params, spans=None):
+        this_params = dict(params)  # each run gets its own copy, they may run concurrently
+        for direction, path in reads_files.items():
+            this_params['input_'+direction+'_path'] = path
+
+        # the key line
+        this_output_contigset_path = self.exec_megahit_single_library (this_params, spans)
+
+        for path in reads_files.values():
+            self.reads_cache.release (path) # files can be really big
+        return this_output_contigset_path
+
+    # assemble each library of an uncombined ReadsSet, up to self.megahit_parallel_jobs at once,
+    # while the next libraries are downloaded in the background.  on_assembled(i, contigs_path)
+    # is called as soon as library i is done.
+    # returns the contig paths in the same order as reads_ref_list
+    def exec_megahit_library_pool (self, ctx, reads_ref_list, params, console, on_assembled=None, spans=None):
+        n_jobs = max(1, min(self.megahit_parallel_jobs, len(reads_ref_list)))
+        pool_params = dict(params)
+        if n_jobs > 1:
+            # split the container between the concurrent MEGAHIT runs
+            pool_params['megahit_concurrent_runs'] = n_jobs
+            num_threads, memory, mem_flag = self.megahit_resources (pool_params, n_jobs)
+            self.log (console, "MegaHit_Sets:run_megahit(): RUNNING "+str(n_jobs)+" MEGAHIT JOBS AT ONCE, "+
+                      str(num_threads)+" threads and "+str(memory)+(" of the memory" if memory <= 1 else " bytes of memory")+" each")
+
+        # one download thread per concurrent run, so n_jobs runs starting at once don't wait on each
+        # other's downloads
+        prefetcher = ReadsPrefetcher (lambda reads_ref: self.download_reads_library(ctx, reads_ref, console, spans),
+                                      reads_ref_list, self.scratch,
+                                      depth=self.reads_prefetch_depth,
+                                      reserve_bytes=self.scratch_reserve_bytes,
+                                      width=n_jobs,
+                                      remove=self.reads_cache.release).start()
+        def assemble(i):
+            contigs_path = self.exec_megahit_reads_library(prefetcher.get(i), dict(pool_params, input_reads_refs=[reads_ref_list[i]]),
+                                                           spans)
+            if on_assembled:
+                on_assembled(i, contigs_path)
+            return contigs_path
 
-        # send back path to contigs fasta file
-        return output_contigs
+        try:
+            if n_jobs == 1:
+                return [assemble(i) for i in range(len(reads_ref_list))]
+            pool = ThreadPool(n_jobs)
+            try:
+                # map() keeps the results in input order, so names still line up with assemblies
+                return pool.map(assemble, range(len(reads_ref_list)), chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+        finally:
+            prefetcher.close()
 
     #END_CLASS_HEADER
 
@@ -162,8 +438,73 @@ class MegaHit_Sets:
             self.scratch = os.path.join('/kb','module','local_scratch')
             self.mac_mode = True
         # end hack
+
+        # number of MEGAHIT runs to execute at once for uncombined ReadsSets, and
+        # the fraction of the container's memory the runs may use between them
+        self.megahit_parallel_jobs = int(config.get('megahit-parallel-jobs', 1))
+        self.megahit_memory_fraction = float(config.get('megahit-memory-fraction', 0.9))
+
+        # the cpus and memory MEGAHIT can really use here, from cpu affinity and cgroup limits.
+        # megahit-threads and megahit-memory-mb override them (0 means all of the cpus, and
+        # megahit-memory-fraction of the memory), and megahit-mem-flag is MEGAHIT's --mem-flag
+        self.resources = AvailableResources()
+        print('Available to MEGAHIT: '+self.resources.summary())
+        self.megahit_num_threads = int(config.get('megahit-threads', 0))
+        self.megahit_memory_bytes = int(config.get('megahit-memory-mb', 0)) * 1024 * 1024
+        self.megahit_mem_flag = int(config.get('megahit-mem-flag', 1))
+
+        # how many libraries may be downloaded ahead of the assembler, and how much
+        # scratch space must stay free for them to be
+        self.reads_prefetch_depth = int(config.get('reads-prefetch-depth', 1))
+        self.scratch_reserve_bytes = int(config.get('scratch-reserve-mb', 1024)) * 1024 * 1024
+
+        # number of ReadsSet members to download at once for a combined assembly
+        self.reads_download_threads = int(config.get('reads-download-threads', 4))
+
+        # number of finished assemblies to upload at once, while later ones are still assembling
+        self.assembly_save_threads = int(config.get('assembly-save-threads', 2))
+
+        # how a combined assembly gets its input: 'concat' appends the members into one
+        # fwd and one rev (or interleaved) file, 'multifile' hands megahit the member files directly, and
+        # 'fifo' streams the members to megahit through named pipes
+        self.combined_input_mode = config.get('combined-input-mode', 'concat')
+        if self.combined_input_mode not in self.COMBINED_INPUT_MODES:
+            raise ValueError("combined-input-mode must be one of "+", ".join(self.COMBINED_INPUT_MODES)+
+                             ", not '"+self.combined_input_mode+"'")
+
+        # reads-gzipped = 1 keeps the reads gzipped from download to MEGAHIT, which reads .gz
+        # itself, so their uncompressed form never touches scratch.  A combined input is then
+        # the members' gzip files appended, which is a valid multi-member gzip file
+        self.reads_gzipped = config.get('reads-gzipped', '0') == '1'
+        self.reads_extension = '.fastq.gz' if self.reads_gzipped else '.fastq'
+
+        # reads-interleaved = 1 asks ReadsUtils for each library as one interleaved file, which
+        # megahit takes with --12, rather than having it split into fwd and rev files
+        self.reads_interleaved = config.get('reads-interleaved', '0') == '1'
+        self.reads_directions = ['interleaved'] if self.reads_interleaved else ['fwd', 'rev']
+
+        # how downloaded libraries are stored, which the reads cache keeps apart
+        self.reads_form = ','.join([form for form, used in [('interleaved', self.reads_interleaved),
+                                                            ('gzip', self.reads_gzipped)] if used])
+
         if not os.path.exists(self.scratch):
             os.makedirs(self.scratch)
+
+        # downloaded reads libraries are kept for the next assembly of the same library version, up
+        # to reads-cache-mb of them.  Off (0) by default: a kept library stays in scratch, so each
+        # ReadsSet member is no longer deleted as soon as it's used, and runs take more disk
+        self.reads_cache = ReadsCache(config.get('reads-cache-dir', os.path.join(self.scratch, 'reads_cache')),
+                                      int(config.get('reads-cache-mb', 0)) * 1024 * 1024)
+
+        # assemblies of the same reads versions with the same options are taken from here instead
+        # of being run again, up to assembly-cache-mb of them.  Off (0) by default: the cached contigs
+        # stay in scratch, and a run whose contigs aren't needed again would only fill it up
+        self._megahit_version = None
+        self.assembly_cache = None
+        assembly_cache_bytes = int(config.get('assembly-cache-mb', 0)) * 1024 * 1024
+        if assembly_cache_bytes > 0:
+            self.assembly_cache = AssemblyCache(config.get('assembly-cache-dir', os.path.join(self.scratch, 'assembly_cache')),
+                                                assembly_cache_bytes)
         #END_CONSTRUCTOR
         pass
 
@@ -172,9 +513,10 @@ class MegaHit_Sets:
         """
         :param params: instance of type "MegaHitParams" (run_megahit() ** ** 
            @optional megahit_parameter_preset **     @optional
-           min_contig_len) -> structure: parameter "workspace_name" of
-           String, parameter "input_reads_ref" of String, parameter
-           "output_contigset_name" of String, parameter
+           min_contig_len **     @optional num_cpu_threads **     @optional
+           memory **     @optional mem_flag) -> structure: parameter
+           "workspace_name" of String, parameter "input_reads_ref" of String,
+           parameter "output_contigset_name" of String, parameter
            "combined_assembly_flag" of Long, parameter
            "megahit_parameter_preset" of String, parameter "min_contig_len"
            of Long, parameter "kmer_params" of type "Kmer_Params" (Kmer
@@ -182,7 +524,8 @@ class MegaHit_Sets:
            @optional k_max **     @optional k_step **     @optional k_list)
            -> structure: parameter "min_count" of Long, parameter "k_min" of
            Long, parameter "k_max" of Long, parameter "k_step" of Long,
-           parameter "k_list" of list of Long
+           parameter "k_list" of list of Long, parameter "num_cpu_threads" of
+           Long, parameter "memory" of Double, parameter "mem_flag" of Long
         :returns: instance of type "MegaHitOutput" -> structure: parameter
            "report_name" of String, parameter "report_ref" of String
         """
@@ -211,16 +554,19 @@ class MegaHit_Sets:
         exec_megahit_output = self.exec_megahit (ctx, params)[0]
 
 
-        ### STEP 3: save the report
+        ### STEP 3: save the report, with the per-library summary table as its html view
         reportObj = {
             'objects_created': [],
-            'text_message': exec_megahit_output['report_text']
+            'message': exec_megahit_output['report_text'],
+            'direct_html': exec_megahit_output['report_html'],
+            'workspace_name': params['workspace_name'],
+            'report_object_name': 'megahit_report_'+str(uuid.uuid4())
         }
         for obj_ref in exec_megahit_output['output_contigset_refs']:
             reportObj['objects_created'].append({'ref':obj_ref, 'description':'Assembled contigs'})
 
         reportClient = KBaseReport(self.callbackURL, token=ctx['token'], service_ver=SERVICE_VER)
-        report_info = reportClient.create({'report':reportObj, 'workspace_name':params['workspace_name']})
+        report_info = reportClient.create_extended_report(reportObj)
 
 
         ### STEP 4: contruct the output to send back
@@ -248,10 +594,13 @@ class MegaHit_Sets:
            "megahit_parameter_preset" of String, parameter "min_count" of
            Long, parameter "k_min" of Long, parameter "k_max" of Long,
            parameter "k_step" of Long, parameter "k_list" of list of Long,
-           parameter "min_contig_len" of Long
-        :returns: instance of type "ExecMegaHitOutput" -> structure:
-           parameter "report_text" of String, parameter
-           "output_contigset_ref" of list of String
+           parameter "min_contig_len" of Long, parameter "num_cpu_threads" of
+           Long, parameter "memory" of Double, parameter "mem_flag" of Long
+        :returns: instance of type "ExecMegaHitOutput" (report_html -
+           per-library summary table of the assemblies, as an html page) ->
+           structure: parameter "report_text" of String, parameter
+           "report_html" of String, parameter "output_contigset_ref" of list
+           of String
         """
         # ctx is the context object
         # return variables are: output
@@ -266,6 +615,8 @@ class MegaHit_Sets:
 
 
         ### STEP 0: init
+        # how long each stage takes, logged as it finishes and added to the report
+        spans = SpanRecorder(log=lambda line: self.log(console, "MegaHit_Sets:run_megahit(): SPAN "+line))
         token = ctx['token']
         wsClient = workspaceService(self.workspaceURL, token=token)
         headers = {'Authorization': 'OAuth '+token}
@@ -281,6 +632,7 @@ class MegaHit_Sets:
         for required_param in required_params:
             if required_param not in params or params[required_param] == None:
                 raise ValueError ("Must define required param: '"+required_param+"'")
+        self.megahit_resources (params)  # refuses a memory param megahit would misread, before any download
 
 
         ### STEP 2: determine if input is a ReadsLibrary or ReadsSet
@@ -289,9 +641,10 @@ class MegaHit_Sets:
         try:
             [OBJID_I, NAME_I, TYPE_I, SAVE_DATE_I, VERSION_I, SAVED_BY_I, WSID_I, WORKSPACE_I, CHSUM_I, SIZE_I, META_I] = range(11)  # object_info tuple
 
-            input_reads_obj_info = wsClient.get_object_info_new ({'objects':[{'ref':input_reads_ref}]})[0]
+            input_reads_obj_info = spans.timed('metadata', reads_ref=input_reads_ref)(wsClient.get_object_info_new) ({'objects':[{'ref':input_reads_ref}]})[0]
             input_reads_obj_type = re.sub ('-[0-9]+\.[0-9]+$', "", input_reads_obj_info[TYPE_I])  # remove trailing version
             input_reads_name = input_reads_obj_info[NAME_I]
+            input_reads_versioned_ref = '/'.join([str(input_reads_obj_info[i]) for i in [WSID_I, OBJID_I, VERSION_I]])
 
         except Exception as e:
             raise ValueError('Unable to get reads object from workspace: (' + input_reads_ref +')' + str(e))
@@ -310,10 +663,12 @@ class MegaHit_Sets:
         if input_reads_obj_type == "KBaseFile.PairedEndLibrary":
             readsSet_ref_list   = [input_reads_ref]
             readsSet_names_list = [input_reads_name]
+            readsSet_versioned_ref_list = [input_reads_versioned_ref]
  
         elif input_reads_obj_type == "KBaseSets.ReadsSet":
             readsSet_ref_list   = []
             readsSet_names_list = []
+            readsSet_versioned_ref_list = []
 
             try:
                 setAPI_Client = SetAPI (url=self.serviceWizardURL, token=ctx['token'])  # for dynamic service
@@ -323,7 +678,7 @@ class MegaHit_Sets:
                 #raise ValueError("SetAPI FAILURE: Unable to get SetAPI Client as local method callbackURL: '"+self.callbackURL+"' token: '"+ctx['token']+"'" + str(e))
 
             try:
-                input_readsSet_obj = setAPI_Client.get_reads_set_v1 ({'ref':input_reads_ref,'include_item_info':1})
+                input_readsSet_obj = spans.timed('resolve_set', reads_ref=input_reads_ref)(setAPI_Client.get_reads_set_v1) ({'ref':input_reads_ref,'include_item_info':1})
             except Exception as e:
                 raise ValueError('SetAPI FAILURE: Unable to get read library set object from workspace: (' + str(input_reads_ref)+")\n" + str(e))
 
@@ -331,16 +686,87 @@ class MegaHit_Sets:
                 readsSet_ref_list.append(readsLibrary_obj['ref'])
                 NAME_I = 1
                 readsSet_names_list.append(readsLibrary_obj['info'][NAME_I])
+                readsSet_versioned_ref_list.append('/'.join([str(readsLibrary_obj['info'][i]) for i in [WSID_I, OBJID_I, VERSION_I]]))
 
         else:
             raise ValueError ("Input reads of type '"+input_reads_obj_type+"' not accepted.  Must be one of "+", ".join(accepted_input_types))
 
 
-        ### STEP 4: If doing a combined assembly on a ReadsSet, download reads one at a time and combine
-        if input_reads_obj_type == "KBaseSets.ReadsSet" and params['combined_assembly_flag'] != 0:
+        ### STEP 3b: look for the assemblies in the result cache, they need no download or megahit run if there
+        # one assembly per library for uncombined sets, otherwise just the one
+        if input_reads_obj_type == "KBaseSets.ReadsSet" and params['combined_assembly_flag'] == 0:
+            if len(readsSet_ref_list) > 1:
+                output_contigset_names = [name+'-'+params['output_contigset_name'] for name in readsSet_names_list]
+            else:
+                output_contigset_names = [params['output_contigset_name']]
+            assembly_cache_keys = self.assembly_cache_keys ([[ref] for ref in readsSet_versioned_ref_list], params)
+        else:
+            output_contigset_names = [params['output_contigset_name']]
+            assembly_cache_keys = self.assembly_cache_keys ([readsSet_versioned_ref_list], params)
+
+        cached_assemblies = {}  # index -> {'contigs_path', 'stats'}
+        for i,key in enumerate(assembly_cache_keys):
+            if key is None:
+                continue
+            contigs_path = os.path.join(self.host_scratch, 'cached.'+key[:16]+'.final.contigs.fa')
+            with spans.span('cache_lookup', assembly_name=output_contigset_names[i]) as span:
+                stats = self.assembly_cache.checkout (key, contigs_path)
+                span.set('hit', stats is not False)
+            if stats is not False:
+                self.log (console, "MegaHit_Sets:run_megahit(): FOUND "+output_contigset_names[i]+" IN THE ASSEMBLY CACHE")
+                cached_assemblies[i] = {'contigs_path': contigs_path, 'stats': stats}
+        combined_cached = 0 in cached_assemblies and input_reads_obj_type == "KBaseSets.ReadsSet" \
+                and params['combined_assembly_flag'] != 0
+
+
+        ### STEP 4: If doing a combined assembly on a ReadsSet, download reads (several at once) and combine in order
+        if combined_cached:
+            pass  # nothing to download
+
+        elif input_reads_obj_type == "KBaseSets.ReadsSet" and params['combined_assembly_flag'] != 0 \
+                and self.combined_input_mode == 'multifile':
+
+            self.log (console, "MegaHit_Sets:run_megahit(): DOWNLOADING ReadsSet MEMBERS FOR MULTI-FILE INPUT")
+
+            # megahit reads the member files directly, so there is nothing to append
+            prefetcher = ReadsPrefetcher (lambda reads_ref: self.download_reads_library(ctx, reads_ref, console, spans),
+                                          readsSet_versioned_ref_list, self.scratch,
+                                          depth=len(readsSet_ref_list),
+                                          reserve_bytes=self.scratch_reserve_bytes,
+                                          width=self.reads_download_threads,
+                                          remove=self.reads_cache.release).start()
+            try:
+                combined_input_files = [prefetcher.get(lib_i) for lib_i in range(len(readsSet_ref_list))]
+            finally:
+                prefetcher.close()
+            combined_input_paths = dict((direction, [f[direction] for f in combined_input_files])
+                                        for direction in self.reads_directions)
+
+        elif input_reads_obj_type == "KBaseSets.ReadsSet" and params['combined_assembly_flag'] != 0 \
+                and self.combined_input_mode == 'fifo':
+
+            self.log (console, "MegaHit_Sets:run_megahit(): STREAMING ReadsSet MEMBERS THROUGH NAMED PIPES")
+
+            # the pipes have to live on local scratch (see mac_mode), and are fed once megahit starts
+            fifo_dir = os.path.join(self.scratch,'fifo.'+uuid.uuid4().hex[:8])
+            os.makedirs(fifo_dir)
+            prefetcher = ReadsPrefetcher (lambda reads_ref: self.download_reads_library(ctx, reads_ref, console, spans),
+                                          readsSet_versioned_ref_list, self.scratch,
+                                          depth=self.reads_download_threads,
+                                          reserve_bytes=self.scratch_reserve_bytes,
+                                          width=self.reads_download_threads,
+                                          remove=self.reads_cache.release).start()
+            feeder = FifoFeeder (dict((direction, os.path.join(fifo_dir, 'input_reads_'+direction+self.reads_extension))
+                                      for direction in self.reads_directions),
+                                 prefetcher.get, len(readsSet_ref_list), remove=self.reads_cache.release)
+            combined_input_paths = dict((direction, [path]) for direction, path in feeder.fifo_paths.items())
+
+        elif input_reads_obj_type == "KBaseSets.ReadsSet" and params['combined_assembly_flag'] != 0:
 
             self.log (console, "MegaHit_Sets:run_megahit(): CREATING COMBINED INPUT FASTQ FILES")
 
+            # appending gzip files as they are makes a multi-member gzip file, never uncompressed
+
             # make dir
             timestamp = int((datetime.utcnow() - datetime.utcfromtimestamp(0)).total_seconds()*1000)
             input_dir = os.path.join(self.scratch,'input.'+str(timestamp))
@@ -349,60 +775,39 @@ class MegaHit_Sets:
             if not os.path.exists(input_dir):
                 os.makedirs(input_dir)
 
-            # connect to ReadsUtils Client
+            # download several members at once, ahead of the append
+            prefetcher = ReadsPrefetcher (lambda reads_ref: self.download_reads_library(ctx, reads_ref, console, spans),
+                                          readsSet_versioned_ref_list, self.scratch,
+                                          depth=self.reads_download_threads,
+                                          reserve_bytes=self.scratch_reserve_bytes,
+                                          width=self.reads_download_threads,
+                                          remove=self.reads_cache.release).start()
+
+            # start combined file (one per direction)
+            combined_input_paths = dict((direction, [os.path.join (input_dir, 'input_reads_'+direction+self.reads_extension)])
+                                        for direction in self.reads_directions)
+
+            # add libraries, one at a time and in set order
+            concats = {}
             try:
-                readsUtils_Client = ReadsUtils (url=self.callbackURL, token=ctx['token'])  # SDK local
-            except:
-                raise ValueError("Unable to get readsUtils_Client\n" + str(e))
-
-            # start combined file
-            read_buf_size  = 65536
-            write_buf_size = 65536
-            combined_input_fwd_path = os.path.join (input_dir, 'input_reads_fwd.fastq')
-            combined_input_rev_path = os.path.join (input_dir, 'input_reads_rev.fastq')
-            combined_input_fwd_handle = open (combined_input_fwd_path, 'w', write_buf_size)
-            combined_input_rev_handle = open (combined_input_rev_path, 'w', write_buf_size)
-
-            # add libraries, one at a time
-            for this_input_reads_ref in readsSet_ref_list:
-                self.log (console, "MegaHit_Sets:run_megahit(): DOWNLOADING FASTQ FILES FOR ReadsSet member: "+str(this_input_reads_ref))
-                try:
-                    readsLibrary = readsUtils_Client.download_reads ({'read_libraries': [this_input_reads_ref],
-                                                                      'interleaved': 'false'
-                                                                      })
-                except Exception as e:
-                    raise ValueError('Unable to get reads object from workspace: (' + this_input_reads_ref +")\n" + str(e))
-
-                this_input_fwd_path = readsLibrary['files'][this_input_reads_ref]['files']['fwd']
-                this_input_rev_path = readsLibrary['files'][this_input_reads_ref]['files']['rev']
-
-                # append fwd
-                self.log (console, "MegaHit_Sets:run_megahit(): APPENDING FASTQ FILES FOR ReadsSet member: "+str(this_input_reads_ref))
-                this_input_path = this_input_fwd_path
-                cat_file_handle = combined_input_fwd_handle
-                with open (this_input_path, 'r', read_buf_size) as this_input_handle:
-                    while True:
-                        read_data = this_input_handle.read(read_buf_size)
-                        if read_data:
-                            cat_file_handle.write(read_data)
-                        else:
-                            break
-                os.remove (this_input_path)  # create space since we no longer need the piece file
-
-                # append rev
-                this_input_path = this_input_rev_path
-                cat_file_handle = combined_input_rev_handle
-                with open (this_input_path, 'r', read_buf_size) as this_input_handle:
-                    while True:
-                        read_data = this_input_handle.read(read_buf_size)
-                        if read_data:
-                            cat_file_handle.write(read_data)
-                        else:
-                            break
-                os.remove (this_input_path)  # create space since we no longer need the piece file
-
-            combined_input_fwd_handle.close()
-            combined_input_rev_handle.close()
+                for direction in self.reads_directions:
+                    concats[direction] = FileConcatenator (combined_input_paths[direction][0])
+                for lib_i,this_input_reads_ref in enumerate(readsSet_ref_list):
+                    this_input_files = prefetcher.get(lib_i)
+
+                    self.log (console, "MegaHit_Sets:run_megahit(): APPENDING FASTQ FILES FOR ReadsSet member: "+str(this_input_reads_ref))
+                    with spans.span('concat', reads_ref=this_input_reads_ref) as span:
+                        for direction in self.reads_directions:
+                            concats[direction].append (this_input_files[direction])
+                        span.add_bytes (self.files_size(this_input_files.values()))
+                    for path in this_input_files.values():
+                        self.reads_cache.release (path)  # create space since we no longer need the piece file
+            finally:
+                for concat in concats.values():
+                    concat.close()
+                prefetcher.close()
+            for direction in self.reads_directions:
+                self.log (console, "MegaHit_Sets:run_megahit(): COMBINED "+concats[direction].summary())
 
 
         ### STEP 5: finally run MegaHit_Sets
@@ -410,75 +815,88 @@ class MegaHit_Sets:
         output_assemblyset_contigset_paths = []
         output_contigset_path = None
 
+        # assemblies are saved (STEP 6) in the background as soon as each one is assembled
+        assembly_saver = AssemblySaver (lambda i, contigs_path: self.save_assembly(ctx, contigs_path,
+                                                                                   params['workspace_name'],
+                                                                                   output_contigset_names[i],
+                                                                                   SERVICE_VER, spans),
+                                        max_uploads=self.assembly_save_threads)
+
+
+        # PairedEndLibrary or ReadsSet combined, assembled before
+        if 0 in cached_assemblies and (input_reads_obj_type != "KBaseSets.ReadsSet" or params['combined_assembly_flag'] != 0):
+            output_assemblyset_contigset_paths.append (cached_assemblies[0]['contigs_path'])
 
         # PairedEndLibrary
-        if input_reads_obj_type == "KBaseFile.PairedEndLibrary":
-            self.log (console, "MegaHit_Sets:run_megahit(): DOWNLOADING FASTQ FILES FOR ReadsLibrary: "+str(input_reads_ref))
-            try:
-                readsUtils_Client = ReadsUtils (url=self.callbackURL, token=ctx['token'])  # SDK local
-                readsLibrary = readsUtils_Client.download_reads ({'read_libraries': [input_reads_ref],
-                                                                  'interleaved': 'false'
-                                                                  })
-            except Exception as e:
-                raise ValueError('Unable to get reads object from workspace: (' + input_reads_ref +")\n" + str(e))
+        elif input_reads_obj_type == "KBaseFile.PairedEndLibrary":
+            input_files = self.download_reads_library (ctx, input_reads_versioned_ref, console, spans)
 
-            input_fwd_path = readsLibrary['files'][input_reads_ref]['files']['fwd']
-            input_rev_path = readsLibrary['files'][input_reads_ref]['files']['rev']
-            exec_megahit_single_library_params['input_fwd_path'] = input_fwd_path
-            exec_megahit_single_library_params['input_rev_path'] = input_rev_path
+            for direction, input_path in input_files.items():
+                exec_megahit_single_library_params['input_'+direction+'_path'] = input_path
+            exec_megahit_single_library_params['input_reads_refs'] = [input_reads_versioned_ref]
 
             # the key line
-            output_contigset_path = self.exec_megahit_single_library (exec_megahit_single_library_params)
+            output_contigset_path = self.exec_megahit_single_library (exec_megahit_single_library_params, spans)
             output_assemblyset_contigset_paths.append (output_contigset_path)
             
-            os.remove (input_fwd_path) # files can be really big
-            os.remove (input_rev_path)
+            for input_path in input_files.values():
+                self.reads_cache.release (input_path) # files can be really big
 
-        # ReadsSet combined (already downloaded and combined fastqs)
+        # ReadsSet combined (already downloaded, and combined fastqs unless in multifile or fifo mode)
         elif input_reads_obj_type == "KBaseSets.ReadsSet" and params['combined_assembly_flag'] != 0:
 
-            input_fwd_path = combined_input_fwd_path
-            input_rev_path = combined_input_rev_path
-            exec_megahit_single_library_params['input_fwd_path'] = input_fwd_path
-            exec_megahit_single_library_params['input_rev_path'] = input_rev_path
+            for direction, input_paths in combined_input_paths.items():
+                exec_megahit_single_library_params['input_'+direction+'_paths'] = input_paths
+            if self.combined_input_mode != 'fifo':
+                # (a resumed megahit may never open the pipes, leaving the feeder stuck)
+                exec_megahit_single_library_params['input_reads_refs'] = readsSet_versioned_ref_list
 
-            # the key line
-            output_contigset_path = self.exec_megahit_single_library (exec_megahit_single_library_params)
-            output_assemblyset_contigset_paths.append (output_contigset_path)
+            if self.combined_input_mode == 'fifo':
+                # members are streamed into the pipes (and removed) while megahit reads them
+                feeder.start()
+                try:
+                    # the key line
+                    output_contigset_path = self.exec_megahit_single_library (exec_megahit_single_library_params, spans)
+                finally:
+                    prefetcher.close()
+                    feeder.close()
+                    shutil.rmtree(fifo_dir)
+                feeder.check()  # megahit must not have seen a truncated stream
+                self.log (console, "MegaHit_Sets:run_megahit(): STREAMED "+
+                          " and ".join([str(feeder.bytes_written[direction])+" "+direction
+                                        for direction in self.reads_directions])+" bytes")
+            else:
+                # the key line
+                output_contigset_path = self.exec_megahit_single_library (exec_megahit_single_library_params, spans)
 
-            os.remove (input_fwd_path) # files can be really big
-            os.remove (input_rev_path)
+                for input_paths in combined_input_paths.values():
+                    for input_path in input_paths:
+                        self.reads_cache.release (input_path) # files can be really big
+            output_assemblyset_contigset_paths.append (output_contigset_path)
 
         # ReadsSet uncombined (still have to download)
         elif input_reads_obj_type == "KBaseSets.ReadsSet" and params['combined_assembly_flag'] == 0:
-            # connect to ReadsUtils Client
+            # libraries assembled before are saved straight away
+            output_assemblyset_contigset_paths = [None for ref in readsSet_ref_list]
+            for i,cached_assembly in sorted(cached_assemblies.items()):
+                output_assemblyset_contigset_paths[i] = cached_assembly['contigs_path']
+                assembly_saver.submit (i, cached_assembly['contigs_path'])
+
+            # get the other libraries (at the versions looked up) and run MegaHit_Sets, several at a time if configured
+            to_assemble = [i for i in range(len(readsSet_ref_list)) if i not in cached_assemblies]
             try:
-                readsUtils_Client = ReadsUtils (url=self.callbackURL, token=ctx['token'])  # SDK local
+                if to_assemble:
+                    assembled_paths = self.exec_megahit_library_pool (ctx, [readsSet_versioned_ref_list[i] for i in to_assemble],
+                                                                      exec_megahit_single_library_params, console,
+                                                                      on_assembled=lambda j, contigs_path: assembly_saver.submit(to_assemble[j], contigs_path),
+                                                                      spans=spans)
+                    for i,contigs_path in zip(to_assemble, assembled_paths):
+                        output_assemblyset_contigset_paths[i] = contigs_path
             except:
-                raise ValueError("Unable to get readsUtils_Client\n" + str(e))
-
-            # get libraries, one at a time, and run MegaHit_Sets
-            output_assemblyset_contigset_paths = []
-            for this_input_reads_ref in readsSet_ref_list:
-                self.log (console, "MegaHit_Sets:run_megahit(): DOWNLOADING FASTQ FILES FOR ReadsSet member: "+str(this_input_reads_ref))
-                try:
-                    readsLibrary = readsUtils_Client.download_reads ({'read_libraries': [this_input_reads_ref],
-                                                                      'interleaved': 'false'
-                                                                      })
-                except Exception as e:
-                    raise ValueError('Unable to get reads object from workspace: (' + this_input_reads_ref +")\n" + str(e))
-
-                this_input_fwd_path = readsLibrary['files'][this_input_reads_ref]['files']['fwd']
-                this_input_rev_path = readsLibrary['files'][this_input_reads_ref]['files']['rev']
-                exec_megahit_single_library_params['input_fwd_path'] = this_input_fwd_path
-                exec_megahit_single_library_params['input_rev_path'] = this_input_rev_path
-
-                # the key line
-                this_output_contigset_path = self.exec_megahit_single_library (exec_megahit_single_library_params)
-                output_assemblyset_contigset_paths.append (this_output_contigset_path)
-                
-                os.remove (this_input_fwd_path) # files can be really big
-                os.remove (this_input_rev_path)
+                # keep what did assemble: let its uploads finish before failing
+                for i,saved_ref in sorted(assembly_saver.saved().items()):
+                    self.log (console, "MegaHit_Sets:run_megahit(): SAVED "+output_contigset_names[i]+" ("+str(saved_ref)+") BEFORE FAILURE")
+                raise
 
         # just in case we've confused ourselves
         else:  
@@ -486,51 +904,37 @@ class MegaHit_Sets:
 
 
         ### STEP 6: save the resulting assembly
-        assemblyUtil = AssemblyUtil(self.callbackURL, token=ctx['token'], service_ver=SERVICE_VER)
-        output_contigset_refs = []
-        output_contigset_names = []
-        for i,this_output_contigset_path in enumerate(output_assemblyset_contigset_paths):
-            if len(output_assemblyset_contigset_paths) == 1:
-                assembly_name = params['output_contigset_name']
-            else:
-                assembly_name = readsSet_names_list[i]+'-'+params['output_contigset_name']
-
-            this_output_data_ref = assemblyUtil.save_assembly_from_fasta({ 
-                                                    'file':{'path':this_output_contigset_path},
-                                                    'workspace_name':params['workspace_name'],
-                                                    'assembly_name':assembly_name
-                                                    })
-
-            output_contigset_refs.append (this_output_data_ref)
-            output_contigset_names.append (assembly_name)
+        # (uncombined sets have been saving in the background since each library finished)
+        if input_reads_obj_type != "KBaseSets.ReadsSet" or params['combined_assembly_flag'] != 0:
+            assembly_saver.submit (0, output_assemblyset_contigset_paths[0])
+        output_contigset_refs = assembly_saver.results (len(output_assemblyset_contigset_paths))
 
 
         ### STEP 7: generate the report text
 
-        # compute a simple contig length distribution for the report
-        report = ''
-        for i,this_output_contigset_path in enumerate(output_assemblyset_contigset_paths):
-
-            report += "MegaHit_Sets run for Read Library: "+readsSet_names_list[i]+"\n"
-            report += "-------------------------------------------------------------\n"
-            report += "\n"
-            lengths = []
-            for seq_record in SeqIO.parse(this_output_contigset_path, 'fasta'):
-                lengths.append(len(seq_record.seq))
-
-                report += 'ContigSet saved to: '+params['workspace_name']+'/'+output_contigset_names[i]+'\n'
-                report += 'Assembled into '+str(len(lengths)) + ' contigs.\n'
-                report += 'Avg Length: '+str(sum(lengths)/float(len(lengths))) + ' bp.\n'
-
-                bins = 10
-                counts, edges = np.histogram(lengths, bins)
-                report += 'Contig Length Distribution (# of contigs -- min to max basepairs):\n'
-                for c in range(bins):
-                    report += '   '+str(counts[c]) + '\t--\t' + str(edges[c]) + ' to ' + str(edges[c+1]) + ' bp\n'
+        # statistics are collected once per assembly, then rendered as text and as an html summary table
+        report = AssemblyReport(params['workspace_name'])
+        with spans.span('report') as span:
+            for i,this_output_contigset_path in enumerate(output_assemblyset_contigset_paths):
+                if input_reads_obj_type == "KBaseSets.ReadsSet" and params['combined_assembly_flag'] != 0:
+                    this_reads_name = input_reads_name  # the whole set went into this one
+                else:
+                    this_reads_name = readsSet_names_list[i]
+                cached_assembly = cached_assemblies.get(i, {})
+                stats = report.add(this_reads_name, output_contigset_names[i], this_output_contigset_path,
+                                   stats=cached_assembly.get('stats'))
+                span.add_bytes (self.files_size([this_output_contigset_path]))
+
+                # new assemblies go in the result cache, with their statistics
+                if assembly_cache_keys[i] is not None and not cached_assembly:
+                    self.assembly_cache.put (assembly_cache_keys[i], this_output_contigset_path, stats)
+            report_text = report.text()
+            report_html = report.html()
 
 
         ### STEP 8: contruct the output to send back
-        output = { 'report_text': report,
+        output = { 'report_text': report_text + spans.text(),
+                   'report_html': report_html,
                    'output_contigset_refs': output_contigset_refs
                  }
 
@@ -1,10 +1,13 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+# Generated by the KBase type compiler, then changed by hand (batches, the JSON
+# codec, bounded request bodies, /metrics): make compile leaves this file as it is
 from wsgiref.simple_server import make_server
 import sys
 import json
 import traceback
 import datetime
+import time
 from multiprocessing import Process
 from getopt import getopt, GetoptError
 from jsonrpcbase import JSONRPCService, InvalidParamsError, KeywordError,\
@@ -17,10 +20,15 @@ import requests as _requests
 import random as _random
 import os
 from MegaHit_Sets.authclient import KBaseAuth as _KBaseAuth
+from MegaHit_Sets.jsoncodec import JSONCodec as _JSONCodec
+from MegaHit_Sets import metrics as _metrics
 
 DEPLOY = 'KB_DEPLOYMENT_CONFIG'
 SERVICE = 'KB_SERVICE_NAME'
 AUTH = 'auth-server-url'
+MAX_REQUEST_SIZE = 'max-request-size-mb'
+METRICS_PATH = '/metrics'
+_READ_CHUNK_SIZE = 1024 * 1024
 
 # Note that the error fields do not match the 2.0 JSONRPC spec
 
@@ -61,6 +69,14 @@ class JSONObjectEncoder(json.JSONEncoder):
         return json.JSONEncoder.default(self, obj)
 
 
+# one codec, and so one encoder, for every request and response
+_codec = _JSONCodec(default=JSONObjectEncoder().default)
+
+
+class RequestTooLargeError(Exception):
+    pass
+
+
 class JSONRPCServiceCustom(JSONRPCService):
 
     def call(self, ctx, jsondata):
@@ -73,7 +89,7 @@ class JSONRPCServiceCustom(JSONRPCService):
         """
         result = self.call_py(ctx, jsondata)
         if result is not None:
-            return json.dumps(result, cls=JSONObjectEncoder)
+            return _codec.dumps(result)
 
         return None
 
@@ -342,6 +358,54 @@ class Application(object):
                              types=[dict])
         authurl = config.get(AUTH) if config else None
         self.auth_client = _KBaseAuth(authurl)
+        max_mb = config.get(MAX_REQUEST_SIZE) if config else None
+        self.max_request_size = int(float(max_mb or 100) * 1024 * 1024)
+
+        # served on GET METRICS_PATH
+        registry = _metrics.REGISTRY
+        self.requests_total = registry.counter(
+            'megahit_sets_requests_total', 'JSON-RPC calls, by method',
+            ['method'])
+        self.request_errors_total = registry.counter(
+            'megahit_sets_request_errors_total',
+            'JSON-RPC calls that returned an error, by method', ['method'])
+        self.request_seconds = registry.histogram(
+            'megahit_sets_request_duration_seconds',
+            'Time to answer a JSON-RPC call, by method', ['method'])
+        self.requests_in_flight = registry.gauge(
+            'megahit_sets_requests_in_flight',
+            'JSON-RPC calls being answered')
+        auth_stats = self.auth_client.cache_stats
+        registry.gauge_function(
+            'megahit_sets_auth_cache_hit_ratio',
+            'Share of token lookups answered from the cache',
+            lambda: auth_stats()['hit_ratio'])
+        registry.gauge_function(
+            'megahit_sets_auth_cache_size', 'Tokens in the cache',
+            lambda: auth_stats()['size'])
+
+    def read_body(self, environ):
+        '''
+        Read the request body in chunks, up to max_request_size bytes.
+        '''
+        try:
+            body_size = int(environ.get('CONTENT_LENGTH', 0))
+        except (ValueError):
+            body_size = 0
+        if body_size > self.max_request_size:
+            raise RequestTooLargeError(
+                'Request body of {} bytes exceeds the limit of {} bytes'
+                .format(body_size, self.max_request_size))
+        chunks = []
+        remaining = body_size
+        while remaining > 0:
+            chunk = environ['wsgi.input'].read(
+                min(remaining, _READ_CHUNK_SIZE))
+            if not chunk:
+                break
+            chunks.append(chunk)
+            remaining -= len(chunk)
+        return chunks[0] if len(chunks) == 1 else ''.join(chunks)
 
     def __call__(self, environ, start_response):
         # Context object, equivalent to the perl impl CallContext
@@ -349,18 +413,28 @@ class Application(object):
         ctx['client_ip'] = getIPAddress(environ)
         status = '500 Internal Server Error'
 
-        try:
-            body_size = int(environ.get('CONTENT_LENGTH', 0))
-        except (ValueError):
-            body_size = 0
         if environ['REQUEST_METHOD'] == 'OPTIONS':
             # we basically do nothing and just return headers
             status = '200 OK'
             rpc_result = ""
+        elif (environ['REQUEST_METHOD'] == 'GET' and
+                environ.get('PATH_INFO') == METRICS_PATH):
+            response_body = _metrics.REGISTRY.render()
+            start_response('200 OK', [
+                ('content-type', _metrics.CONTENT_TYPE),
+                ('content-length', str(len(response_body)))])
+            return [response_body]
         else:
-            request_body = environ['wsgi.input'].read(body_size)
             try:
-                req = json.loads(request_body)
+                req = _codec.loads(self.read_body(environ))
+            except RequestTooLargeError as rte:
+                status = '413 Request Entity Too Large'
+                err = {'error': {'code': -32600,
+                                 'name': 'Request too large',
+                                 'message': str(rte),
+                                 }
+                       }
+                rpc_result = self.process_error(err, ctx, {'version': '1.1'})
             except ValueError as ve:
                 err = {'error': {'code': -32700,
                                  'name': "Parse error",
@@ -369,71 +443,22 @@ class Application(object):
                        }
                 rpc_result = self.process_error(err, ctx, {'version': '1.1'})
             else:
-                ctx['module'], ctx['method'] = req['method'].split('.')
-                ctx['call_id'] = req['id']
-                ctx['rpc_context'] = {
-                    'call_stack': [{'time': self.now_in_utc(),
-                                    'method': req['method']}
-                                   ]
-                }
-                prov_action = {'service': ctx['module'],
-                               'method': ctx['method'],
-                               'method_params': req['params']
-                               }
-                ctx['provenance'] = [prov_action]
-                try:
-                    token = environ.get('HTTP_AUTHORIZATION')
-                    # parse out the method being requested and check if it
-                    # has an authentication requirement
-                    method_name = req['method']
-                    auth_req = self.method_authentication.get(
-                        method_name, 'none')
-                    if auth_req != 'none':
-                        if token is None and auth_req == 'required':
-                            err = JSONServerError()
-                            err.data = (
-                                'Authentication required for ' +
-                                'MegaHit_Sets ' +
-                                'but no authentication header was passed')
-                            raise err
-                        elif token is None and auth_req == 'optional':
-                            pass
-                        else:
-                            try:
-                                user = self.auth_client.get_user(token)
-                                ctx['user_id'] = user
-                                ctx['authenticated'] = 1
-                                ctx['token'] = token
-                            except Exception, e:
-                                if auth_req == 'required':
-                                    err = JSONServerError()
-                                    err.data = \
-                                        "Token validation failed: %s" % e
-                                    raise err
-                    if (environ.get('HTTP_X_FORWARDED_FOR')):
-                        self.log(log.INFO, ctx, 'X-Forwarded-For: ' +
-                                 environ.get('HTTP_X_FORWARDED_FOR'))
-                    self.log(log.INFO, ctx, 'start method')
-                    rpc_result = self.rpc_service.call(ctx, req)
-                    self.log(log.INFO, ctx, 'end method')
+                if isinstance(req, list) and req:
+                    # a batch: each request is dispatched in turn, and the
+                    # responses are returned together
+                    responses = []
+                    for req_ in req:
+                        ctx_ = MethodContext(self.userlog)
+                        ctx_['client_ip'] = ctx['client_ip']
+                        _, rpc_result_ = self.process_request(environ, ctx_,
+                                                              req_)
+                        if rpc_result_:
+                            responses.append(rpc_result_)
                     status = '200 OK'
-                except JSONRPCError as jre:
-                    err = {'error': {'code': jre.code,
-                                     'name': jre.message,
-                                     'message': jre.data
-                                     }
-                           }
-                    trace = jre.trace if hasattr(jre, 'trace') else None
-                    rpc_result = self.process_error(err, ctx, req, trace)
-                except Exception:
-                    err = {'error': {'code': 0,
-                                     'name': 'Unexpected Server Error',
-                                     'message': 'An unexpected server error ' +
-                                                'occurred',
-                                     }
-                           }
-                    rpc_result = self.process_error(err, ctx, req,
-                                                    traceback.format_exc())
+                    rpc_result = '[' + ','.join(responses) + ']'
+                else:
+                    status, rpc_result = self.process_request(environ, ctx,
+                                                              req)
 
         # print 'Request method was %s\n' % environ['REQUEST_METHOD']
         # print 'Environment dictionary is:\n%s\n' % pprint.pformat(environ)
@@ -455,6 +480,105 @@ class Application(object):
         start_response(status, response_headers)
         return [response_body]
 
+    def process_request(self, environ, ctx, req):
+        '''
+        Run a single request, returning the http status and the response
+        body (None for a notification).
+        '''
+        method = req.get('method') if isinstance(req, dict) else None
+        if (not isinstance(method, basestring) or
+                method not in self.rpc_service.method_data):
+            method = 'unknown'  # keep the metric label values bounded
+        start = time.time()
+        with self.requests_in_flight.track_inprogress():
+            status, rpc_result = self._process_request(environ, ctx, req)
+        self.request_seconds.labels(method).observe(time.time() - start)
+        self.requests_total.labels(method).inc()
+        if status != '200 OK':
+            self.request_errors_total.labels(method).inc()
+        return status, rpc_result
+
+    def _process_request(self, environ, ctx, req):
+        status = '500 Internal Server Error'
+        # e.g. a member of a batch; one without an id is a notification
+        if (not isinstance(req, dict) or
+                not isinstance(req.get('method'), basestring) or
+                req['method'].count('.') != 1):
+            err = {'error': {'code': -32600,
+                             'name': 'Invalid Request',
+                             'message': 'The request is not a JSON-RPC ' +
+                                        'request object',
+                             }
+                   }
+            return status, self.process_error(
+                err, ctx, req if isinstance(req, dict) else {})
+        ctx['module'], ctx['method'] = req['method'].split('.')
+        ctx['call_id'] = req.get('id')
+        ctx['rpc_context'] = {
+            'call_stack': [{'time': self.now_in_utc(),
+                            'method': req['method']}
+                           ]
+        }
+        prov_action = {'service': ctx['module'],
+                       'method': ctx['method'],
+                       'method_params': req.get('params')
+                       }
+        ctx['provenance'] = [prov_action]
+        try:
+            token = environ.get('HTTP_AUTHORIZATION')
+            # parse out the method being requested and check if it
+            # has an authentication requirement
+            method_name = req['method']
+            auth_req = self.method_authentication.get(
+                method_name, 'none')
+            if auth_req != 'none':
+                if token is None and auth_req == 'required':
+                    err = JSONServerError()
+                    err.data = (
+                        'Authentication required for ' +
+                        'MegaHit_Sets ' +
+                        'but no authentication header was passed')
+                    raise err
+                elif token is None and auth_req == 'optional':
+                    pass
+                else:
+                    try:
+                        user = self.auth_client.get_user(token)
+                        ctx['user_id'] = user
+                        ctx['authenticated'] = 1
+                        ctx['token'] = token
+                    except Exception, e:
+                        if auth_req == 'required':
+                            err = JSONServerError()
+                            err.data = \
+                                "Token validation failed: %s" % e
+                            raise err
+            if (environ.get('HTTP_X_FORWARDED_FOR')):
+                self.log(log.INFO, ctx, 'X-Forwarded-For: ' +
+                         environ.get('HTTP_X_FORWARDED_FOR'))
+            self.log(log.INFO, ctx, 'start method')
+            rpc_result = self.rpc_service.call(ctx, req)
+            self.log(log.INFO, ctx, 'end method')
+            status = '200 OK'
+        except JSONRPCError as jre:
+            err = {'error': {'code': jre.code,
+                             'name': jre.message,
+                             'message': jre.data
+                             }
+                   }
+            trace = jre.trace if hasattr(jre, 'trace') else None
+            rpc_result = self.process_error(err, ctx, req, trace)
+        except Exception:
+            err = {'error': {'code': 0,
+                             'name': 'Unexpected Server Error',
+                             'message': 'An unexpected server error ' +
+                                        'occurred',
+                             }
+                   }
+            rpc_result = self.process_error(err, ctx, req,
+                                            traceback.format_exc())
+        return status, rpc_result
+
     def process_error(self, error, context, request, trace=None):
         if trace:
             self.log(log.ERR, context, trace.split('\n')[0:-1])
@@ -471,7 +595,7 @@ class Application(object):
         else:
             error['version'] = '1.0'
             error['error']['error'] = trace
-        return json.dumps(error)
+        return _codec.dumps(error)
 
     def now_in_utc(self):
         # noqa Taken from http://stackoverflow.com/questions/3401428/how-to-get-an-isoformat-datetime-string-including-the-default-timezone @IgnorePep8
@@ -590,7 +714,7 @@ def process_async_cli(input_file_path, output_file_path, token):
     if 'error' in resp:
         exit_code = 500
     with open(output_file_path, "w") as f:
-        f.write(json.dumps(resp, cls=JSONObjectEncoder))
+        f.write(_codec.dumps(resp))
     return exit_code
 
 if __name__ == "__main__":
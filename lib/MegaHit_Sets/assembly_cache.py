@@ -0,0 +1,124 @@
+'''
+A local cache of finished assemblies, keyed on what went into them.
+
+Each entry is a directory named by the key, holding the contigs and their
+statistics.  Entries are written to a temporary directory and renamed into
+place, so several processes can share the cache, and the least recently
+used are evicted once the cache grows past its size limit.  An entry's
+modification time is its last use.
+'''
+import errno as _errno
+import hashlib as _hashlib
+import json as _json
+import os as _os
+import shutil as _shutil
+import threading as _threading
+import uuid as _uuid
+
+_CONTIGS = 'final.contigs.fa'
+_STATS = 'stats.json'
+
+
+def _link_or_copy(src, dest):
+    # a hard link is instant, and keeps the data if the other name is removed
+    try:
+        _os.link(src, dest)
+    except OSError:
+        _shutil.copyfile(src, dest)
+
+
+class AssemblyCache(object):
+    '''
+    Contigs and statistics by key, in cache_dir, up to max_bytes in all.
+    '''
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._lock = _threading.Lock()
+        if not _os.path.exists(cache_dir):
+            _os.makedirs(cache_dir)
+
+    @staticmethod
+    def key(reads_refs, options, megahit_version):
+        '''
+        The key of an assembly of versioned reads_refs with the megahit
+        options (a list of arguments) by megahit_version.
+        '''
+        what = {'reads': list(reads_refs), 'options': list(options),
+                'megahit': megahit_version}
+        return _hashlib.sha256(
+            _json.dumps(what, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def _entry(self, key):
+        return _os.path.join(self.cache_dir, key)
+
+    def checkout(self, key, contigs_path):
+        '''
+        Put the cached contigs for key at contigs_path and return their
+        statistics (None if none were stored), or return False on a miss.
+        '''
+        entry = self._entry(key)
+        try:
+            if _os.path.exists(contigs_path):
+                _os.remove(contigs_path)
+            _link_or_copy(_os.path.join(entry, _CONTIGS), contigs_path)
+        except (IOError, OSError) as e:
+            if e.errno != _errno.ENOENT:
+                raise
+            return False  # never cached, or evicted
+        try:
+            _os.utime(entry, None)  # now the most recently used
+            with open(_os.path.join(entry, _STATS)) as f:
+                return _json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def put(self, key, contigs_path, stats=None):
+        '''
+        Cache the contigs at contigs_path, and their statistics, as key.
+        '''
+        entry = self._entry(key)
+        if _os.path.exists(entry):
+            return
+        tmp = _os.path.join(self.cache_dir, '.tmp.' + _uuid.uuid4().hex)
+        _os.makedirs(tmp)
+        try:
+            _link_or_copy(contigs_path, _os.path.join(tmp, _CONTIGS))
+            if stats is not None:
+                with open(_os.path.join(tmp, _STATS), 'w') as f:
+                    _json.dump(stats, f)
+            _os.rename(tmp, entry)
+        except OSError as e:
+            # another process cached it first
+            if e.errno not in (_errno.EEXIST, _errno.ENOTEMPTY):
+                raise
+        finally:
+            if _os.path.exists(tmp):
+                _shutil.rmtree(tmp)
+        self.evict()
+
+    def evict(self):
+        '''
+        Remove the least recently used entries until the cache fits in
+        max_bytes.
+        '''
+        with self._lock:
+            entries = []
+            total = 0
+            for name in _os.listdir(self.cache_dir):
+                entry = self._entry(name)
+                if name.startswith('.tmp.'):
+                    continue
+                try:
+                    size = sum(_os.path.getsize(_os.path.join(entry, f))
+                               for f in _os.listdir(entry))
+                    entries.append((_os.path.getmtime(entry), size, entry))
+                except OSError:
+                    continue  # evicted by another process meanwhile
+                total += size
+            for _, size, entry in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                _shutil.rmtree(entry, ignore_errors=True)
+                total -= size
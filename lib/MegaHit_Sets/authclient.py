@@ -3,37 +3,61 @@ Created on Aug 1, 2016
 
 A very basic KBase auth client for the Python server.
 
+Generated by the KBase type compiler, then changed by hand (the LRU token
+cache, shared and background validations): make compile leaves this file as
+it is.
+
 @author: gaprice@lbl.gov
 '''
 import time as _time
 import requests as _requests
 import threading as _threading
 import hashlib
+from collections import OrderedDict as _OrderedDict
 
 
 class TokenCache(object):
-    ''' A basic cache for tokens. '''
+    '''
+    A least recently used cache for tokens. Each token expires ttl seconds
+    after it was added. Expired tokens are dropped when they are looked up,
+    or when they reach the least recently used end of the cache, so no call
+    scans the whole cache. Lookups, adds and evictions are all O(1).
+    '''
 
     _MAX_TIME_SEC = 5 * 60  # 5 min
 
-    _lock = _threading.RLock()
-
-    def __init__(self, maxsize=2000):
-        self._cache = {}
+    def __init__(self, maxsize=2000, ttl=None):
+        self._cache = _OrderedDict()  # hashed token -> [user, time added]
         self._maxsize = maxsize
-        self._halfmax = maxsize / 2  # int division to round down
+        self.ttl = self._MAX_TIME_SEC if ttl is None else ttl
+        self._lock = _threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
 
     def get_user(self, token):
+        return self.get_user_and_age(token)[0]
+
+    def get_user_and_age(self, token):
+        '''
+        Return the user for token and the seconds since it was added, or
+        (None, None) if the token isn't cached.
+        '''
         token = hashlib.sha256(token).hexdigest()
+        now = _time.time()
         with self._lock:
-            usertime = self._cache.get(token)
-        if not usertime:
-            return None
-
-        user, intime = usertime
-        if _time.time() - intime > self._MAX_TIME_SEC:
-            return None
-        return user
+            usertime = self._cache.pop(token, None)
+            if not usertime:
+                self.misses += 1
+                return None, None
+            if now - usertime[1] > self.ttl:
+                self.expirations += 1
+                self.misses += 1
+                return None, None
+            self._cache[token] = usertime  # now the most recently used
+            self.hits += 1
+        return usertime[0], now - usertime[1]
 
     def add_valid_token(self, token, user):
         if not token:
@@ -41,51 +65,177 @@ class TokenCache(object):
         if not user:
             raise ValueError('Must supply user')
         token = hashlib.sha256(token).hexdigest()
+        now = _time.time()
+        with self._lock:
+            self._cache.pop(token, None)
+            self._cache[token] = [user, now]
+            # sweep expired tokens off the least recently used end
+            while self._cache:
+                t = next(iter(self._cache))
+                if now - self._cache[t][1] <= self.ttl:
+                    break
+                del self._cache[t]
+                self.expirations += 1
+            while len(self._cache) > self._maxsize:
+                self._cache.popitem(last=False)
+                self.evictions += 1
+
+    def remove(self, token):
+        token = hashlib.sha256(token).hexdigest()
+        with self._lock:
+            self._cache.pop(token, None)
+
+    def stats(self):
+        '''
+        The hit, miss, eviction and expiration counts, the cache size and
+        the hit ratio.
+        '''
         with self._lock:
-            self._cache[token] = [user, _time.time()]
-            if len(self._cache) > self._maxsize:
-                for i, (t, _) in enumerate(sorted(self._cache.items(),
-                                                  key=lambda (_, v): v[1])):
-                    if i <= self._halfmax:
-                        del self._cache[t]
-                    else:
-                        break
+            lookups = self.hits + self.misses
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'expirations': self.expirations,
+                    'size': len(self._cache),
+                    'hit_ratio': (float(self.hits) / lookups
+                                  if lookups else 0.0)}
+
+
+class _Validation(object):
+    '''
+    A token validation in progress, shared by the callers waiting for it.
+    '''
+
+    def __init__(self):
+        self.done = _threading.Event()
+        self.user = None
+        self.error = None
 
 
 class KBaseAuth(object):
     '''
     A very basic KBase auth client for the Python server.
+
+    Concurrent requests to validate the same token share one call to the
+    auth service. Tokens the service rejects are remembered for
+    _REJECTED_TIME_SEC, and a cached token is validated again in the
+    background once it is within _REFRESH_SEC of expiring, so a client that
+    keeps calling never waits on the auth service.
+
+    timeout - seconds to wait on the auth service before failing. Requests
+        sharing a validation wait at most twice that for it. Default
+        _TIMEOUT_SEC.
     '''
 
     _LOGIN_URL = 'https://kbase.us/services/authorization/Sessions/Login'
 
-    def __init__(self, auth_url=None):
+    _REFRESH_SEC = 30
+    _REJECTED_TIME_SEC = 30
+    _TIMEOUT_SEC = 30
+    # answers meaning the token itself is bad, rather than that the auth
+    # service is failing: these statuses, or auth2's invalid token appcode
+    _REJECTED_STATUS = frozenset([401, 403])
+    _INVALID_TOKEN_APPCODE = 10020
+
+    def __init__(self, auth_url=None, timeout=None):
         '''
         Constructor
         '''
         self._authurl = auth_url
         if not self._authurl:
             self._authurl = self._LOGIN_URL
+        self.timeout = timeout or self._TIMEOUT_SEC
         self._cache = TokenCache()
+        # rejected token -> the error message
+        self._rejected = TokenCache(maxsize=500, ttl=self._REJECTED_TIME_SEC)
+        self._inflight = {}  # token -> _Validation
+        self._lock = _threading.Lock()
 
     def get_user(self, token):
         if not token:
             raise ValueError('Must supply token')
-        user = self._cache.get_user(token)
+        user, age = self._cache.get_user_and_age(token)
         if user:
+            if age > self._cache.ttl - self._REFRESH_SEC:
+                self._refresh(token)
             return user
+        error_msg = self._rejected.get_user(token)
+        if error_msg:
+            raise ValueError(error_msg)
+        return self._validate(token)
+
+    def cache_stats(self):
+        '''
+        The statistics of the token cache, see TokenCache.stats.
+        '''
+        return self._cache.stats()
 
+    def _refresh(self, token):
+        # registered before the thread starts, so a burst of callers starts
+        # one refresh; an error is seen once the cached token expires
+        with self._lock:
+            if token in self._inflight:
+                return
+            validation = self._inflight[token] = _Validation()
+        t = _threading.Thread(target=self._run_validation,
+                              args=(token, validation))
+        t.daemon = True
+        t.start()
+
+    def _validate(self, token):
+        with self._lock:
+            validation = self._inflight.get(token)
+            first = validation is None
+            if first:
+                validation = self._inflight[token] = _Validation()
+        if first:
+            self._run_validation(token, validation)
+        elif not validation.done.wait(2 * self.timeout):
+            # e.g. a read from the auth service that keeps trickling in
+            raise ValueError('Timed out waiting for the auth service to '
+                             'validate the token')
+        if validation.error is not None:
+            raise validation.error
+        return validation.user
+
+    def _run_validation(self, token, validation):
+        try:
+            validation.user = self._fetch_user(token)
+            self._cache.add_valid_token(token, validation.user)
+        except Exception as e:
+            validation.error = e
+        finally:
+            with self._lock:
+                del self._inflight[token]
+            validation.done.set()
+
+    def _fetch_user(self, token):
         d = {'token': token, 'fields': 'user_id'}
-        ret = _requests.post(self._authurl, data=d)
+        try:
+            ret = _requests.post(self._authurl, data=d, timeout=self.timeout)
+        except _requests.exceptions.Timeout:
+            raise ValueError('Timed out after {} s connecting to the auth '
+                             'service'.format(self.timeout))
         if not ret.ok:
             try:
                 err = ret.json()
             except:
                 ret.raise_for_status()
-            raise ValueError('Error connecting to auth service: {} {}\n{}'
-                             .format(ret.status_code, ret.reason,
-                                     err['error_msg']))
-
-        user = ret.json()['user_id']
-        self._cache.add_valid_token(token, user)
-        return user
+            error_msg = ('Error connecting to auth service: {} {}\n{}'
+                         .format(ret.status_code, ret.reason,
+                                 err.get('error_msg', err)
+                                 if isinstance(err, dict) else err))
+            if self._is_rejection(ret.status_code, err):
+                self._cache.remove(token)
+                self._rejected.add_valid_token(token, error_msg)
+            raise ValueError(error_msg)
+
+        return ret.json()['user_id']
+
+    def _is_rejection(self, status_code, err):
+        # the auth service rejected the token, rather than failed (e.g. 503)
+        if status_code in self._REJECTED_STATUS:
+            return True
+        error = err.get('error') if isinstance(err, dict) else None
+        return (isinstance(error, dict) and
+                error.get('appcode') == self._INVALID_TOKEN_APPCODE)
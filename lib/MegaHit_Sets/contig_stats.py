@@ -0,0 +1,132 @@
+'''
+Contig statistics for a FASTA file in a single vectorized pass.
+
+The file is memory mapped and scanned a chunk of whole records at a time
+with numpy, looking only at record starts and line breaks; no per-contig
+Python objects are created.  Only the contig lengths (4 bytes each) are
+kept, so a 10M contig assembly needs about 40 MB plus one chunk.
+'''
+import mmap as _mmap
+import os as _os
+
+import numpy as _np
+
+_CHUNK_SIZE = 64 * 1024 * 1024
+_GT = ord('>')
+_NL = ord('\n')
+_CR = ord('\r')
+_FOLD = 0x20  # ORed into a byte, maps upper case ASCII letters to lower
+_G, _C, _A, _T = [ord(b) for b in 'gcat']
+
+
+def _gc_at(c):
+    # counts of G+C and A+T bytes in either case
+    folded = c | _FOLD
+    gc = _np.count_nonzero(folded == _G) + _np.count_nonzero(folded == _C)
+    at = _np.count_nonzero(folded == _A) + _np.count_nonzero(folded == _T)
+    return int(gc), int(at)
+
+
+def _scan_chunk(c):
+    '''
+    Return the sequence lengths, and the G+C and A+T base counts, of a uint8
+    array holding whole records, the first starting at offset 0.
+    '''
+    gt = _np.flatnonzero(c == _GT)
+    prev = c[_np.maximum(gt - 1, 0)]
+    starts = gt[(gt == 0) | (prev == _NL)]
+    nl = _np.flatnonzero(c == _NL)
+    cr = _np.flatnonzero(c == _CR)
+
+    # a header runs from its '>' up to the next newline (or the chunk end)
+    hdr_nl = _np.searchsorted(nl, starts)
+    hdr_ends = _np.append(nl, len(c))[hdr_nl]
+    rec_ends = _np.append(starts[1:], len(c))
+
+    seq_bytes = _np.maximum(rec_ends - hdr_ends - 1, 0)
+    seq_nl = _np.maximum(_np.searchsorted(nl, rec_ends) - hdr_nl - 1, 0)
+    seq_cr = (_np.searchsorted(cr, rec_ends) -
+              _np.searchsorted(cr, hdr_ends))
+    lengths = (seq_bytes - seq_nl - seq_cr).astype(_np.uint32)
+
+    # base counts of the whole chunk, less those of the (short) header lines
+    hdr_lens = hdr_ends - starts
+    hdr_index = (_np.repeat(starts - (_np.cumsum(hdr_lens) - hdr_lens),
+                            hdr_lens) +
+                 _np.arange(hdr_lens.sum()))
+    gc, at = _gc_at(c)
+    hdr_gc, hdr_at = _gc_at(c[hdr_index])
+    return lengths, gc - hdr_gc, at - hdr_at
+
+
+def _nx(sorted_desc, cumulative, total, fraction):
+    # the length, and 1-based count, of the contig that takes the running
+    # total to fraction of all bases
+    i = int(_np.searchsorted(cumulative, total * fraction))
+    return int(sorted_desc[i]), i + 1
+
+
+def fasta_contig_stats(fasta_path, bins=10, chunk_size=_CHUNK_SIZE):
+    '''
+    Compute statistics of the contigs in fasta_path.  Returns a dict with:
+    count, total_bp, min, max, mean - of the contig lengths.
+    n50, l50, n90, l90 - Nx length and number of contigs needed to reach it.
+    gc_percent - G+C as a percentage of the A, C, G and T bases.
+    hist_counts, hist_edges - a bins-bin histogram of the contig lengths,
+        as numpy.histogram returns them.
+    '''
+    stats = {'count': 0, 'total_bp': 0, 'min': 0, 'max': 0, 'mean': 0.0,
+             'n50': 0, 'l50': 0, 'n90': 0, 'l90': 0, 'gc_percent': 0.0,
+             'hist_counts': [], 'hist_edges': []}
+    size = _os.path.getsize(fasta_path)
+    if size == 0:
+        return stats
+
+    length_chunks = []
+    gc = at = 0
+    with open(fasta_path, 'rb') as f:
+        mm = _mmap.mmap(f.fileno(), 0, access=_mmap.ACCESS_READ)
+        try:
+            # skip anything before the first record
+            start = 0
+            if mm[0:1] != b'>':
+                start = mm.find(b'\n>')
+                start = size if start < 0 else start + 1
+            while start < size:
+                end = min(size, start + chunk_size)
+                if end < size:
+                    nxt = mm.find(b'\n>', end - 1)
+                    end = size if nxt < 0 else nxt + 1
+                c = _np.frombuffer(mm, dtype=_np.uint8, count=end - start,
+                                   offset=start)
+                chunk_lengths, chunk_gc, chunk_at = _scan_chunk(c)
+                del c  # release the view before the map is closed
+                length_chunks.append(chunk_lengths)
+                gc += chunk_gc
+                at += chunk_at
+                start = end
+        finally:
+            mm.close()
+
+    if not length_chunks:
+        return stats
+    lengths = _np.concatenate(length_chunks)
+    if len(lengths) == 0:
+        return stats
+    total = int(lengths.sum(dtype=_np.int64))
+    sorted_desc = _np.sort(lengths)[::-1]
+    cumulative = _np.cumsum(sorted_desc, dtype=_np.int64)
+    hist_counts, hist_edges = _np.histogram(lengths, bins)
+
+    stats['count'] = len(lengths)
+    stats['total_bp'] = total
+    stats['min'] = int(sorted_desc[-1])
+    stats['max'] = int(sorted_desc[0])
+    stats['mean'] = total / float(len(lengths))
+    stats['n50'], stats['l50'] = _nx(sorted_desc, cumulative, total, 0.5)
+    stats['n90'], stats['l90'] = _nx(sorted_desc, cumulative, total, 0.9)
+    if gc + at:
+        stats['gc_percent'] = 100.0 * gc / (gc + at)
+    stats['hist_counts'] = hist_counts.tolist()
+    stats['hist_edges'] = hist_edges.tolist()
+    return stats
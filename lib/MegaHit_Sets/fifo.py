@@ -0,0 +1,104 @@
+'''
+Stream downloaded reads libraries into named pipes, so a combined input for
+the assembler never has to exist on disk.
+'''
+import errno as _errno
+import os as _os
+import shutil as _shutil
+import threading as _threading
+
+_BUF_SIZE = 1024 * 1024
+
+
+class FifoFeeder(object):
+    '''
+    Streams a sequence of libraries into named pipes.
+
+    fifo_paths - dict mapping a key of the files returned by get_files
+        (e.g. 'fwd', 'rev') to the path of the fifo to create for it.
+    get_files - function taking a library index and returning a dict of
+        that library's files, e.g. ReadsPrefetcher.get.
+    n_libraries - the number of libraries to stream.
+    remove - function removing a library's file once streamed.
+
+    One thread per fifo writes each library's file into its fifo in order
+    and removes the file once written, so only the libraries not yet
+    streamed take scratch space.  The reader must consume all the fifos
+    concurrently, as megahit does with paired -1/-2 inputs.
+    '''
+
+    def __init__(self, fifo_paths, get_files, n_libraries, remove=_os.remove):
+        self.fifo_paths = dict(fifo_paths)
+        self._remove = remove
+        self.bytes_written = dict((k, 0) for k in self.fifo_paths)
+        self._get_files = get_files
+        self._n = n_libraries
+        self._libraries = {}  # index -> [files, keys still to stream]
+        self._errors = []
+        self._lock = _threading.Lock()
+        self._threads = []
+        for key, path in self.fifo_paths.items():
+            _os.mkfifo(path)
+            t = _threading.Thread(target=self._feed, args=(key, path))
+            t.daemon = True
+            self._threads.append(t)
+
+    def start(self):
+        for t in self._threads:
+            t.start()
+        return self
+
+    def _library(self, index):
+        # the first thread to reach a library fetches it for all of them
+        with self._lock:
+            if index not in self._libraries:
+                self._libraries[index] = [self._get_files(index),
+                                          len(self.fifo_paths)]
+            entry = self._libraries[index]
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._libraries[index]
+            return entry[0]
+
+    def _feed(self, key, fifo_path):
+        try:
+            with open(fifo_path, 'wb') as out:  # blocks until a reader opens
+                for i in range(self._n):
+                    src_path = self._library(i)[key]
+                    try:
+                        with open(src_path, 'rb') as src:
+                            _shutil.copyfileobj(src, out, _BUF_SIZE)
+                        self.bytes_written[key] += _os.path.getsize(src_path)
+                    finally:
+                        self._remove(src_path)
+        except Exception as e:
+            with self._lock:
+                self._errors.append(e)
+
+    def close(self):
+        '''
+        Wait for the feeding threads and remove the fifos.  A thread still
+        waiting for a reader (e.g. because the reader failed to start) is
+        released, and fails with a broken pipe.  Call it once the reader has
+        exited, and after whatever get_files waits on can no longer block.
+        '''
+        for t, path in zip(self._threads, self.fifo_paths.values()):
+            while t.is_alive():
+                try:
+                    fd = _os.open(path, _os.O_RDONLY | _os.O_NONBLOCK)
+                    _os.close(fd)
+                except OSError as e:
+                    if e.errno != _errno.ENOENT:
+                        raise
+                t.join(1)
+        for path in self.fifo_paths.values():
+            if _os.path.exists(path):
+                _os.remove(path)
+
+    def check(self):
+        '''
+        Raise the first error any feeding thread hit.  If this raises, the
+        reader saw an incomplete stream.
+        '''
+        if self._errors:
+            raise self._errors[0]
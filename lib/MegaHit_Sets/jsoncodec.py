@@ -0,0 +1,74 @@
+'''
+JSON encoding and decoding through a chosen library.
+
+The standard library is used unless the KB_JSON_CODEC environment variable
+names another backend: simplejson, orjson or rapidjson. These are faster,
+but differ from the standard library: simplejson is set up to write what it
+writes, though on Python 2 it still reads ASCII strings as str rather than
+unicode, while orjson writes NaN as null and fails on integers beyond 64
+bits, and rapidjson writes a None key as "None". Each codec keeps one
+encoder for all its calls rather than building one per document.
+'''
+import json as _json
+import os as _os
+
+_DEFAULT_BACKEND = 'json'
+
+
+def _orjson(default):
+    import orjson
+
+    def dumps(obj):
+        # non-string keys written as strings, as the standard library does
+        return orjson.dumps(obj, default=default,
+                            option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+    return orjson.loads, dumps
+
+
+def _rapidjson(default):
+    import rapidjson
+
+    def dumps(obj):
+        # non-string keys written as strings, like the standard library
+        return rapidjson.dumps(
+            obj, default=default,
+            mapping_mode=rapidjson.MM_COERCE_KEYS_TO_STRINGS)
+    return rapidjson.loads, dumps
+
+
+def _simplejson(default):
+    import simplejson
+    # simplejson's own defaults write namedtuples as objects and Decimals as
+    # numbers, where the standard library writes a list and calls default
+    encoder = simplejson.JSONEncoder(
+        default=default, namedtuple_as_object=False, use_decimal=False,
+        for_json=False)
+    return simplejson.loads, encoder.encode
+
+
+def _stdlib(default):
+    return _json.loads, _json.JSONEncoder(default=default).encode
+
+
+_FACTORIES = {'orjson': _orjson, 'rapidjson': _rapidjson,
+              'simplejson': _simplejson, 'json': _stdlib}
+
+
+class JSONCodec(object):
+    '''
+    loads(string) and dumps(obj) through one JSON library.
+
+    default - called with any object the library can't serialize, returning
+        a serializable version of it or raising TypeError, as for
+        json.JSONEncoder.default.
+    backend - one of 'orjson', 'rapidjson', 'simplejson' or 'json'. By
+        default KB_JSON_CODEC, or else json.
+    '''
+
+    def __init__(self, default=None, backend=None):
+        backend = (backend or _os.environ.get('KB_JSON_CODEC') or
+                   _DEFAULT_BACKEND)
+        if backend not in _FACTORIES:
+            raise ValueError('Unknown JSON codec: ' + backend)
+        self.loads, self.dumps = _FACTORIES[backend](default)
+        self.name = backend
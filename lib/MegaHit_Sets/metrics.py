@@ -0,0 +1,243 @@
+'''
+A small in-process metrics registry, rendered in the Prometheus text
+exposition format.
+
+Counters, gauges and histograms are created through a Registry (normally
+the process-wide REGISTRY), optionally with label names, and updated from
+any thread. The values are per process: with several uwsgi processes each
+one reports its own.
+'''
+import bisect as _bisect
+import threading as _threading
+import time as _time
+from contextlib import contextmanager as _contextmanager
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# seconds, from a quick call up to a long assembly
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   30, 60, 300, 1800, 3600, 4 * 3600, 12 * 3600)
+
+
+def _escape(value):
+    return (str(value).replace('\\', '\\\\').replace('\n', '\\n')
+            .replace('"', '\\"'))
+
+
+def _labels_text(pairs):
+    if not pairs:
+        return ''
+    return '{' + ','.join(name + '="' + _escape(value) + '"'
+                          for name, value in pairs) + '}'
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class _Value(object):
+
+    def __init__(self):
+        self._lock = _threading.Lock()
+        self.value = 0.0
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def set(self, value):
+        with self._lock:
+            self.value = float(value)
+
+    @_contextmanager
+    def track_inprogress(self):
+        '''
+        Count the time spent in a with block as one in progress.
+        '''
+        self.inc()
+        try:
+            yield
+        finally:
+            self.dec()
+
+    def samples(self, name):
+        return [(name, (), self.value)]
+
+
+class _HistogramValue(object):
+
+    def __init__(self, buckets):
+        self._lock = _threading.Lock()
+        self._buckets = buckets
+        self._counts = [0] * len(buckets)
+        self._sum = 0.0
+        self._count = 0
+
+    def observe(self, value):
+        i = _bisect.bisect_left(self._buckets, value)
+        with self._lock:
+            if i < len(self._counts):
+                self._counts[i] += 1
+            self._sum += value
+            self._count += 1
+
+    @_contextmanager
+    def time(self):
+        '''
+        Observe the seconds spent in a with block.
+        '''
+        start = _time.time()
+        try:
+            yield
+        finally:
+            self.observe(_time.time() - start)
+
+    def samples(self, name):
+        with self._lock:
+            counts = list(self._counts)
+            total, count = self._sum, self._count
+        samples = []
+        cumulative = 0
+        for bound, n in zip(self._buckets, counts):
+            cumulative += n
+            samples.append((name + '_bucket', (('le', _number(bound)),),
+                            cumulative))
+        samples.append((name + '_bucket', (('le', '+Inf'),), count))
+        samples.append((name + '_sum', (), total))
+        samples.append((name + '_count', (), count))
+        return samples
+
+
+class _Metric(object):
+    '''
+    A named metric, holding one value for each combination of label values.
+    Without label names it has a single value, and the methods of that
+    value can be called on the metric directly.
+    '''
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = _threading.Lock()
+        self._children = {}
+        if not self.labelnames:
+            self.labels()  # reported from the start, as zero
+
+    def _new_value(self):
+        return _Value()
+
+    def labels(self, *values):
+        values = tuple(str(v) for v in values)
+        if len(values) != len(self.labelnames):
+            raise ValueError('{} takes labels {}'.format(self.name,
+                                                         self.labelnames))
+        with self._lock:
+            child = self._children.get(values)
+            if child is None:
+                child = self._children[values] = self._new_value()
+        return child
+
+    def __getattr__(self, attr):
+        # e.g. metric.inc() for a metric without labels
+        if attr.startswith('_') or self.labelnames:
+            raise AttributeError(attr)
+        return getattr(self.labels(), attr)
+
+    def render(self, lines):
+        lines.append('# HELP ' + self.name + ' ' + self.documentation)
+        lines.append('# TYPE ' + self.name + ' ' + self.kind)
+        with self._lock:
+            children = sorted(self._children.items())
+        for values, child in children:
+            pairs = tuple(zip(self.labelnames, values))
+            for name, extra, value in child.samples(self.name):
+                lines.append(name + _labels_text(pairs + extra) + ' ' +
+                             _number(value))
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(),
+                 buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super(Histogram, self).__init__(name, documentation, labelnames)
+
+    def _new_value(self):
+        return _HistogramValue(self.buckets)
+
+
+class _FunctionGauge(_Metric):
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, function):
+        super(_FunctionGauge, self).__init__(name, documentation)
+        self._function = function
+
+    def render(self, lines):
+        lines.append('# HELP ' + self.name + ' ' + self.documentation)
+        lines.append('# TYPE ' + self.name + ' ' + self.kind)
+        lines.append(self.name + ' ' + _number(self._function()))
+
+
+class Registry(object):
+    '''
+    The metrics of a process, by name.
+    '''
+
+    def __init__(self):
+        self._lock = _threading.Lock()
+        self._metrics = {}
+
+    def get_or_register(self, metric):
+        '''
+        Register metric, or return the one already registered by its name.
+        '''
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.get_or_register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self.get_or_register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(),
+                  buckets=DEFAULT_BUCKETS):
+        return self.get_or_register(Histogram(name, documentation, labelnames,
+                                              buckets))
+
+    def gauge_function(self, name, documentation, function):
+        '''
+        A gauge whose value is function(), called whenever it is rendered.
+        '''
+        with self._lock:
+            metric = self._metrics[name] = _FunctionGauge(
+                name, documentation, function)
+        return metric
+
+    def render(self):
+        with self._lock:
+            metrics = [self._metrics[name] for name in sorted(self._metrics)]
+        lines = []
+        for metric in metrics:
+            metric.render(lines)
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
@@ -0,0 +1,142 @@
+'''
+Download-ahead stage for assembling the libraries of a ReadsSet.
+
+Background threads download the libraries in order while the assembler
+(or the concatenation of a combined input) works on earlier ones.  How far
+they run ahead is bounded both by a fixed depth and by the free space left
+on the scratch volume.
+'''
+import os as _os
+import threading as _threading
+
+
+class ReadsPrefetcher(object):
+    '''
+    Downloads reads libraries ahead of their consumers.
+
+    download - function taking a reads ref and returning a dict whose values
+        are the paths of the downloaded files.
+    reads_refs - the refs to download, in the order they will be consumed.
+    scratch - the directory the files land in, used to check free space.
+    depth - the maximum number of libraries downloading or downloaded and
+        waiting to be taken.
+    reserve_bytes - free space to always leave on the scratch volume.
+    width - the number of downloads to run at once.
+    remove - function removing a downloaded file nobody took.
+
+    A library is only downloaded ahead of demand if the scratch volume has
+    room for it and every download in flight to be as large as the largest
+    library seen so far, plus reserve_bytes.  A library a consumer is
+    already waiting for is always downloaded.
+    '''
+
+    _POLL_SEC = 10
+
+    def __init__(self, download, reads_refs, scratch, depth=1,
+                 reserve_bytes=0, width=1, remove=_os.remove):
+        self._download = download
+        self._remove_file = remove
+        self._refs = list(reads_refs)
+        self._scratch = scratch
+        self._depth = max(0, int(depth))
+        self._reserve = reserve_bytes
+        self._results = {}  # index -> (files, exception)
+        self._next = 0      # index of the next library to download
+        self._inflight = 0  # downloads running
+        self._ready = 0     # downloaded but not yet taken
+        self._waiting = 0   # consumers blocked in get()
+        self._largest = 0
+        self._closed = False
+        self._cond = _threading.Condition()
+        self._threads = []
+        for _ in range(max(1, int(width))):
+            t = _threading.Thread(target=self._run)
+            t.daemon = True
+            self._threads.append(t)
+
+    def start(self):
+        for t in self._threads:
+            t.start()
+        return self
+
+    def _free_bytes(self):
+        st = _os.statvfs(self._scratch)
+        return st.f_bavail * st.f_frsize
+
+    def _may_download(self):
+        pending = self._ready + self._inflight
+        if self._waiting > pending:
+            return True
+        if pending >= self._depth:
+            return False
+        return (self._free_bytes() >=
+                self._largest * (self._inflight + 1) + self._reserve)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while (not self._closed and self._next < len(self._refs) and
+                       not self._may_download()):
+                    self._cond.wait(self._POLL_SEC)
+                if self._closed or self._next >= len(self._refs):
+                    return
+                i = self._next
+                self._next += 1
+                self._inflight += 1
+            files, err = None, None
+            try:
+                files = self._download(self._refs[i])
+            except Exception as e:
+                err = e
+            size = 0
+            if files:
+                size = sum(_os.path.getsize(p) for p in files.values())
+            with self._cond:
+                self._inflight -= 1
+                if self._closed:
+                    self._remove(files)
+                    return
+                self._results[i] = (files, err)
+                self._ready += 1
+                self._largest = max(self._largest, size)
+                self._cond.notify_all()
+
+    def get(self, index):
+        '''
+        Wait for the library at position index of reads_refs and return the
+        result of download() for it.  Re-raises any download error.  Each
+        index may only be taken once.
+        '''
+        with self._cond:
+            self._waiting += 1
+            self._cond.notify_all()
+            try:
+                while index not in self._results:
+                    if self._closed:
+                        raise ValueError('Prefetcher was closed')
+                    self._cond.wait(self._POLL_SEC)
+            finally:
+                self._waiting -= 1
+            files, err = self._results.pop(index)
+            self._ready -= 1
+            self._cond.notify_all()
+        if err:
+            raise err
+        return files
+
+    def close(self):
+        '''
+        Stop downloading and remove any downloaded files nobody took.  A
+        download still in flight removes its own files when it completes.
+        '''
+        with self._cond:
+            self._closed = True
+            for files, _ in self._results.values():
+                self._remove(files)
+            self._results = {}
+            self._cond.notify_all()
+
+    def _remove(self, files):
+        for path in (files or {}).values():
+            if _os.path.exists(path):
+                self._remove_file(path)
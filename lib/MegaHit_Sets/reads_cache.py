@@ -0,0 +1,221 @@
+'''
+A scratch-resident cache of downloaded reads libraries, so that assembling
+the same library again (e.g. with another preset) needs no new download.
+
+Libraries are kept by versioned ref and form (e.g. gzipped), one directory
+each, written to a temporary directory with the list of its files and
+renamed into place, and only handed out while all those files are there
+(not while another process is evicting it, say).  A file
+handed out by the cache is held with a shared flock on it until it is
+released, which is what counts its users across threads and processes
+alike.  Once the cache is over its byte budget, the least recently used
+libraries that nobody holds are evicted.  With a budget of 0 nothing is
+kept, and releasing a file removes it.
+'''
+import errno as _errno
+import fcntl as _fcntl
+import hashlib as _hashlib
+import os as _os
+import shutil as _shutil
+import threading as _threading
+import uuid as _uuid
+
+_SEP = '~'  # between the files key (e.g. fwd) and name in a library dir
+_KEYS = '.keys'  # in a library dir, the files keys it was cached with
+
+
+def _link(path, link_path):
+    # a hard link where possible, else a copy (e.g. across filesystems)
+    try:
+        _os.link(path, link_path)
+    except OSError:
+        _shutil.copyfile(path, link_path)
+
+
+class ReadsCache(object):
+    '''
+    Downloaded reads libraries in cache_dir, up to max_bytes in all.
+    '''
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = _threading.Lock()
+        self._ref_locks = {}  # ref -> Lock, so a library is downloaded once
+        self._held = {}  # path -> [open locked files]
+        if max_bytes > 0 and not _os.path.exists(cache_dir):
+            _os.makedirs(cache_dir)
+
+    def _entry(self, ref, form):
+        key = ref + (_SEP + form if form else '')
+        return _os.path.join(self.cache_dir,
+                             _hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def fetch(self, ref, download, form=''):
+        '''
+        The files of the library at versioned ref, as a dict like the one
+        download(ref) returns, which is called on a miss.  form names how
+        download() stores the files (e.g. 'gzip'), which is cached apart
+        from other forms of the library.  Hand each file back with
+        release() once done with it.
+        '''
+        if self.max_bytes <= 0:
+            return download(ref)
+
+        with self._lock:
+            ref_lock = self._ref_locks.setdefault((ref, form),
+                                                  _threading.Lock())
+        with ref_lock:
+            entry = self._entry(ref, form)
+            files = self._checkout(entry)
+            if files is not None:
+                with self._lock:
+                    self.hits += 1
+                return files
+
+            files = download(ref)
+            with self._lock:
+                self.misses += 1
+            if (sum(_os.path.getsize(p) for p in files.values()) >
+                    self.max_bytes):
+                return files  # would never fit, so not cached
+            cached = self._add(entry, files)
+        self.evict()
+        return cached if cached is not None else files
+
+    def _hold(self, path):
+        # a shared lock on the file, or None if it's gone or being evicted
+        try:
+            f = open(path, 'rb')
+        except IOError as e:
+            if e.errno == _errno.ENOENT:
+                return None
+            raise
+        try:
+            _fcntl.flock(f, _fcntl.LOCK_SH | _fcntl.LOCK_NB)
+            if _os.fstat(f.fileno()).st_ino == _os.stat(path).st_ino:
+                return f
+        except (IOError, OSError):
+            pass
+        f.close()
+        return None
+
+    def _checkout(self, entry):
+        # the held files of entry, or None unless it has all it was cached
+        # with
+        try:
+            with open(_os.path.join(entry, _KEYS)) as f:
+                keys = set(f.read().split())
+            names = _os.listdir(entry)
+        except (IOError, OSError):
+            return None
+        files, held = {}, []
+        for name in names:
+            if name == _KEYS:
+                continue
+            path = _os.path.join(entry, name)
+            f = self._hold(path)
+            if f is None:
+                break
+            held.append((f, path))
+            files[name.split(_SEP, 1)[0]] = path
+        if set(files) != keys:
+            for f, path in held:
+                f.close()
+            return None
+        with self._lock:
+            for f, path in held:
+                self._held.setdefault(path, []).append(f)
+        try:
+            _os.utime(entry, None)  # now the most recently used
+        except OSError:
+            pass
+        return files
+
+    def _add(self, entry, files):
+        # the held files of entry once files are cached there, or None with
+        # files left as they are if that fails
+        tmp = _os.path.join(self.cache_dir, '.tmp.' + _uuid.uuid4().hex)
+        _os.makedirs(tmp)
+        try:
+            for key, path in files.items():
+                _link(path, _os.path.join(
+                    tmp, key + _SEP + _os.path.basename(path)))
+            with open(_os.path.join(tmp, _KEYS), 'w') as f:
+                f.write('\n'.join(sorted(files)) + '\n')
+            try:
+                _os.rename(tmp, entry)
+            except OSError as e:
+                # another process cached it first, or is evicting it
+                if e.errno not in (_errno.EEXIST, _errno.ENOTEMPTY):
+                    raise
+        finally:
+            if _os.path.exists(tmp):
+                _shutil.rmtree(tmp)
+        cached = self._checkout(entry)
+        if cached is not None:
+            for path in files.values():
+                _os.remove(path)  # the cached copies are used instead
+        return cached
+
+    def release(self, path):
+        '''
+        Done with a file from fetch(): it stays cached for the next user,
+        or is removed if it was never cached.
+        '''
+        with self._lock:
+            held = self._held.get(path)
+            f = held.pop() if held else None
+            if held == []:
+                del self._held[path]
+        if f is not None:
+            f.close()
+        elif _os.path.exists(path):
+            _os.remove(path)
+
+    def evict(self):
+        '''
+        Remove the least recently used libraries nobody holds until the
+        cache fits in max_bytes.
+        '''
+        with self._lock:
+            entries = []
+            total = 0
+            for name in _os.listdir(self.cache_dir):
+                if name.startswith('.tmp.'):
+                    continue
+                entry = _os.path.join(self.cache_dir, name)
+                try:
+                    paths = [_os.path.join(entry, f)
+                             for f in _os.listdir(entry)]
+                    size = sum(_os.path.getsize(p) for p in paths)
+                    entries.append((_os.path.getmtime(entry), size, entry,
+                                    paths))
+                except OSError:
+                    continue  # evicted by another process meanwhile
+                total += size
+            for _, size, entry, paths in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                if self._remove_unheld(entry, paths):
+                    total -= size
+
+    def _remove_unheld(self, entry, paths):
+        locked = []
+        try:
+            for path in paths:
+                f = open(path, 'rb')
+                locked.append(f)
+                _fcntl.flock(f, _fcntl.LOCK_EX | _fcntl.LOCK_NB)
+        except (IOError, OSError):
+            return False  # in use, here or by another process
+        else:
+            for path in paths:
+                _os.remove(path)
+            _shutil.rmtree(entry, ignore_errors=True)
+            return True
+        finally:
+            for f in locked:
+                f.close()
@@ -0,0 +1,110 @@
+'''
+Report generation for MEGAHIT runs.
+
+Statistics are computed once per assembly when it is added, and the text
+and HTML forms of the report are rendered from them by joining lists of
+parts rather than growing a string.
+'''
+try:
+    from html import escape as _escape  # py3
+except ImportError:
+    from cgi import escape as _escape  # py2
+
+from MegaHit_Sets.contig_stats import fasta_contig_stats
+
+_RULE = '-------------------------------------------------------------\n'
+
+_COLUMNS = [('Reads', None), ('Assembly', None), ('Contigs', 'count'),
+            ('Total bp', 'total_bp'), ('Max bp', 'max'), ('N50', 'n50'),
+            ('L50', 'l50'), ('N90', 'n90'), ('GC %', 'gc_percent')]
+
+
+class AssemblyReport(object):
+    '''
+    Collects the statistics of each assembly of a run and renders them.
+
+    workspace_name - the workspace the assemblies were saved to.
+    bins - the number of bins in each contig length histogram.
+    '''
+
+    def __init__(self, workspace_name, bins=10):
+        self.workspace_name = workspace_name
+        self.bins = bins
+        self.entries = []
+
+    def add(self, reads_name, assembly_name, contigs_path, stats=None):
+        '''
+        Compute the statistics of the contigs in contigs_path, assembled
+        from reads_name and saved as assembly_name, and return them.
+        stats - statistics computed earlier for the same contigs (with the
+            same number of bins), to use instead.
+        '''
+        if stats is None or len(stats.get('hist_counts', [])) != self.bins:
+            stats = fasta_contig_stats(contigs_path, bins=self.bins)
+        self.entries.append({'reads_name': reads_name,
+                             'assembly_name': assembly_name,
+                             'stats': stats})
+        return stats
+
+    def text(self):
+        parts = []
+        for entry in self.entries:
+            stats = entry['stats']
+            parts.append('MegaHit_Sets run for Read Library: ' +
+                         entry['reads_name'] + '\n')
+            parts.append(_RULE)
+            parts.append('\n')
+            parts.append('ContigSet saved to: ' + self.workspace_name + '/' +
+                         entry['assembly_name'] + '\n')
+            parts.append('Assembled into ' + str(stats['count']) +
+                         ' contigs.\n')
+            if stats['count'] == 0:
+                parts.append('\n')
+                continue
+            parts.append('Avg Length: ' + str(stats['mean']) + ' bp.\n')
+            parts.append('Total Length: ' + str(stats['total_bp']) +
+                         ' bp, Max Length: ' + str(stats['max']) + ' bp.\n')
+            parts.append('N50: ' + str(stats['n50']) + ' bp (L50: ' +
+                         str(stats['l50']) + ' contigs), N90: ' +
+                         str(stats['n90']) + ' bp.\n')
+            parts.append('GC: ' + ('%.2f' % stats['gc_percent']) + '%\n')
+
+            counts = stats['hist_counts']
+            edges = stats['hist_edges']
+            parts.append('Contig Length Distribution ' +
+                         '(# of contigs -- min to max basepairs):\n')
+            for c in range(len(counts)):
+                parts.append('   ' + str(counts[c]) + '\t--\t' +
+                             str(edges[c]) + ' to ' + str(edges[c + 1]) +
+                             ' bp\n')
+            parts.append('\n')
+        return ''.join(parts)
+
+    def html(self):
+        '''
+        An HTML page with one summary table row per assembly.
+        '''
+        parts = ['<html><head><title>MEGAHIT assembly summary</title>',
+                 '<style>table {border-collapse: collapse} ',
+                 'th, td {border: 1px solid #ccc; padding: 2px 8px; ',
+                 'text-align: right} ',
+                 'th:nth-child(-n+2), td:nth-child(-n+2) {text-align: left}',
+                 '</style></head><body>',
+                 '<h3>MEGAHIT assembly summary</h3>\n<table>\n<tr>']
+        for title, _ in _COLUMNS:
+            parts.append('<th>' + title + '</th>')
+        parts.append('</tr>\n')
+        for entry in self.entries:
+            stats = entry['stats']
+            parts.append('<tr><td>' + _escape(entry['reads_name']) +
+                         '</td><td>' + _escape(self.workspace_name + '/' +
+                                               entry['assembly_name']) +
+                         '</td>')
+            for _, key in _COLUMNS[2:]:
+                value = stats[key]
+                if key == 'gc_percent':
+                    value = '%.2f' % value
+                parts.append('<td>' + str(value) + '</td>')
+            parts.append('</tr>\n')
+        parts.append('</table></body></html>\n')
+        return ''.join(parts)
@@ -0,0 +1,167 @@
+'''
+The CPUs and memory this process can actually use.
+
+Inside a container these are usually less than the node has, while
+multiprocessing.cpu_count() and /proc/meminfo (which MEGAHIT itself reads)
+see the whole node. The CPUs are limited by the CPU affinity mask (cpusets)
+and by a cgroup v1 or v2 CPU quota, and the memory by a cgroup v1 or v2
+memory limit. A limit set on any ancestor cgroup applies as well.
+'''
+import math as _math
+import multiprocessing as _multiprocessing
+import os as _os
+
+PROC_SELF = '/proc/self'
+CGROUP_ROOT = '/sys/fs/cgroup'
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return None
+
+
+def _count_cpu_list(text):
+    # e.g. '0-3,8,10-11'
+    count = 0
+    for part in text.split(','):
+        if '-' in part:
+            first, last = part.split('-')
+            count += int(last) - int(first) + 1
+        elif part:
+            count += 1
+    return count
+
+
+def affinity_cpus(proc_self=PROC_SELF):
+    '''
+    The number of CPUs this process may be scheduled on, or None if unknown.
+    '''
+    if proc_self == PROC_SELF and hasattr(_os, 'sched_getaffinity'):
+        return len(_os.sched_getaffinity(0))
+    status = _read(_os.path.join(proc_self, 'status')) or ''
+    for line in status.splitlines():
+        if line.startswith('Cpus_allowed_list:'):
+            return _count_cpu_list(line.split(':', 1)[1].strip())
+    return None
+
+
+def _cgroup_dirs(controller, proc_self, cgroup_root):
+    '''
+    The directory of this process's cgroup and those of its ancestors,
+    innermost first, for a cgroup v1 controller or for cgroup v2 (None).
+    '''
+    cgroups = _read(_os.path.join(proc_self, 'cgroup')) or ''
+    for line in cgroups.splitlines():
+        fields = line.split(':', 2)
+        if len(fields) != 3:
+            continue
+        controllers, path = fields[1], fields[2]
+        if controller is None:
+            if controllers:  # cgroup v2 is the '0::/path' line
+                continue
+            mounts = [cgroup_root]
+        else:
+            if controller not in controllers.split(','):
+                continue
+            mounts = [_os.path.join(cgroup_root, controllers),
+                      _os.path.join(cgroup_root, controller)]
+        for mount in mounts:
+            if not _os.path.isdir(mount):
+                continue
+            # in a cgroup namespace the path is not under the mount, which
+            # is then the process's own cgroup already
+            dirs = []
+            parts = [part for part in path.split('/') if part]
+            while parts:
+                path_dir = _os.path.join(mount, *parts)
+                if _os.path.isdir(path_dir):
+                    dirs.append(path_dir)
+                parts.pop()
+            dirs.append(mount)
+            return dirs
+    return []
+
+
+def cgroup_cpus(proc_self=PROC_SELF, cgroup_root=CGROUP_ROOT):
+    '''
+    The cgroup CPU quota as a whole number of CPUs (rounded up), or None
+    without one.
+    '''
+    quotas = []
+    for cgroup_dir in _cgroup_dirs(None, proc_self, cgroup_root):
+        # '<quota> <period>', or 'max <period>' without a quota
+        text = _read(_os.path.join(cgroup_dir, 'cpu.max'))
+        if text and not text.startswith('max'):
+            fields = text.split()
+            period = float(fields[1]) if len(fields) > 1 else 100000.0
+            quotas.append(float(fields[0]) / period)
+    for cgroup_dir in _cgroup_dirs('cpu', proc_self, cgroup_root):
+        quota = _read(_os.path.join(cgroup_dir, 'cpu.cfs_quota_us'))
+        period = _read(_os.path.join(cgroup_dir, 'cpu.cfs_period_us'))
+        if quota and period and int(quota) > 0:  # -1 is no quota
+            quotas.append(float(quota) / float(period))
+    if not quotas:
+        return None
+    return max(1, int(_math.ceil(min(quotas))))
+
+
+def physical_memory():
+    '''
+    The node's memory in bytes, or None if unknown.
+    '''
+    try:
+        return _os.sysconf('SC_PAGE_SIZE') * _os.sysconf('SC_PHYS_PAGES')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def cgroup_memory(proc_self=PROC_SELF, cgroup_root=CGROUP_ROOT):
+    '''
+    The cgroup memory limit in bytes, or None without one.
+    '''
+    limits = []
+    for cgroup_dir in _cgroup_dirs(None, proc_self, cgroup_root):
+        text = _read(_os.path.join(cgroup_dir, 'memory.max'))
+        if text and text != 'max':
+            limits.append(int(text))
+    for cgroup_dir in _cgroup_dirs('memory', proc_self, cgroup_root):
+        # without a limit this is a huge number, which the node's memory caps
+        text = _read(_os.path.join(cgroup_dir, 'memory.limit_in_bytes'))
+        if text:
+            limits.append(int(text))
+    return min(limits) if limits else None
+
+
+class AvailableResources(object):
+    '''
+    The CPUs and bytes of memory available to this process: the least of
+    what the node has and any affinity or cgroup limits.  cpus_limited_by
+    and memory_limited_by say which of these set them.
+    '''
+
+    def __init__(self, proc_self=PROC_SELF, cgroup_root=CGROUP_ROOT):
+        cpus = [(n, source) for source, n in
+                [('node', _multiprocessing.cpu_count()),
+                 ('affinity', affinity_cpus(proc_self)),
+                 ('cgroup', cgroup_cpus(proc_self, cgroup_root))] if n]
+        self.cpus, self.cpus_limited_by = min(cpus, key=lambda c: c[0])
+
+        memory = [(n, source) for source, n in
+                  [('node', physical_memory()),
+                   ('cgroup', cgroup_memory(proc_self, cgroup_root))] if n]
+        self.memory_bytes, self.memory_limited_by = None, None
+        if memory:
+            self.memory_bytes, self.memory_limited_by = min(
+                memory, key=lambda m: m[0])
+
+    def summary(self):
+        memory = 'unknown memory'
+        if self.memory_bytes:
+            memory = ('%.1f GiB of memory (%s)' %
+                      (self.memory_bytes / float(1 << 30),
+                       self.memory_limited_by))
+        return '%d CPUs (%s) and %s' % (self.cpus, self.cpus_limited_by,
+                                        memory)
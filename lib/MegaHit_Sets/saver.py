@@ -0,0 +1,55 @@
+'''
+Save assemblies in the background as soon as each one is produced.
+'''
+import threading as _threading
+from multiprocessing.pool import ThreadPool as _ThreadPool
+
+
+class AssemblySaver(object):
+    '''
+    Runs save(index, contigs_path) on a pool of max_uploads threads for
+    each submitted assembly, so uploads overlap with the assembly of later
+    libraries.  Results are handed back in index order.  submit() may be
+    called from several threads at once.
+    '''
+
+    def __init__(self, save, max_uploads=2):
+        self._save = save
+        self._max_uploads = max(1, int(max_uploads))
+        self._pool = None  # started by the first submit
+        self._results = {}  # index -> AsyncResult
+        self._lock = _threading.Lock()
+
+    def submit(self, index, contigs_path):
+        with self._lock:
+            if self._pool is None:
+                self._pool = _ThreadPool(self._max_uploads)
+            self._results[index] = self._pool.apply_async(
+                self._save, (index, contigs_path))
+
+    def close(self):
+        '''
+        Wait for every submitted save to finish.
+        '''
+        with self._lock:
+            pool = self._pool
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    def saved(self):
+        '''
+        The results of the saves that succeeded, by index.  Waits for
+        pending saves first.
+        '''
+        self.close()
+        return dict((i, r.get()) for i, r in self._results.items()
+                    if r.successful())
+
+    def results(self, n):
+        '''
+        Wait for all saves and return the results for indexes 0 to n-1 in
+        order.  Raises the error of the first save that failed.
+        '''
+        self.close()
+        return [self._results[i].get() for i in range(n)]
@@ -0,0 +1,180 @@
+'''
+Timing spans for the stages of a run.
+
+A SpanRecorder collects one record per span: its wall time, CPU time and
+the bytes it processed. Spans are opened as a with block (span()) or by
+wrapping a function (timed()), from any thread, and are rendered at the
+end as a text table and logged as they finish as one JSON object per line.
+
+CPU time is that of the thread running the span where the platform can
+measure it (otherwise of the whole process), plus the CPU time of any
+subprocesses waited for while it ran, such as MEGAHIT itself. Spans that
+overlap in time can therefore both count the same subprocess.
+'''
+import functools as _functools
+import json as _json
+import os as _os
+import threading as _threading
+import time as _time
+
+try:
+    import resource as _resource
+except ImportError:  # not on windows
+    _resource = None
+
+_thread_time = getattr(_time, 'thread_time', None)  # py3.7+
+_RUSAGE_THREAD = getattr(_resource, 'RUSAGE_THREAD', None)
+
+
+def _own_cpu_seconds():
+    if _thread_time is not None:
+        return _thread_time()
+    if _RUSAGE_THREAD is not None:
+        usage = _resource.getrusage(_RUSAGE_THREAD)
+        return usage.ru_utime + usage.ru_stime
+    times = _os.times()
+    return times[0] + times[1]
+
+
+def _children_cpu_seconds():
+    times = _os.times()
+    return times[2] + times[3]
+
+
+def _rate(nbytes, seconds):
+    if not nbytes or seconds <= 0:
+        return ''
+    return '%.1f MB/s' % (nbytes / seconds / 1e6)
+
+
+class Span(object):
+    '''
+    One timed stage. attrs describe what it worked on (e.g. the reads ref).
+    '''
+
+    def __init__(self, name, attrs):
+        self.name = name
+        self.attrs = attrs
+        self.bytes = 0
+        self.wall_seconds = None
+        self.cpu_seconds = None
+        self.error = None
+
+    def add_bytes(self, nbytes):
+        self.bytes += nbytes
+
+    def set(self, key, value):
+        self.attrs[key] = value
+
+    def _start(self):
+        self.start = _time.time()
+        self._cpu_start = _own_cpu_seconds()
+        self._children_start = _children_cpu_seconds()
+        self.thread = _threading.current_thread().name
+
+    def _finish(self, error):
+        self.wall_seconds = _time.time() - self.start
+        self.cpu_seconds = (_own_cpu_seconds() - self._cpu_start +
+                            _children_cpu_seconds() - self._children_start)
+        if error is not None:
+            self.error = type(error).__name__
+
+    def record(self):
+        record = {'span': self.name,
+                  'start': round(self.start, 3),
+                  'wall_s': round(self.wall_seconds, 3),
+                  'cpu_s': round(self.cpu_seconds, 3),
+                  'bytes': self.bytes,
+                  'thread': self.thread}
+        if self.attrs:
+            record['attrs'] = self.attrs
+        if self.error:
+            record['error'] = self.error
+        return record
+
+
+class _SpanContext(object):
+
+    def __init__(self, recorder, span):
+        self._recorder = recorder
+        self._span = span
+
+    def __enter__(self):
+        self._span._start()
+        return self._span
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self._span._finish(exc_value if exc_type is not None else None)
+        self._recorder._add(self._span)
+        return False
+
+
+class SpanRecorder(object):
+    '''
+    Collects the spans of one run.
+
+    log - called with the JSON line of each span as it finishes.
+    '''
+
+    def __init__(self, log=None):
+        self._log = log
+        self._lock = _threading.Lock()
+        self.spans = []
+
+    def span(self, name, **attrs):
+        '''
+        A with block timed as a span, e.g.
+
+            with spans.span('download', reads_ref=ref) as span:
+                ...
+                span.add_bytes(size)
+        '''
+        return _SpanContext(self, Span(name, attrs))
+
+    def timed(self, name, bytes_of=None, **attrs):
+        '''
+        A decorator timing each call of a function as a span.  bytes_of,
+        if given, is called with the function's result to get the bytes it
+        processed.
+        '''
+        def decorator(function):
+            @_functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.span(name, **dict(attrs)) as span:
+                    result = function(*args, **kwargs)
+                    if bytes_of is not None:
+                        span.add_bytes(bytes_of(result))
+                    return result
+            return wrapper
+        return decorator
+
+    def _add(self, span):
+        with self._lock:
+            self.spans.append(span)
+        if self._log is not None:
+            self._log(self.json(span))
+
+    def json(self, span):
+        return _json.dumps(span.record(), sort_keys=True)
+
+    def text(self):
+        '''
+        A table of the spans in the order they started.
+        '''
+        with self._lock:
+            spans = sorted(self.spans, key=lambda s: s.start)
+        if not spans:
+            return ''
+        parts = ['Timing (wall and CPU seconds, bytes processed):\n']
+        for span in spans:
+            described = ' '.join(key + '=' + str(span.attrs[key])
+                                 for key in sorted(span.attrs))
+            if span.error:
+                described += ' FAILED: ' + span.error
+            line = ('   %-12s %9.1f s %9.1f s cpu %14d bytes %12s  %s' %
+                    (span.name, span.wall_seconds, span.cpu_seconds,
+                     span.bytes, _rate(span.bytes, span.wall_seconds),
+                     described))
+            parts.append(line.rstrip() + '\n')
+        parts.append('\n')
+        return ''.join(parts)
@@ -1,7 +1,10 @@
 ############################################################
 #
-# Autogenerated by the KBase type compiler -
-# any changes made here will be overwritten
+# Generated by the KBase type compiler, then changed by hand
+# (pooled sessions and retries, the Service Wizard url cache,
+# batches, job futures): make compile leaves this file as it
+# is, and make baseclients copies the MegaHit_Sets one over
+# those kb-sdk install writes for the dependencies
 #
 ############################################################
 
@@ -11,6 +14,7 @@ import json as _json
 import requests as _requests
 import random as _random
 import os as _os
+import threading as _threading
 
 try:
     from configparser import ConfigParser as _ConfigParser  # py 3
@@ -21,11 +25,314 @@ try:
     from urllib.parse import urlparse as _urlparse  # py3
 except ImportError:
     from urlparse import urlparse as _urlparse  # py2
+try:
+    from urllib3.util.retry import Retry as _Retry
+    from urllib3.exceptions import NewConnectionError as _NewConnectionError
+except ImportError:
+    from requests.packages.urllib3.util.retry import Retry as _Retry
+    from requests.packages.urllib3.exceptions import (
+        NewConnectionError as _NewConnectionError)
+try:
+    from concurrent.futures import Future as _Future  # py3, or py2 backport
+except ImportError:
+    _Future = None
 import time
 
 _CT = 'content-type'
 _AJ = 'application/json'
 _URL_SCHEME = frozenset(['http', 'https'])
+# responses of an idempotent call that are worth retrying
+_RETRY_STATUS = frozenset([502, 503, 504])
+
+
+class _SessionPool(object):
+    '''
+    One requests.Session per base url (scheme and host), shared by every
+    client in the process, so successive calls reuse pooled keep-alive
+    connections instead of opening a new TCP/TLS connection each time.
+    Defaults come from the environment:
+    KB_CLIENT_POOL_SIZE - connections kept open per base url. Default 10.
+    KB_CLIENT_KEEP_ALIVE - seconds an idle session is kept before it is
+        replaced, as servers drop idle connections. 0 disables connection
+        reuse. Default 60.
+    KB_CLIENT_RETRIES - times a failed connection attempt is retried, and
+        times an idempotent call is retried. Default 3.
+    KB_CLIENT_RETRY_BACKOFF - seconds before the first retry, doubling for
+        each further retry. Default 0.5.
+    '''
+
+    def __init__(self):
+        self.pool_size = int(_os.environ.get('KB_CLIENT_POOL_SIZE', 10))
+        self.keep_alive = float(_os.environ.get('KB_CLIENT_KEEP_ALIVE', 60))
+        self.retries = int(_os.environ.get('KB_CLIENT_RETRIES', 3))
+        self.backoff = float(_os.environ.get('KB_CLIENT_RETRY_BACKOFF', 0.5))
+        self._lock = _threading.Lock()
+        self._sessions = {}  # base url -> [session, last use time]
+        self._pid = _os.getpid()
+
+    def configure(self, pool_size=None, keep_alive=None, retries=None,
+                  backoff=None):
+        with self._lock:
+            if pool_size is not None:
+                self.pool_size = int(pool_size)
+            if keep_alive is not None:
+                self.keep_alive = float(keep_alive)
+            if retries is not None:
+                self.retries = int(retries)
+            if backoff is not None:
+                self.backoff = float(backoff)
+            # dropped rather than closed, as other threads may be mid call
+            # on them; their connections close once they are unused
+            self._sessions.clear()
+
+    def _new_session(self):
+        session = _requests.Session()
+        retry = _Retry(total=self.retries, read=False,
+                       backoff_factor=self.backoff)
+        adapter = _requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=max(1, self.pool_size),
+            max_retries=retry)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        if self.keep_alive <= 0:
+            session.headers['Connection'] = 'close'
+        return session
+
+    def session(self, url):
+        scheme, netloc, _, _, _, _ = _urlparse(url)
+        key = scheme + '://' + netloc
+        now = time.time()
+        with self._lock:
+            if self._pid != _os.getpid():
+                # connections can't be shared with the parent of a fork
+                self._sessions.clear()
+                self._pid = _os.getpid()
+            entry = self._sessions.get(key)
+            if entry is not None and 0 < self.keep_alive < now - entry[1]:
+                # not closed, as another thread may still be using it
+                entry = None
+            if entry is None:
+                entry = self._sessions[key] = [self._new_session(), now]
+            entry[1] = now
+            return entry[0]
+
+
+_session_pool = _SessionPool()
+
+
+def configure_session_pool(pool_size=None, keep_alive=None, retries=None,
+                           backoff=None):
+    '''
+    Change the connection pool settings of all clients in this process, see
+    _SessionPool. Open sessions are replaced by new ones.
+    '''
+    _session_pool.configure(pool_size, keep_alive, retries, backoff)
+
+
+class _ServiceUrlCache(object):
+    '''
+    Service urls resolved by the Service Wizard, shared by every client in
+    the process and keyed by (wizard url, module, version), so a dynamic
+    service call normally costs one round trip rather than two.
+    An entry younger than KB_SERVICE_URL_TTL seconds (default 300) is used
+    as is. An older one is still used, while a background thread resolves
+    it again (stale-while-revalidate). A url that can't be connected to is
+    dropped and resolved again at once.
+    '''
+
+    def __init__(self):
+        self.ttl = float(_os.environ.get('KB_SERVICE_URL_TTL', 300))
+        self._lock = _threading.Lock()
+        self._urls = {}  # key -> (url, time resolved)
+        self._refreshing = set()
+
+    def get(self, key, resolve):
+        '''
+        Return the url for key, calling resolve() to look it up if needed.
+        '''
+        with self._lock:
+            entry = self._urls.get(key)
+            if entry is not None:
+                url, resolved = entry
+                if (time.time() - resolved >= self.ttl and
+                        key not in self._refreshing):
+                    self._refreshing.add(key)
+                    t = _threading.Thread(target=self._refresh,
+                                          args=(key, resolve))
+                    t.daemon = True
+                    t.start()
+                return url
+        return self._resolve(key, resolve)
+
+    def _resolve(self, key, resolve):
+        url = resolve()
+        with self._lock:
+            self._urls[key] = (url, time.time())
+        return url
+
+    def _refresh(self, key, resolve):
+        try:
+            self._resolve(key, resolve)
+        except Exception:
+            pass  # keep serving the stale url, and retry on the next get
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def invalidate(self, key, url):
+        '''
+        Drop the entry for key if it still maps to url.
+        '''
+        with self._lock:
+            entry = self._urls.get(key)
+            if entry is not None and entry[0] == url:
+                del self._urls[key]
+
+
+_service_url_cache = _ServiceUrlCache()
+
+
+def _not_sent(error):
+    # whether a requests ConnectionError came from failing to connect, so
+    # the request never reached the server and sending it again can't run
+    # the call twice
+    if isinstance(error, _requests.exceptions.ConnectTimeout):
+        return True
+    cause = error.args[0] if error.args else None
+    return isinstance(getattr(cause, 'reason', cause), _NewConnectionError)
+
+
+if _Future is None:
+    class _Future(object):
+        '''
+        The parts of concurrent.futures.Future used by BaseClient.submit_job,
+        for python 2 without the futures package.
+        '''
+
+        def __init__(self):
+            self._done = _threading.Event()
+            self._result = None
+            self._exception = None
+            self._callbacks = []
+            self._lock = _threading.Lock()
+
+        def done(self):
+            return self._done.is_set()
+
+        def _finish(self):
+            with self._lock:
+                self._done.set()
+                callbacks, self._callbacks = self._callbacks, []
+            for fn in callbacks:
+                fn(self)
+
+        def set_result(self, result):
+            self._result = result
+            self._finish()
+
+        def set_exception(self, exception):
+            self._exception = exception
+            self._finish()
+
+        def add_done_callback(self, fn):
+            with self._lock:
+                if not self._done.is_set():
+                    self._callbacks.append(fn)
+                    return
+            fn(self)
+
+        def exception(self, timeout=None):
+            if not self._done.wait(timeout):
+                raise _threading.ThreadError('Timed out waiting for job')
+            return self._exception
+
+        def result(self, timeout=None):
+            if self.exception(timeout) is not None:
+                raise self._exception
+            return self._result
+
+
+class _JobPoller(object):
+    '''
+    Checks the state of all the outstanding asynchronous jobs of a client
+    from one background thread, on one backoff schedule: each round checks
+    every job, and the wait between rounds grows from the client's
+    async_job_check_time by async_job_check_time_scale_percent up to
+    async_job_check_max_time, dropping back when a job is added. The thread
+    exits when no jobs are left.
+
+    Each check may take up to KB_CLIENT_JOB_CHECK_TIMEOUT seconds (default
+    60, and at most the client's timeout), so a check that hangs holds up
+    the other jobs only that long.  A job whose check times out is checked
+    again in the next round, and fails after as many timed out checks in a
+    row as the client retries calls (KB_CLIENT_RETRIES) plus one.
+    '''
+
+    def __init__(self, client):
+        self._client = client
+        self.check_timeout = min(
+            client.timeout,
+            float(_os.environ.get('KB_CLIENT_JOB_CHECK_TIMEOUT', 60)))
+        self._lock = _threading.Lock()
+        self._jobs = {}  # job id -> (module, future)
+        self._timeouts = {}  # job id -> checks timed out in a row
+        self._added = _threading.Event()
+        self._thread = None
+
+    def add(self, module, job_id):
+        future = _Future()
+        with self._lock:
+            self._jobs[job_id] = (module, future)
+            self._added.set()
+            if self._thread is None:
+                self._thread = _threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+        return future
+
+    def _run(self):
+        client = self._client
+        interval = client.async_job_check_time
+        while True:
+            if self._added.wait(interval):
+                self._added.clear()
+                interval = client.async_job_check_time
+                time.sleep(interval)
+            with self._lock:
+                jobs = list(self._jobs.items())
+            for job_id, (module, future) in jobs:
+                try:
+                    job_state = client._check_job(module, job_id,
+                                                  timeout=self.check_timeout)
+                    self._timeouts.pop(job_id, None)
+                    if not job_state['finished']:
+                        continue
+                    future.set_result(_unpack_result(job_state['result']))
+                except _requests.exceptions.Timeout as e:
+                    self._timeouts[job_id] = self._timeouts.get(job_id, 0) + 1
+                    if self._timeouts[job_id] <= _session_pool.retries:
+                        continue
+                    future.set_exception(e)
+                except Exception as e:
+                    future.set_exception(e)
+                self._timeouts.pop(job_id, None)
+                with self._lock:
+                    del self._jobs[job_id]
+            with self._lock:
+                if not self._jobs:
+                    self._thread = None
+                    return
+            interval = min(interval *
+                           client.async_job_check_time_scale_percent / 100.0,
+                           client.async_job_check_max_time)
+
+
+def _unpack_result(result):
+    if not result:
+        return
+    if len(result) == 1:
+        return result[0]
+    return result
 
 
 def _get_token(user_id, password, auth_svc):
@@ -93,6 +400,75 @@ class _JSONObjectEncoder(_json.JSONEncoder):
         return _json.JSONEncoder.default(self, obj)
 
 
+class _Batch(object):
+    '''
+    Calls queued by BaseClient.batch(). call_method takes the same arguments
+    as BaseClient.call_method, and returns a future for the call's result.
+    '''
+
+    def __init__(self, client):
+        self._client = client
+        self._calls = []  # (url, arg hash, future)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+        else:
+            self._fail(self._calls, ValueError('The batch was not sent'))
+            self._calls = []
+
+    def call_method(self, service_method, args, service_ver=None,
+                    context=None):
+        url = self._client._get_service_url(service_method, service_ver)
+        context = self._client._set_up_context(service_ver, context)
+        future = _Future()
+        self._calls.append((url, self._client._arg_hash(
+            service_method, args, context), future))
+        return future
+
+    def flush(self):
+        '''
+        Send the queued calls.
+        '''
+        calls, self._calls = self._calls, []
+        urls = []
+        by_url = {}
+        for call in calls:
+            if call[0] not in by_url:
+                urls.append(call[0])
+                by_url[call[0]] = []
+            by_url[call[0]].append(call)
+        for url in urls:
+            self._send(url, by_url[url])
+
+    def _fail(self, calls, error):
+        for _, _, future in calls:
+            future.set_exception(error)
+
+    def _send(self, url, calls):
+        try:
+            resp = self._client._post_json(url, [c[1] for c in calls])
+            if not isinstance(resp, list):
+                raise ServerError('Unknown', 0,
+                                  'The server did not answer with a batch')
+        except Exception as e:
+            self._fail(calls, e)
+            return
+        by_id = dict((r.get('id'), r) for r in resp if isinstance(r, dict))
+        for _, arg_hash, future in calls:
+            r = by_id.get(arg_hash['id'])
+            if r is None or ('error' not in r and 'result' not in r):
+                future.set_exception(ServerError(
+                    'Unknown', 0, 'An unknown server error occurred'))
+            elif r.get('error'):
+                future.set_exception(ServerError(**r['error']))
+            else:
+                future.set_result(_unpack_result(r['result']))
+
+
 class BaseClient(object):
     '''
     The KBase base client.
@@ -140,6 +516,7 @@ class BaseClient(object):
         self.async_job_check_time_scale_percent = (
             async_job_check_time_scale_percent)
         self.async_job_check_max_time = async_job_check_max_time_ms / 1000.0
+        self._job_poller = _JobPoller(self)
         # token overrides user_id and password
         if token is not None:
             self._headers['AUTHORIZATION'] = token
@@ -160,7 +537,28 @@ class BaseClient(object):
         if self.timeout < 1:
             raise ValueError('Timeout value must be at least 1 second')
 
-    def _call(self, url, method, params, context=None):
+    def _post(self, url, body, idempotent=False, timeout=None):
+        # connection failures are retried by the session's adapter, as the
+        # request never reached the server. An idempotent call is also
+        # retried if the connection drops mid call or a gateway fails.
+        attempts = 1 + (_session_pool.retries if idempotent else 0)
+        for attempt in range(attempts):
+            if attempt:
+                time.sleep(_session_pool.backoff * 2 ** (attempt - 1))
+            last = attempt == attempts - 1
+            try:
+                ret = _session_pool.session(url).post(
+                    url, data=body, headers=self._headers,
+                    timeout=timeout or self.timeout,
+                    verify=not self.trust_all_ssl_certificates)
+            except _requests.exceptions.ConnectionError:
+                if last:
+                    raise
+                continue
+            if last or ret.status_code not in _RETRY_STATUS:
+                return ret
+
+    def _arg_hash(self, method, params, context=None):
         arg_hash = {'method': method,
                     'params': params,
                     'version': '1.1',
@@ -170,11 +568,11 @@ class BaseClient(object):
             if type(context) is not dict:
                 raise ValueError('context is not type dict as required.')
             arg_hash['context'] = context
+        return arg_hash
 
-        body = _json.dumps(arg_hash, cls=_JSONObjectEncoder)
-        ret = _requests.post(url, data=body, headers=self._headers,
-                             timeout=self.timeout,
-                             verify=not self.trust_all_ssl_certificates)
+    def _post_json(self, url, data, idempotent=False, timeout=None):
+        body = _json.dumps(data, cls=_JSONObjectEncoder)
+        ret = self._post(url, body, idempotent, timeout)
         ret.encoding = 'utf-8'
         if ret.status_code == 500:
             if ret.headers.get(_CT) == _AJ:
@@ -187,23 +585,43 @@ class BaseClient(object):
                 raise ServerError('Unknown', 0, ret.text)
         if not ret.ok:
             ret.raise_for_status()
-        resp = ret.json()
+        return ret.json()
+
+    def _call(self, url, method, params, context=None, idempotent=False,
+              timeout=None):
+        resp = self._post_json(url, self._arg_hash(method, params, context),
+                               idempotent, timeout)
         if 'result' not in resp:
             raise ServerError('Unknown', 0, 'An unknown server error occurred')
-        if not resp['result']:
-            return
-        if len(resp['result']) == 1:
-            return resp['result'][0]
-        return resp['result']
+        return _unpack_result(resp['result'])
+
+    def batch(self):
+        '''
+        Return a context manager that queues calls and sends them together,
+        one JSON-RPC batch request per service url, when the with block
+        ends:
+            with client.batch() as batch:
+                status = batch.call_method('ReadsUtils.status', [])
+            status.result()
+        '''
+        return _Batch(self)
+
+    def _service_url_key(self, service_method, service_version):
+        service, _ = service_method.split('.')
+        return (self.url, service, service_version)
 
     def _get_service_url(self, service_method, service_version):
         if not self.lookup_url:
             return self.url
-        service, _ = service_method.split('.')
-        service_status_ret = self._call(
-            self.url, 'ServiceWizard.get_service_status',
-            [{'module_name': service, 'version': service_version}])
-        return service_status_ret['url']
+        key = self._service_url_key(service_method, service_version)
+
+        def resolve():
+            service_status_ret = self._call(
+                self.url, 'ServiceWizard.get_service_status',
+                [{'module_name': key[1], 'version': key[2]}],
+                idempotent=True)
+            return service_status_ret['url']
+        return _service_url_cache.get(key, resolve)
 
     def _set_up_context(self, service_ver=None, context=None):
         if service_ver:
@@ -212,8 +630,9 @@ class BaseClient(object):
             context['service_ver'] = service_ver
         return context
 
-    def _check_job(self, service, job_id):
-        return self._call(self.url, service + '._check_job', [job_id])
+    def _check_job(self, service, job_id, timeout=None):
+        return self._call(self.url, service + '._check_job', [job_id],
+                          idempotent=True, timeout=timeout)
 
     def _submit_job(self, service_method, args, service_ver=None,
                     context=None):
@@ -233,23 +652,21 @@ class BaseClient(object):
             or dev/beta/release.
         context - the rpc context dict.
         '''
+        return self.submit_job(service_method, args, service_ver,
+                               context).result()
+
+    def submit_job(self, service_method, args, service_ver=None,
+                   context=None):
+        '''
+        Start a SDK method asynchronously and return a
+        concurrent.futures.Future for its result, so many jobs can be run
+        at once without a thread each. One background thread per client
+        checks all the outstanding jobs.
+        Arguments are as for run_job.
+        '''
         mod, _ = service_method.split('.')
         job_id = self._submit_job(service_method, args, service_ver, context)
-        async_job_check_time = self.async_job_check_time
-        while True:
-            time.sleep(async_job_check_time)
-            async_job_check_time = (async_job_check_time *
-                                    self.async_job_check_time_scale_percent /
-                                    100.0)
-            if async_job_check_time > self.async_job_check_max_time:
-                async_job_check_time = self.async_job_check_max_time
-            job_state = self._check_job(mod, job_id)
-            if job_state['finished']:
-                if not job_state['result']:
-                    return
-                if len(job_state['result']) == 1:
-                    return job_state['result'][0]
-                return job_state['result']
+        return self._job_poller.add(mod, job_id)
 
     def call_method(self, service_method, args, service_ver=None,
                     context=None):
@@ -265,4 +682,19 @@ class BaseClient(object):
         '''
         url = self._get_service_url(service_method, service_ver)
         context = self._set_up_context(service_ver, context)
-        return self._call(url, service_method, args, context)
+        try:
+            return self._call(url, service_method, args, context)
+        except _requests.exceptions.ConnectionError as e:
+            if not self.lookup_url:
+                raise
+            # the service may have moved since its url was cached.  The call
+            # only goes to the new url if it never reached the old one, as
+            # e.g. a job it started may be running there
+            _service_url_cache.invalidate(
+                self._service_url_key(service_method, service_ver), url)
+            if not _not_sent(e):
+                raise
+            new_url = self._get_service_url(service_method, service_ver)
+            if new_url == url:
+                raise
+            return self._call(new_url, service_method, args, context)
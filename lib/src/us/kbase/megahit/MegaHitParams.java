@@ -45,6 +45,13 @@ import com.fasterxml.jackson.annotation.JsonPropertyOrder;
  *              k_list - list of kmer size (all must be odd, in the range 15-127, increment <= 28);
  *                  overrides '--k-min', '--k-max', and '--k-step'
  *              min_contig_length - minimum length of contigs to output, default 200
+ *              num_cpu_threads - number of CPU threads, default all the CPUs available to the container
+ *              memory - max memory for SdBG construction: a fraction (0-1) of the memory available
+ *                  to the container, or else a number of bytes, at least 1 GiB (1073741824); values
+ *                  in between are refused.  Default 0.9
+ *              mem_flag - SdBG builder memory mode: 0 = minimum, 1 = moderate (default), 2 = all of memory
+ *              num_cpu_threads and memory are shared by all the MEGAHIT runs that happen at once,
+ *                  and are capped at what the container's cgroup and cpu affinity allow
  *              @optional megahit_parameter_preset
  *              @optional min_count
  *              @optional k_min
@@ -52,6 +59,9 @@ import com.fasterxml.jackson.annotation.JsonPropertyOrder;
  *              @optional k_step
  *              @optional k_list
  *              @optional min_contig_len
+ *              @optional num_cpu_threads
+ *              @optional memory
+ *              @optional mem_flag
  * </pre>
  * 
  */
@@ -68,7 +78,10 @@ import com.fasterxml.jackson.annotation.JsonPropertyOrder;
     "k_max",
     "k_step",
     "k_list",
-    "min_contig_len"
+    "min_contig_len",
+    "num_cpu_threads",
+    "memory",
+    "mem_flag"
 })
 public class MegaHitParams {
 
@@ -94,6 +107,12 @@ public class MegaHitParams {
     private List<Long> kList;
     @JsonProperty("min_contig_len")
     private java.lang.Long minContigLen;
+    @JsonProperty("num_cpu_threads")
+    private java.lang.Long numCpuThreads;
+    @JsonProperty("memory")
+    private java.lang.Double memory;
+    @JsonProperty("mem_flag")
+    private java.lang.Long memFlag;
     private Map<String, Object> additionalProperties = new HashMap<String, Object>();
 
     @JsonProperty("workspace_name")
@@ -261,6 +280,51 @@ public class MegaHitParams {
         return this;
     }
 
+    @JsonProperty("num_cpu_threads")
+    public java.lang.Long getNumCpuThreads() {
+        return numCpuThreads;
+    }
+
+    @JsonProperty("num_cpu_threads")
+    public void setNumCpuThreads(java.lang.Long numCpuThreads) {
+        this.numCpuThreads = numCpuThreads;
+    }
+
+    public MegaHitParams withNumCpuThreads(java.lang.Long numCpuThreads) {
+        this.numCpuThreads = numCpuThreads;
+        return this;
+    }
+
+    @JsonProperty("memory")
+    public java.lang.Double getMemory() {
+        return memory;
+    }
+
+    @JsonProperty("memory")
+    public void setMemory(java.lang.Double memory) {
+        this.memory = memory;
+    }
+
+    public MegaHitParams withMemory(java.lang.Double memory) {
+        this.memory = memory;
+        return this;
+    }
+
+    @JsonProperty("mem_flag")
+    public java.lang.Long getMemFlag() {
+        return memFlag;
+    }
+
+    @JsonProperty("mem_flag")
+    public void setMemFlag(java.lang.Long memFlag) {
+        this.memFlag = memFlag;
+    }
+
+    public MegaHitParams withMemFlag(java.lang.Long memFlag) {
+        this.memFlag = memFlag;
+        return this;
+    }
+
     @JsonAnyGetter
     public Map<String, Object> getAdditionalProperties() {
         return this.additionalProperties;
@@ -273,7 +337,7 @@ public class MegaHitParams {
 
     @Override
     public String toString() {
-        return ((((((((((((((((((((((((("MegaHitParams"+" [workspaceName=")+ workspaceName)+", inputReadsName=")+ inputReadsName)+", outputContigsetName=")+ outputContigsetName)+", combinedAssemblyFlag=")+ combinedAssemblyFlag)+", megahitParameterPreset=")+ megahitParameterPreset)+", minCount=")+ minCount)+", kMin=")+ kMin)+", kMax=")+ kMax)+", kStep=")+ kStep)+", kList=")+ kList)+", minContigLen=")+ minContigLen)+", additionalProperties=")+ additionalProperties)+"]");
+        return ((((((((((((((((((((((((((((((("MegaHitParams"+" [workspaceName=")+ workspaceName)+", inputReadsName=")+ inputReadsName)+", outputContigsetName=")+ outputContigsetName)+", combinedAssemblyFlag=")+ combinedAssemblyFlag)+", megahitParameterPreset=")+ megahitParameterPreset)+", minCount=")+ minCount)+", kMin=")+ kMin)+", kMax=")+ kMax)+", kStep=")+ kStep)+", kList=")+ kList)+", minContigLen=")+ minContigLen)+", numCpuThreads=")+ numCpuThreads)+", memory=")+ memory)+", memFlag=")+ memFlag)+", additionalProperties=")+ additionalProperties)+"]");
     }
 
 }
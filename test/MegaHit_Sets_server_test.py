@@ -3,6 +3,9 @@ import unittest
 import os
 import json
 import time
+import threading
+import shutil
+import gzip
 import requests
 requests.packages.urllib3.disable_warnings()
 
@@ -12,6 +15,13 @@ try:
 except:
     from configparser import ConfigParser  # py3
 
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer  # py2
+    from SocketServer import ThreadingMixIn
+except:
+    from http.server import BaseHTTPRequestHandler, HTTPServer  # py3
+    from socketserver import ThreadingMixIn
+
 from pprint import pprint
 
 from requests_toolbelt import MultipartEncoder
@@ -20,6 +30,17 @@ from biokbase.AbstractHandle.Client import AbstractHandle as HandleService
 
 from MegaHit_Sets.MegaHit_SetsImpl import MegaHit_Sets
 from MegaHit_Sets.MegaHit_SetsServer import MethodContext
+from MegaHit_Sets.concat import FileConcatenator
+from MegaHit_Sets.fifo import FifoFeeder
+from MegaHit_Sets.prefetch import ReadsPrefetcher
+from MegaHit_Sets.contig_stats import fasta_contig_stats
+from MegaHit_Sets.report import AssemblyReport
+from MegaHit_Sets.saver import AssemblySaver
+from MegaHit_Sets.authclient import KBaseAuth, TokenCache
+from MegaHit_Sets.resources import AvailableResources, affinity_cpus, cgroup_cpus, cgroup_memory
+from MegaHit_Sets.assembly_cache import AssemblyCache
+from MegaHit_Sets.reads_cache import ReadsCache
+from MegaHit_Sets.spans import SpanRecorder
 
 
 class MegaHit_SetsTest(unittest.TestCase):
@@ -86,6 +107,43 @@ class MegaHit_SetsTest(unittest.TestCase):
     def getContext(self):
         return self.__class__.ctx
 
+    def startStandInServer(self, answer):
+        '''
+        Start a JSON-RPC server on a free local port, answering each call
+        (and each call of a batch) with its result, answer(call).  answer
+        may raise ValueError to answer with an error.  Returns the server,
+        to shut down, and its url.
+        '''
+        def respond(req):
+            try:
+                return {'version': '1.1', 'id': req.get('id'), 'result': [answer(req)]}
+            except ValueError as e:
+                return {'version': '1.1', 'id': req.get('id'),
+                        'error': {'name': 'JSONRPCError', 'code': -32500, 'message': str(e)}}
+        class StandInHandler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            def do_POST(self):
+                length = int(self.headers['content-length'])
+                req = json.loads(self.rfile.read(length).decode('utf-8'))
+                resp = [respond(r) for r in req] if isinstance(req, list) else respond(req)
+                body = json.dumps(resp).encode('utf-8')
+                self.send_response(200)
+                self.send_header('content-type', 'application/json')
+                self.send_header('content-length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            def log_message(self, *args):
+                pass
+        class StandInServer(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+            def handle_error(self, request, client_address):
+                pass  # e.g. a client that timed out and closed the connection
+        server = StandInServer(('127.0.0.1', 0), StandInHandler)
+        server_thread = threading.Thread(target=server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+        return server, 'http://127.0.0.1:'+str(server.server_port)+'/'
+
 
     @classmethod
     def upload_file_to_shock(cls, file_path):
@@ -535,3 +593,1188 @@ class MegaHit_SetsTest(unittest.TestCase):
         contigset_info = info_list[0]
         self.assertEqual(contigset_info[1],output_name)
         self.assertEqual(contigset_info[2].split('-')[0],'KBaseGenomeAnnotations.Assembly')
+
+
+    ### TEST 3: run megahit against a reads set, one assembly per library, two at a time
+    #
+    def test_run_megahit_ReadsSet_uncombined_parallel(self):
+
+        print ("\n\nRUNNING: test_run_megahit_ReadsSet_uncombined_parallel()")
+        print ("========================================================\n\n")
+
+        # figure out where the test data lives
+        pe_lib_set_info = self.getPairedEndLib_SetInfo(['small_1','small_2'], True)
+        pprint(pe_lib_set_info)
+
+        # run method
+        output_name = 'output_readsSet_uncombined.contigset'
+        params = {
+            'workspace_name': pe_lib_set_info[7],
+            'input_reads_ref': str(pe_lib_set_info[6])+'/'+str(pe_lib_set_info[0]),
+            'megahit_parameter_preset': 'meta',
+            'output_contigset_name': output_name,
+            'combined_assembly_flag': 0
+        }
+
+        impl = self.getImpl()
+        saved_parallel_jobs = impl.megahit_parallel_jobs
+        impl.megahit_parallel_jobs = 2
+        try:
+            result = impl.run_megahit(self.getContext(),params)
+        finally:
+            impl.megahit_parallel_jobs = saved_parallel_jobs
+        print('RESULT:')
+        pprint(result)
+
+        # check the output, one assembly per library named after that library
+        for lib_name in ['test-0.pe.reads', 'test-1.pe.reads']:
+            info_list = self.wsClient.get_object_info([{'ref':pe_lib_set_info[7] + '/' + lib_name+'-'+output_name}], 1)
+            self.assertEqual(len(info_list),1)
+            contigset_info = info_list[0]
+            self.assertEqual(contigset_info[2].split('-')[0],'KBaseGenomeAnnotations.Assembly')
+
+
+    ### TEST 4: run a combined assembly of a reads set, streaming the members through named pipes
+    #
+    def test_run_megahit_ReadsSet_fifo(self):
+
+        print ("\n\nRUNNING: test_run_megahit_ReadsSet_fifo()")
+        print ("=========================================\n\n")
+
+        # figure out where the test data lives
+        pe_lib_set_info = self.getPairedEndLib_SetInfo(['small_1','small_2'], True)
+        pprint(pe_lib_set_info)
+
+        # run method
+        output_name = 'output_readsSet_fifo.contigset'
+        params = {
+            'workspace_name': pe_lib_set_info[7],
+            'input_reads_ref': str(pe_lib_set_info[6])+'/'+str(pe_lib_set_info[0]),
+            'megahit_parameter_preset': 'meta',
+            'output_contigset_name': output_name,
+            'combined_assembly_flag': 1
+        }
+
+        impl = self.getImpl()
+        saved_mode = impl.combined_input_mode
+        impl.combined_input_mode = 'fifo'
+        try:
+            result = impl.run_megahit(self.getContext(),params)
+        finally:
+            impl.combined_input_mode = saved_mode
+        print('RESULT:')
+        pprint(result)
+
+        # check the output
+        info_list = self.wsClient.get_object_info([{'ref':pe_lib_set_info[7] + '/' + output_name}], 1)
+        self.assertEqual(len(info_list),1)
+        contigset_info = info_list[0]
+        self.assertEqual(contigset_info[1],output_name)
+        self.assertEqual(contigset_info[2].split('-')[0],'KBaseGenomeAnnotations.Assembly')
+
+
+    ### TEST 5: the fifo feeder streams every library in order, and removes each once written
+    #
+    def test_fifo_feeder(self):
+
+        scratch = self.getImpl().scratch
+        fifo_dir = os.path.join(scratch, 'test_fifo_feeder')
+        os.makedirs(fifo_dir)
+
+        libraries = []
+        for lib_i in range(3):
+            files = {}
+            for direction in ['fwd', 'rev']:
+                path = os.path.join(fifo_dir, str(lib_i)+'.'+direction+'.fq')
+                with open(path, 'w') as f:
+                    f.write(direction+str(lib_i)+'\n')
+                files[direction] = path
+            libraries.append(files)
+
+        feeder = FifoFeeder({'fwd': os.path.join(fifo_dir, 'fwd.fifo'),
+                             'rev': os.path.join(fifo_dir, 'rev.fifo')},
+                            lambda lib_i: libraries[lib_i], len(libraries)).start()
+        streamed = {}
+        def read_fifo(direction):
+            with open(feeder.fifo_paths[direction]) as f:
+                streamed[direction] = f.read()
+        readers = [threading.Thread(target=read_fifo, args=(d,)) for d in ['fwd', 'rev']]
+        for reader in readers:
+            reader.start()
+        for reader in readers:
+            reader.join()
+        feeder.close()
+        feeder.check()
+
+        self.assertEqual(streamed['fwd'], 'fwd0\nfwd1\nfwd2\n')
+        self.assertEqual(streamed['rev'], 'rev0\nrev1\nrev2\n')
+        self.assertEqual(os.listdir(fifo_dir), [])
+        os.rmdir(fifo_dir)
+
+
+    ### TEST 6: contig statistics of a small multi-line fasta
+    #
+    def test_fasta_contig_stats(self):
+
+        fasta_path = os.path.join(self.getImpl().scratch, 'test_contig_stats.fa')
+        with open(fasta_path, 'w') as f:
+            f.write('>k141_0 flag=1 multi=2.0000 len=10\nACGTACGTGG\n')
+            f.write('>k141_1 flag=1 multi=2.0000 len=4\nAATT\n')
+            f.write('>k141_2 flag=1 multi=2.0000 len=6\nGGC\nCAA\n')
+
+        stats = fasta_contig_stats(fasta_path, bins=2)
+        os.remove(fasta_path)
+
+        self.assertEqual(stats['count'], 3)
+        self.assertEqual(stats['total_bp'], 20)
+        self.assertEqual(stats['max'], 10)
+        self.assertEqual(stats['min'], 4)
+        self.assertEqual(stats['n50'], 10)
+        self.assertEqual(stats['l50'], 1)
+        self.assertEqual(stats['n90'], 4)
+        self.assertEqual(stats['l90'], 3)
+        self.assertAlmostEqual(stats['gc_percent'], 50.0)
+        self.assertEqual(stats['hist_counts'], [2, 1])
+
+
+    ### TEST 7: token cache LRU behaviour, and a contention micro-benchmark
+    #
+    def test_token_cache(self):
+
+        cache = TokenCache(maxsize=3, ttl=0.5)
+        for token in ['a', 'b', 'c']:
+            cache.add_valid_token(token, 'user_'+token)
+        self.assertEqual(cache.get_user('a'), 'user_a')  # 'b' is now the LRU
+        cache.add_valid_token('d', 'user_d')
+        self.assertEqual(cache.get_user('b'), None)
+        self.assertEqual(cache.get_user('c'), 'user_c')
+        time.sleep(0.6)
+        self.assertEqual(cache.get_user('a'), None)
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['evictions'], stats['expirations']),
+                         (2, 2, 1, 1))
+
+        # many threads looking up and adding tokens from a key space larger than the cache
+        cache = TokenCache(maxsize=2000)
+        n_threads = 16
+        n_ops = 20000
+        def hammer(seed):
+            for i in range(n_ops):
+                token = 'token_'+str((seed * 7919 + i * 104729) % 3000)
+                if cache.get_user(token) is None:
+                    cache.add_valid_token(token, 'user')
+        threads = [threading.Thread(target=hammer, args=(seed,)) for seed in range(n_threads)]
+        start = time.time()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.time() - start
+        stats = cache.stats()
+        print('TokenCache: '+str(n_threads)+' threads, '+str(int(n_threads * n_ops / elapsed))+
+              ' lookups/s, '+str(stats))
+        self.assertEqual(stats['hits'] + stats['misses'], n_threads * n_ops)
+        self.assertLessEqual(stats['size'], 2000)
+
+
+    ### TEST 8: cpus and memory from cgroup v1 and v2 limits and cpu affinity, and their split between runs
+    #
+    def test_available_resources(self):
+
+        root = os.path.join(self.getImpl().scratch, 'test_resources')
+        def write(path, text):
+            path = os.path.join(root, path)
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as f:
+                f.write(text)
+
+        # cgroup v2: a 2.5 cpu quota on the job's cgroup, and a 3 GiB limit on its parent
+        write('v2/proc/status', 'Name:\tpython\nCpus_allowed_list:\t0-7,16\n')
+        write('v2/proc/cgroup', '0::/jobs/megahit\n')
+        write('v2/cgroup/jobs/memory.max', str(3 << 30)+'\n')
+        write('v2/cgroup/jobs/megahit/memory.max', 'max\n')
+        write('v2/cgroup/jobs/megahit/cpu.max', '250000 100000\n')
+        proc_self, cgroup_root = os.path.join(root, 'v2/proc'), os.path.join(root, 'v2/cgroup')
+        self.assertEqual(affinity_cpus(proc_self), 9)
+        self.assertEqual(cgroup_cpus(proc_self, cgroup_root), 3)
+        self.assertEqual(cgroup_memory(proc_self, cgroup_root), 3 << 30)
+
+        # cgroup v1 in a cgroup namespace: no cpu quota, affinity to 1 cpu, 1 GiB of memory
+        write('v1/proc/status', 'Name:\tpython\nCpus_allowed_list:\t3\n')
+        write('v1/proc/cgroup', '4:memory:/docker/abc\n2:cpu,cpuacct:/docker/abc\n0::/\n')
+        write('v1/cgroup/cpu,cpuacct/cpu.cfs_quota_us', '-1\n')
+        write('v1/cgroup/cpu,cpuacct/cpu.cfs_period_us', '100000\n')
+        write('v1/cgroup/memory/memory.limit_in_bytes', str(1 << 30)+'\n')
+        proc_self, cgroup_root = os.path.join(root, 'v1/proc'), os.path.join(root, 'v1/cgroup')
+        self.assertEqual(cgroup_cpus(proc_self, cgroup_root), None)
+        self.assertEqual(cgroup_memory(proc_self, cgroup_root), 1 << 30)
+        resources = AvailableResources(proc_self, cgroup_root)
+        self.assertEqual(resources.cpus, 1)
+        self.assertLessEqual(resources.memory_bytes, 1 << 30)
+        shutil.rmtree(root)
+
+        # two runs at once share 1 cpu and 1 GiB, and asking for more is capped at that
+        impl = self.getImpl()
+        saved_resources = impl.resources
+        impl.resources = resources
+        resources.memory_bytes = 1 << 30
+        try:
+            self.assertEqual(impl.megahit_resources({'num_cpu_threads': 8, 'memory': 0.5}, 2),
+                             (1, 1 << 28, impl.megahit_mem_flag))
+            self.assertEqual(impl.megahit_resources({'memory': 4e9, 'mem_flag': 0}),
+                             (1, 1 << 30, 0))
+            self.assertEqual(impl.megahit_resources({'num_cpu_threads': '', 'memory': 4e9, 'mem_flag': ''}),
+                             (1, 1 << 30, impl.megahit_mem_flag))
+
+            # a memory between 1 and 1 GiB is neither a fraction nor a plausible number of bytes
+            for memory in [2, 16, 16000, -0.5]:
+                self.assertRaises(ValueError, impl.megahit_resources, {'memory': memory})
+
+            # with the container's memory unknown, megahit is given the fraction, or the bytes uncapped
+            resources.memory_bytes = None
+            self.assertEqual(impl.megahit_resources({'memory': 0.5, 'mem_flag': 2}, 2), (1, 0.25, 2))
+            self.assertEqual(impl.megahit_resources({'memory': 4e9}, 2), (1, 2000000000, impl.megahit_mem_flag))
+            self.assertEqual(impl.megahit_resources({'memory': 1}), (1, 1.0, impl.megahit_mem_flag))
+        finally:
+            impl.resources = saved_resources
+
+
+    ### TEST 9: the assembly result cache, and its least recently used eviction
+    #
+    def test_assembly_cache(self):
+
+        root = os.path.join(self.getImpl().scratch, 'test_assembly_cache')
+        os.makedirs(root)
+        contigs_path = os.path.join(root, 'final.contigs.fa')
+        with open(contigs_path, 'w') as f:
+            f.write('>k141_0\n' + 'ACGT' * 250 + '\n')  # about 1 KB
+        cache = AssemblyCache(os.path.join(root, 'cache'), max_bytes=2500)
+
+        keys = [AssemblyCache.key(['1/'+str(i)+'/1'], ['--min-contig-len', '500'], 'MEGAHIT v1.1.3')
+                for i in range(3)]
+        self.assertNotEqual(keys[0], AssemblyCache.key(['1/0/2'], ['--min-contig-len', '500'], 'MEGAHIT v1.1.3'))
+        self.assertNotEqual(keys[0], AssemblyCache.key(['1/0/1'], [], 'MEGAHIT v1.1.3'))
+
+        checkout_path = os.path.join(root, 'checkout.fa')
+        self.assertEqual(cache.checkout(keys[0], checkout_path), False)
+        cache.put(keys[0], contigs_path, {'count': 1})
+        cache.put(keys[1], contigs_path)
+        time.sleep(0.01)
+        self.assertEqual(cache.checkout(keys[0], checkout_path), {'count': 1})  # keys[1] is now the LRU
+        with open(checkout_path) as f:
+            self.assertEqual(f.readline(), '>k141_0\n')
+        time.sleep(0.01)
+        cache.put(keys[2], contigs_path)  # over 2500 bytes: keys[1] goes
+        self.assertEqual(cache.checkout(keys[1], checkout_path), False)
+        self.assertEqual(cache.checkout(keys[2], checkout_path), None)  # no stats were given
+        self.assertNotEqual(cache.checkout(keys[0], checkout_path), False)
+        shutil.rmtree(root)
+
+
+    ### TEST 10: the reads cache hands out held files, evicts only unheld libraries, and passes through when off
+    #
+    def test_reads_cache(self):
+
+        root = os.path.join(self.getImpl().scratch, 'test_reads_cache')
+        os.makedirs(root)
+        downloads = []
+
+        def download(ref):
+            downloads.append(ref)
+            files = {}
+            for key in ['fwd', 'rev']:
+                files[key] = os.path.join(root, ref.replace('/', '_') + '.' + key + '.fq')
+                with open(files[key], 'w') as f:
+                    f.write('@r\n' + 'ACGT' * 25 + '\n+\n' + 'I' * 100 + '\n')  # 211 bytes, 422 a library
+            return files
+
+        cache = ReadsCache(os.path.join(root, 'cache'), max_bytes=600)
+        first = cache.fetch('1/1/1', download)
+        self.assertEqual(cache.fetch('1/1/1', download), first)
+        self.assertEqual((downloads, cache.hits, cache.misses), (['1/1/1'], 1, 1))
+        for path in first.values():
+            cache.release(path)
+
+        time.sleep(0.01)
+        second = cache.fetch('1/2/1', download)  # over 600 bytes, but 1/1/1 is still held once
+        self.assertTrue(all(os.path.exists(path) for path in first.values()))
+        for path in list(first.values()) + list(second.values()):
+            cache.release(path)
+        cache.evict()
+        self.assertFalse(any(os.path.exists(path) for path in first.values()))
+        self.assertTrue(all(os.path.exists(path) for path in second.values()))
+
+        # the gzipped form of a library is cached apart from the plain one
+        gzipped = cache.fetch('1/2/1', download, form='gzip')
+        self.assertEqual(downloads[-1], '1/2/1')
+        self.assertNotEqual(sorted(gzipped.values()), sorted(second.values()))
+        for path in gzipped.values():
+            cache.release(path)
+
+        # a library dir missing some of its files (e.g. being evicted by another process) isn't handed
+        # out, and as it can't be replaced, the download is used uncached
+        entry = cache._entry('1/4/1', '')
+        os.makedirs(entry)
+        with open(os.path.join(entry, '.keys'), 'w') as f:
+            f.write('fwd\nrev\n')
+        with open(os.path.join(entry, 'fwd~partial.fq'), 'w') as f:
+            f.write('@r\n')
+        files = cache.fetch('1/4/1', download)
+        self.assertEqual(downloads[-1], '1/4/1')
+        self.assertEqual(sorted(files), ['fwd', 'rev'])
+        self.assertTrue(all(os.path.exists(path) and os.path.dirname(path) == root for path in files.values()))
+        for path in files.values():
+            cache.release(path)
+        self.assertFalse(any(os.path.exists(path) for path in files.values()))
+
+        off = ReadsCache(os.path.join(root, 'off'), max_bytes=0)
+        files = off.fetch('1/3/1', download)
+        for path in files.values():
+            off.release(path)
+        self.assertFalse(any(os.path.exists(path) for path in files.values()))
+        shutil.rmtree(root)
+
+
+    ### TEST 11: the job poller checks every job with a bounded timeout, so a hung check doesn't hold up the others
+    #
+    def test_job_poller(self):
+        from ReadsUtils.baseclient import BaseClient
+
+        # 'slow' hangs on its first check, 'hung' on every check
+        checks = {}
+        def answer(call):
+            if call['method'].endswith('_submit'):
+                return call['params'][0]['name']
+            name = call['params'][0]
+            checks[name] = checks.get(name, 0) + 1
+            if name == 'hung' or (name == 'slow' and checks[name] == 1):
+                time.sleep(1)
+            return {'finished': 1, 'result': [name.upper()]}
+        server, url = self.startStandInServer(answer)
+        try:
+            client = BaseClient(url, token='test', async_job_check_time_ms=10)
+            client._job_poller.check_timeout = 0.2
+            start = time.time()
+            futures = dict((name, client.submit_job('ReadsUtils.download_reads', [{'name': name}]))
+                           for name in ['a', 'slow', 'b', 'hung'])
+            self.assertEqual(futures['a'].result(5), 'A')
+            self.assertEqual(futures['b'].result(5), 'B')
+            self.assertLess(time.time() - start, 0.9)  # not held up by the 1 second checks
+            self.assertEqual(futures['slow'].result(5), 'SLOW')
+            self.assertIsNotNone(futures['hung'].exception(10))  # timed out too many times
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+    ### TEST 12: JSON-RPC batches, answered by the server member by member, and sent by BaseClient.batch()
+    #
+    def test_batch_requests(self):
+        from io import BytesIO
+        from MegaHit_Sets.MegaHit_SetsServer import application
+        from ReadsUtils.baseclient import BaseClient, ServerError
+
+        batch = [{'version': '1.1', 'id': '1', 'method': 'MegaHit_Sets.status', 'params': []},
+                 {'version': '1.1', 'method': 'MegaHit_Sets.status', 'params': []},  # a notification
+                 {'version': '1.1', 'id': '3', 'method': 'status', 'params': []},
+                 {'version': '1.1', 'id': '4', 'method': 'MegaHit_Sets.status'},
+                 {'version': '1.1', 'id': '5', 'method': 'MegaHit_Sets.no_such_method', 'params': []},
+                 'not a request']
+        body = json.dumps(batch).encode('utf-8')
+        started = []
+        response = application({'REQUEST_METHOD': 'POST', 'CONTENT_LENGTH': str(len(body)),
+                                'wsgi.input': BytesIO(body), 'REMOTE_ADDR': '127.0.0.1'},
+                               lambda status, headers: started.append(status))
+        self.assertEqual(started, ['200 OK'])
+        responses = json.loads(b''.join(response).decode('utf-8'))
+        by_id = dict((r.get('id'), r) for r in responses)
+        self.assertEqual(len(responses), 5)  # all but the notification
+        self.assertEqual(by_id['1']['result'][0]['state'], 'OK')
+        self.assertEqual(by_id['3']['error']['code'], -32600)
+        self.assertEqual(by_id['4']['result'][0]['state'], 'OK')
+        self.assertEqual(by_id['5']['error']['code'], -32601)
+        self.assertEqual(by_id[None]['error']['code'], -32600)
+
+        # the client sends its queued calls as one batch, and hands each its own result or error
+        posts = []
+        def answer(call):
+            posts.append(call['id'])
+            if call['params'][0] == 'bad':
+                raise ValueError('bad params')
+            return call['params'][0]
+        server, url = self.startStandInServer(answer)
+        try:
+            client = BaseClient(url, token='test')
+            with client.batch() as b:
+                ok = b.call_method('ReadsUtils.echo', ['ok'])
+                bad = b.call_method('ReadsUtils.echo', ['bad'])
+            self.assertEqual(ok.result(5), 'ok')
+            self.assertRaises(ServerError, bad.result, 5)
+            self.assertEqual(len(posts), 2)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+    ### TEST 13: a rerun of the same assembly continues from megahit's checkpoints, unless that assembly is running right now
+    #
+    def test_megahit_resume(self):
+
+        impl = self.getImpl()
+        root = os.path.join(impl.scratch, 'test_megahit_resume')
+        os.makedirs(root)
+        calls_path = os.path.join(root, 'calls')
+        megahit = os.path.join(root, 'megahit')
+        with open(megahit, 'w') as f:  # a stand-in megahit that records its arguments
+            f.write('#!/bin/sh\n' +
+                    'echo "$@" >> ' + calls_path + '\n' +
+                    'while [ $# -gt 0 ]; do [ "$1" = -o ] && out="$2"; shift; done\n' +
+                    # as megahit, a run continued after its last checkpoint leaves the contigs as they are
+                    'mkdir -p "$out" && { [ -e "$out/final.contigs.fa" ] || echo ">k141_0" > "$out/final.contigs.fa"; }\n')
+        os.chmod(megahit, 0o755)
+        reads_path = os.path.join(root, 'reads.fq')
+        with open(reads_path, 'w') as f:
+            f.write('@r\nACGT\n+\nIIII\n')
+        params = {'input_fwd_path': reads_path, 'input_rev_path': reads_path,
+                  'input_reads_refs': ['1/2/3'], 'min_contig_len': 500}
+        options = ['--min-contig-len', '500']
+
+        def run():
+            impl.exec_megahit_single_library(params)
+            with open(calls_path) as f:
+                args = f.read().splitlines()[-1].split(' ')
+            return args[args.index('-o') + 1], '--continue' in args
+
+        saved_megahit = impl.MegaHit_Sets
+        impl.MegaHit_Sets = megahit
+        output_dir, lock = impl.megahit_output_dir(['1/2/3'], options)
+        lock.close()
+        new_version_dir, lock = impl.megahit_output_dir(['1/2/4'], options)
+        lock.close()
+        self.assertNotEqual(new_version_dir, output_dir)  # keyed on the versioned refs
+        fresh_dir = None
+        try:
+            # checkpoints from an earlier run that didn't finish: megahit goes on from them
+            os.makedirs(output_dir)
+            with open(os.path.join(output_dir, 'checkpoints.txt'), 'w') as f:
+                f.write('1\tdone\n')
+            self.assertEqual(run(), (output_dir, True))
+
+            # the same assembly is running right now (it holds the lock): this run starts afresh elsewhere
+            lock = impl.megahit_output_dir(['1/2/3'], options)[1]
+            try:
+                fresh_dir, resumed = run()
+            finally:
+                lock.close()
+            self.assertNotEqual(fresh_dir, output_dir)
+            self.assertFalse(resumed)
+            self.assertTrue(os.path.exists(os.path.join(output_dir, 'checkpoints.txt')))  # left to its run
+
+            # in mac mode the contigs are copied out to the host scratch, and so are still there for a rerun
+            impl.mac_mode = True
+            impl.host_scratch = os.path.join(root, 'host')
+            os.makedirs(impl.host_scratch)
+            for _ in range(2):
+                contigs = impl.exec_megahit_single_library(params)
+                self.assertEqual(os.path.dirname(contigs), impl.host_scratch)
+                with open(contigs) as f:
+                    self.assertEqual(f.read(), '>k141_0\n')
+                os.remove(contigs)
+            self.assertTrue(os.path.exists(os.path.join(output_dir, 'final.contigs.fa')))
+        finally:
+            impl.MegaHit_Sets = saved_megahit
+            impl.mac_mode, impl.host_scratch = False, impl.scratch
+            for path in [output_dir, fresh_dir, root]:
+                if path:
+                    shutil.rmtree(path, ignore_errors=True)
+            for path in [output_dir + '.lock', new_version_dir + '.lock']:
+                os.remove(path)
+
+
+    ### TEST 14: gzipped libraries appended whole by the FileConcatenator read back as one gzip stream
+    #
+    def test_concat_gzip_members(self):
+
+        root = os.path.join(self.getImpl().scratch, 'test_concat_gzip_members')
+        os.makedirs(root)
+        payloads = [b'@r0\nACGT\n+\nIIII\n', b'@r1\nGGCC\n+\nIIII\n' * 1000]
+        member_paths = []
+        for i, payload in enumerate(payloads):
+            member_paths.append(os.path.join(root, str(i) + '.fq.gz'))
+            with gzip.open(member_paths[-1], 'wb') as f:
+                f.write(payload)
+
+        combined_path = os.path.join(root, 'combined.fq.gz')
+        with FileConcatenator(combined_path) as concatenator:
+            for path in member_paths:
+                concatenator.append(path)
+        self.assertEqual(os.path.getsize(combined_path), sum(os.path.getsize(path) for path in member_paths))
+        with gzip.open(combined_path, 'rb') as f:
+            self.assertEqual(f.read(), b''.join(payloads))
+        shutil.rmtree(root)
+
+
+    ### TEST 15: interleaved reads go to megahit with --12, listed, staged, concatenated or streamed through one fifo
+    #
+    def test_interleaved_input(self):
+
+        impl = MegaHit_Sets(dict(self.cfg, **{'reads-interleaved': '1', 'reads-gzipped': '1'}))
+        self.assertEqual((impl.reads_directions, impl.reads_extension), (['interleaved'], '.fastq.gz'))
+        root = os.path.join(impl.scratch, 'test_interleaved_input')
+        os.makedirs(root)
+        calls_path = os.path.join(root, 'calls')
+        megahit = os.path.join(root, 'megahit')
+        with open(megahit, 'w') as f:  # a stand-in megahit that records its arguments and the reads it got
+            f.write('#!/bin/sh\n' +
+                    'echo "$@" >> ' + calls_path + '\n' +
+                    'while [ $# -gt 0 ]; do case "$1" in -o) out="$2";; --12) in12="$2";; esac; shift; done\n' +
+                    'mkdir -p "$out"\n' +
+                    'for f in $(echo "$in12" | tr "," " "); do gzip -dc "$f"; done > "$out/reads"\n' +
+                    'echo ">k141_0" > "$out/final.contigs.fa"\n')
+        os.chmod(megahit, 0o755)
+        impl.MegaHit_Sets = megahit
+
+        payloads = [b'@r0/1\nACGT\n+\nIIII\n@r0/2\nTTGC\n+\nIIII\n',
+                    b'@r1/1\nGGCC\n+\nIIII\n@r1/2\nAATT\n+\nIIII\n']
+        def write_libraries():
+            paths = []
+            for i, payload in enumerate(payloads):
+                paths.append(os.path.join(root, str(i) + '.interleaved.fq.gz'))
+                with gzip.open(paths[-1], 'wb') as f:
+                    f.write(payload)
+            return paths
+
+        def run(input_paths):
+            output_dir = os.path.dirname(impl.exec_megahit_single_library({'input_interleaved_paths': input_paths}))
+            with open(calls_path) as f:
+                args = f.read().splitlines()[-1].split(' ')
+            with open(os.path.join(output_dir, 'reads'), 'rb') as f:
+                reads = f.read()
+            shutil.rmtree(output_dir)
+            return args, reads
+
+        # several files are passed as a comma list, or as staged links when that gets too long
+        paths = write_libraries()
+        self.assertEqual(impl.megahit_input_args({'interleaved': paths}), ({'interleaved': ','.join(paths)}, None))
+        impl.MEGAHIT_MAX_INPUT_ARG_LEN = 10
+        input_args, staging_dir = impl.megahit_input_args({'interleaved': paths})
+        staging_name = os.path.basename(staging_dir)
+        self.assertEqual(input_args, {'interleaved': staging_name + '/0.interleaved.fq.gz,' +
+                                                     staging_name + '/1.interleaved.fq.gz'})
+        shutil.rmtree(staging_dir)
+        args, reads = run(paths)
+        self.assertEqual(args[args.index('--12') + 1].count('.interleaved.fq.gz'), 2)
+        self.assertNotIn('-1', args)
+        self.assertEqual(reads, b''.join(payloads))
+        del impl.MEGAHIT_MAX_INPUT_ARG_LEN
+        args, reads = run(paths)
+        self.assertEqual(args[args.index('--12') + 1], ','.join(paths))
+
+        # concatenated into one gzip file, as for a combined assembly
+        combined_path = os.path.join(root, 'input_reads_interleaved' + impl.reads_extension)
+        with FileConcatenator(combined_path) as concatenator:
+            for path in paths:
+                concatenator.append(path)
+                os.remove(path)
+        args, reads = run([combined_path])
+        self.assertEqual((args[args.index('--12') + 1], reads), (combined_path, b''.join(payloads)))
+        os.remove(combined_path)
+
+        # streamed through the one fifo, each library removed once written
+        paths = write_libraries()
+        feeder = FifoFeeder({'interleaved': os.path.join(root, 'input_reads_interleaved' + impl.reads_extension)},
+                            lambda lib_i: {'interleaved': paths[lib_i]}, len(paths)).start()
+        try:
+            args, reads = run([feeder.fifo_paths['interleaved']])
+        finally:
+            feeder.close()
+        feeder.check()
+        self.assertEqual(reads, b''.join(payloads))
+        self.assertFalse(any(os.path.exists(path) for path in paths))
+        shutil.rmtree(root)
+
+
+    ### TEST 16: the reads prefetcher downloads ahead up to its depth and the free scratch space, but always
+    ### downloads a library a consumer is waiting for
+    #
+    def test_reads_prefetcher(self):
+
+        root = os.path.join(self.getImpl().scratch, 'test_reads_prefetcher')
+        os.makedirs(root)
+        downloads = []
+
+        def download(ref):
+            downloads.append(ref)
+            path = os.path.join(root, ref + '.fq')
+            with open(path, 'w') as f:
+                f.write('@r\n' + 'A' * 396 + '\n')  # 400 bytes
+            return {'fwd': path}
+
+        def wait_for_downloads(n):
+            deadline = time.time() + 5
+            while len(downloads) < n and time.time() < deadline:
+                time.sleep(0.01)
+            time.sleep(0.1)  # long enough for a download that shouldn't happen to start
+            return list(downloads)
+
+        class FixedSpacePrefetcher(ReadsPrefetcher):
+            free_bytes = 10 ** 9  # the scratch volume, as the prefetcher sees it
+            def _free_bytes(self):
+                return self.free_bytes
+
+        # two libraries ahead at most, and one more once one is taken
+        prefetcher = FixedSpacePrefetcher(download, ['a', 'b', 'c', 'd'], root, depth=2).start()
+        try:
+            self.assertEqual(wait_for_downloads(2), ['a', 'b'])
+            self.assertEqual(prefetcher.get(0), {'fwd': os.path.join(root, 'a.fq')})
+            self.assertEqual(wait_for_downloads(3), ['a', 'b', 'c'])
+        finally:
+            prefetcher.close()
+        self.assertEqual(sorted(os.listdir(root)), ['a.fq'])  # the ones nobody took are removed
+        os.remove(os.path.join(root, 'a.fq'))
+
+        # 800 bytes free and 500 kept in reserve: nothing more fits once a 400 byte library is seen,
+        # but a library a consumer is waiting for is downloaded all the same
+        del downloads[:]
+        prefetcher = FixedSpacePrefetcher(download, ['a', 'b', 'c'], root, depth=3, reserve_bytes=500)
+        prefetcher.free_bytes = 800
+        prefetcher.start()
+        try:
+            self.assertEqual(wait_for_downloads(1), ['a'])
+            prefetcher.get(0)
+            self.assertEqual(prefetcher.get(1), {'fwd': os.path.join(root, 'b.fq')})
+            self.assertEqual(wait_for_downloads(2), ['a', 'b'])
+            prefetcher.free_bytes = 10 ** 9
+            self.assertEqual(prefetcher.get(2), {'fwd': os.path.join(root, 'c.fq')})
+        finally:
+            prefetcher.close()
+        shutil.rmtree(root)
+
+
+    ### TEST 17: the reads prefetcher runs width downloads at once, and still hands the libraries out in order
+    #
+    def test_reads_prefetcher_width(self):
+
+        root = os.path.join(self.getImpl().scratch, 'test_reads_prefetcher_width')
+        os.makedirs(root)
+        started = []
+        release = dict((ref, threading.Event()) for ref in ['a', 'b', 'c'])
+
+        def download(ref):
+            started.append(ref)
+            if not release[ref].wait(5):
+                raise ValueError('not released: ' + ref)
+            if ref == 'c':
+                raise ValueError('download of c failed')
+            path = os.path.join(root, ref + '.fq')
+            with open(path, 'w') as f:
+                f.write('@' + ref + '\n')
+            return {'fwd': path}
+
+        prefetcher = ReadsPrefetcher(download, ['a', 'b', 'c'], root, depth=3, width=3).start()
+        try:
+            deadline = time.time() + 5
+            while len(started) < 3 and time.time() < deadline:
+                time.sleep(0.01)
+            self.assertEqual(sorted(started), ['a', 'b', 'c'])  # all three at once
+
+            # b and c finish first, but a still comes first
+            release['b'].set()
+            release['c'].set()
+            time.sleep(0.05)
+            release['a'].set()
+            self.assertEqual([prefetcher.get(i)['fwd'] for i in [0, 1]],
+                             [os.path.join(root, 'a.fq'), os.path.join(root, 'b.fq')])
+            self.assertRaises(ValueError, prefetcher.get, 2)
+        finally:
+            prefetcher.close()
+        shutil.rmtree(root)
+
+
+    ### TEST 18: the report escapes names in its html summary, and run_megahit hands that html to KBaseReport
+    #
+    def test_assembly_report(self):
+
+        impl = self.getImpl()
+        root = os.path.join(impl.scratch, 'test_assembly_report')
+        os.makedirs(root)
+        contigs_path = os.path.join(root, 'final.contigs.fa')
+        with open(contigs_path, 'w') as f:
+            f.write('>k141_0\nACGTACGTGG\n>k141_1\nGGCC\n')
+
+        report = AssemblyReport('ws<1>')
+        stats = report.add('reads & <b>lib</b>', 'lib-<out>', contigs_path)
+        self.assertEqual((stats['count'], stats['total_bp'], stats['max']), (2, 14, 10))
+        text = report.text()
+        html = report.html()
+        self.assertIn('MegaHit_Sets run for Read Library: reads & <b>lib</b>\n', text)
+        self.assertIn('ContigSet saved to: ws<1>/lib-<out>\n', text)
+        self.assertIn('Assembled into 2 contigs.\n', text)
+        self.assertIn('<tr><td>reads &amp; &lt;b&gt;lib&lt;/b&gt;</td><td>ws&lt;1&gt;/lib-&lt;out&gt;</td>'
+                      '<td>2</td><td>14</td><td>10</td>', html)
+        self.assertNotIn('<b>', html)
+
+        # run_megahit saves the text as the report message and the html as its direct view
+        calls = []
+        def answer(call):  # KBaseReport, run as an SDK job
+            if call['method'] == 'KBaseReport._check_job':
+                return {'finished': 1, 'result': [{'name': 'megahit_report_1', 'ref': '1/9/1'}]}
+            calls.append(call)
+            return 'job_1'
+        server, url = self.startStandInServer(answer)
+        saved_callback_url = impl.callbackURL
+        impl.callbackURL = url
+        impl.exec_megahit = lambda ctx, params: [{'report_text': text, 'report_html': html,
+                                                  'output_contigset_refs': ['1/2/3']}]
+        try:
+            output = impl.run_megahit(self.getContext(), {'workspace_name': 'ws<1>', 'input_reads_ref': '1/1/1',
+                                                          'output_contigset_name': 'out'})[0]
+        finally:
+            del impl.exec_megahit
+            impl.callbackURL = saved_callback_url
+            server.shutdown()
+            server.server_close()
+        self.assertEqual(output, {'report_name': 'megahit_report_1', 'report_ref': '1/9/1'})
+        self.assertEqual([call['method'] for call in calls], ['KBaseReport._create_extended_report_submit'])
+        report_params = calls[0]['params'][0]
+        self.assertEqual((report_params['message'], report_params['direct_html']), (text, html))
+        self.assertEqual(report_params['objects_created'], [{'ref': '1/2/3', 'description': 'Assembled contigs'}])
+        self.assertEqual(report_params['workspace_name'], 'ws<1>')
+        shutil.rmtree(root)
+
+
+    ### TEST 19: the assembly saver hands results back in index order, and keeps the saves that finished
+    ### when another one fails
+    #
+    def test_assembly_saver(self):
+
+        def save(i, contigs_path):
+            time.sleep(0.05 * (3 - i))  # the first submitted finish last
+            if contigs_path is None:
+                raise ValueError('no contigs for ' + str(i))
+            return 'saved/' + contigs_path
+
+        saver = AssemblySaver(save, max_uploads=3)
+        for i in [2, 0, 1]:
+            saver.submit(i, 'contigs.' + str(i))
+        self.assertEqual(saver.results(3), ['saved/contigs.0', 'saved/contigs.1', 'saved/contigs.2'])
+
+        # library 1 fails to save (or the run fails after it): the others still finish, and are reported
+        saver = AssemblySaver(save, max_uploads=2)
+        for i, contigs_path in [(0, 'contigs.0'), (1, None), (2, 'contigs.2')]:
+            saver.submit(i, contigs_path)
+        self.assertEqual(saver.saved(), {0: 'saved/contigs.0', 2: 'saved/contigs.2'})
+        self.assertRaises(ValueError, saver.results, 3)
+
+        saver = AssemblySaver(save)
+        self.assertEqual(saver.saved(), {})  # nothing submitted
+
+
+    ### TEST 20: the clients' session pool keeps one session per host for keep-alive connections, with retries
+    ### on connecting, and replaces a session left idle too long
+    #
+    def test_session_pool(self):
+        from MegaHit_Sets.baseclient import BaseClient, _SessionPool
+
+        pool = _SessionPool()
+        pool.configure(pool_size=4, keep_alive=0.3, retries=2, backoff=0.1)
+        session = pool.session('http://service.example:5000/services/ws')
+        self.assertIs(pool.session('http://service.example:5000/services/shock-api'), session)
+        self.assertIsNot(pool.session('https://service.example:5000/services/ws'), session)
+        adapter = session.get_adapter('http://service.example:5000/')
+        self.assertEqual((adapter.max_retries.total, adapter.max_retries.read, adapter.max_retries.backoff_factor),
+                         (2, False, 0.1))
+        self.assertEqual(session.headers['Connection'], 'keep-alive')
+        time.sleep(0.4)
+        self.assertIsNot(pool.session('http://service.example:5000/services/ws'), session)  # idle too long
+        pool.configure(keep_alive=0)
+        self.assertEqual(pool.session('http://service.example:5000/services/ws').headers['Connection'], 'close')
+
+        # successive calls of a client go over one connection
+        server, url = self.startStandInServer(lambda call: call['params'][0])
+        connections = []
+        process_request = server.process_request
+        def count_connection(request, client_address):
+            connections.append(client_address)
+            process_request(request, client_address)
+        server.process_request = count_connection
+        try:
+            client = BaseClient(url, token='test')
+            self.assertEqual([client.call_method('Stand_In.echo', [i]) for i in range(3)], [0, 1, 2])
+            self.assertEqual(len(connections), 1)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+    ### TEST 21: Service Wizard urls are cached, refreshed in the background once stale, and looked up again when
+    ### the service can't be connected to, but a call that reached the service is never sent twice
+    #
+    def test_service_url_cache(self):
+        import socket
+        from requests.exceptions import ConnectionError
+        from MegaHit_Sets.baseclient import BaseClient, _ServiceUrlCache, _session_pool, configure_session_pool
+
+        cache = _ServiceUrlCache()
+        cache.ttl = 0.2
+        resolved = []
+        def resolve():
+            resolved.append(time.time())
+            return 'http://service/' + str(len(resolved))
+        self.assertEqual(cache.get('key', resolve), 'http://service/1')
+        self.assertEqual(cache.get('key', resolve), 'http://service/1')
+        time.sleep(0.3)
+        self.assertEqual(cache.get('key', resolve), 'http://service/1')  # stale, while it's resolved again
+        deadline = time.time() + 5
+        while len(resolved) < 2 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(cache.get('key', resolve), 'http://service/2')
+        cache.invalidate('key', 'http://service/1')  # no longer its url: kept
+        self.assertEqual(cache.get('key', resolve), 'http://service/2')
+        cache.invalidate('key', 'http://service/2')
+        self.assertEqual(cache.get('key', resolve), 'http://service/3')
+
+        # a service that reads each request and closes the connection without answering
+        dropped = []
+        dropping = socket.socket()
+        dropping.bind(('127.0.0.1', 0))
+        dropping.listen(5)
+        def drop():
+            while True:
+                connection = dropping.accept()[0]
+                dropped.append(connection.recv(65536))
+                connection.close()
+        dropper = threading.Thread(target=drop)
+        dropper.daemon = True
+        dropper.start()
+        unused = socket.socket()  # a port nothing listens on
+        unused.bind(('127.0.0.1', 0))
+        refused_url = 'http://127.0.0.1:' + str(unused.getsockname()[1]) + '/'
+        unused.close()
+
+        service, service_url = self.startStandInServer(lambda call: call['method'])
+        service_urls = {'Moved': [refused_url, service_url],
+                        'Dropping': ['http://127.0.0.1:' + str(dropping.getsockname()[1]) + '/', service_url]}
+        def get_service_status(call):
+            return {'url': service_urls[call['params'][0]['module_name']].pop(0)}
+        wizard, wizard_url = self.startStandInServer(get_service_status)
+        saved_backoff = _session_pool.backoff
+        configure_session_pool(backoff=0)  # retry the refused connection at once
+        try:
+            client = BaseClient(wizard_url, token='test', lookup_url=True)
+            # can't connect to the cached url: looked up again, and sent to the new one
+            self.assertEqual(client.call_method('Moved.run_job', [], 'release'), 'Moved.run_job')
+            # the call reached the service: not sent again
+            self.assertRaises(ConnectionError, client.call_method, 'Dropping.run_job', [], 'release')
+            self.assertEqual(len(dropped), 1)
+            self.assertEqual(service_urls['Dropping'], [service_url])  # not looked up again either
+        finally:
+            configure_session_pool(backoff=saved_backoff)
+            for server in [service, wizard]:
+                server.shutdown()
+                server.server_close()
+            dropping.close()
+
+
+    ### TEST 22: the auth client validates a token once for concurrent requests, shares a rejection with all of
+    ### them and remembers it for a while, refreshes a token about to expire in the background, and times out
+    #
+    def test_auth_client(self):
+        try:
+            from urlparse import parse_qs  # py2
+        except ImportError:
+            from urllib.parse import parse_qs  # py3
+
+        # a stand-in auth service: answers tokens[token] as (status, body) after delay seconds
+        tokens = {}
+        posts = []
+        delay = [0.2]
+        class AuthHandler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                length = int(self.headers['content-length'])
+                token = parse_qs(self.rfile.read(length).decode('utf-8'))['token'][0]
+                posts.append(token)
+                time.sleep(delay[0])
+                status, body = tokens[token]
+                body = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                self.send_header('content-type', 'application/json')
+                self.send_header('content-length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            def log_message(self, *args):
+                pass
+        class AuthServer(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+            def handle_error(self, request, client_address):
+                pass  # a client that timed out
+        server = AuthServer(('127.0.0.1', 0), AuthHandler)
+        server_thread = threading.Thread(target=server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+        auth = KBaseAuth('http://127.0.0.1:' + str(server.server_port) + '/', timeout=0.5)
+
+        def call_concurrently(token, n=20):
+            results = []
+            def call():
+                try:
+                    results.append(auth.get_user(token))
+                except ValueError as e:
+                    results.append(e)
+            callers = [threading.Thread(target=call) for _ in range(n)]
+            for caller in callers:
+                caller.start()
+            for caller in callers:
+                caller.join()
+            return results
+
+        try:
+            # single flight: one call to the service for 20 concurrent requests, then cached
+            tokens['good'] = (200, {'user_id': 'alice'})
+            self.assertEqual(call_concurrently('good'), ['alice'] * 20)
+            self.assertEqual(auth.get_user('good'), 'alice')
+            self.assertEqual(posts.count('good'), 1)
+
+            # a rejection is shared by every waiting request, and remembered until it expires
+            tokens['bad'] = (401, {'error': {'appcode': 10020, 'message': 'Invalid token'}})
+            errors = call_concurrently('bad')
+            self.assertTrue(all(isinstance(e, ValueError) and 'Invalid token' in str(e) for e in errors))
+            self.assertRaises(ValueError, auth.get_user, 'bad')
+            self.assertEqual(posts.count('bad'), 1)
+            auth._rejected.ttl = 0.1
+            time.sleep(0.2)
+            self.assertRaises(ValueError, auth.get_user, 'bad')
+            self.assertEqual(posts.count('bad'), 2)
+
+            # an auth service failing (rather than rejecting the token) is not remembered
+            tokens['unavailable'] = (503, {'error': {'message': 'Service unavailable'}})
+            self.assertRaises(ValueError, auth.get_user, 'unavailable')
+            self.assertRaises(ValueError, auth.get_user, 'unavailable')
+            self.assertEqual(posts.count('unavailable'), 2)
+
+            # near expiry, the cached user is answered at once and one background call refreshes it
+            auth._cache.ttl = 1.0
+            auth._REFRESH_SEC = 0.9
+            auth._cache.add_valid_token('good', 'alice')
+            tokens['good'] = (200, {'user_id': 'alice2'})
+            time.sleep(0.15)
+            start = time.time()
+            self.assertEqual(call_concurrently('good'), ['alice'] * 20)
+            self.assertLess(time.time() - start, delay[0])
+            deadline = time.time() + 5
+            while auth._cache.get_user('good') != 'alice2' and time.time() < deadline:
+                time.sleep(0.01)
+            self.assertEqual(auth._cache.get_user('good'), 'alice2')
+            self.assertEqual(posts.count('good'), 2)
+
+            # a hung auth service fails the requests waiting on it rather than holding them forever
+            tokens['slow'] = (200, {'user_id': 'carol'})
+            delay[0] = 2
+            start = time.time()
+            errors = call_concurrently('slow', n=5)
+            self.assertTrue(all(isinstance(e, ValueError) and 'Timed out' in str(e) for e in errors))
+            self.assertLess(time.time() - start, 1.5)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+    ### TEST 23: the server's JSON codec writes what the standard library writes, and a request body is read
+    ### in chunks up to its Content-Length, or refused unread with a 413 when that is over the limit
+    #
+    def test_json_codec_and_request_body(self):
+        from collections import namedtuple
+        from decimal import Decimal
+        from io import BytesIO
+        from MegaHit_Sets import MegaHit_SetsServer as server_module
+        from MegaHit_Sets.MegaHit_SetsServer import JSONObjectEncoder, application
+        from MegaHit_Sets.jsoncodec import JSONCodec
+
+        # the standard library unless KB_JSON_CODEC names another backend, which must exist
+        old_codec = os.environ.pop('KB_JSON_CODEC', None)
+        try:
+            self.assertEqual(JSONCodec().name, 'json')
+            os.environ['KB_JSON_CODEC'] = 'no_such_codec'
+            self.assertRaises(ValueError, JSONCodec)
+        finally:
+            os.environ.pop('KB_JSON_CODEC', None)
+            if old_codec is not None:
+                os.environ['KB_JSON_CODEC'] = old_codec
+
+        # simplejson, when installed, writes namedtuples, Decimals and sets as the standard library does
+        Pair = namedtuple('Pair', ['a', 'b'])
+        default = JSONObjectEncoder().default
+        doc = {'pair': Pair(1, 2), 'set': set([3]), 'text': u'caf\xe9', 'big': 2 ** 70, 'nested': [None, 1.5]}
+        stdlib = JSONCodec(default=default, backend='json')
+        expected = json.loads(json.dumps(doc, cls=JSONObjectEncoder))
+        self.assertEqual(stdlib.loads(stdlib.dumps(doc)), expected)
+        self.assertEqual(expected['pair'], [1, 2])
+        self.assertRaises(TypeError, stdlib.dumps, {'d': Decimal('1.5')})
+        try:
+            simple = JSONCodec(default=default, backend='simplejson')
+        except ImportError:
+            simple = None
+        if simple:
+            self.assertEqual(json.loads(simple.dumps(doc)), expected)
+            self.assertEqual(simple.loads(stdlib.dumps(doc)), expected)
+            self.assertRaises(TypeError, simple.dumps, {'d': Decimal('1.5')})
+
+        def post(body, content_length, wsgi_input=None):
+            environ = {'REQUEST_METHOD': 'POST', 'REMOTE_ADDR': '127.0.0.1',
+                       'wsgi.input': wsgi_input or BytesIO(body)}
+            if content_length is not None:
+                environ['CONTENT_LENGTH'] = content_length
+            started = []
+            response = application(environ, lambda status, headers: started.append(status))
+            return started[0], json.loads(b''.join(response).decode('utf-8'))
+
+        class Unreadable(object):
+            def read(self, *args):
+                raise AssertionError('the body of a refused request was read')
+
+        call = json.dumps({'version': '1.1', 'id': '1', 'method': 'MegaHit_Sets.status',
+                           'params': []}).encode('utf-8')
+        old_max, old_chunk = application.max_request_size, server_module._READ_CHUNK_SIZE
+        application.max_request_size = len(call)
+        server_module._READ_CHUNK_SIZE = 7  # several chunks per body
+        try:
+            # a body read in chunks up to its length, even with more after it
+            status, resp = post(call + b'trailing', str(len(call)))
+            self.assertEqual(status, '200 OK')
+            self.assertEqual(resp['result'][0]['state'], 'OK')
+
+            # over the limit: refused without reading it
+            status, resp = post(None, str(len(call) + 1), wsgi_input=Unreadable())
+            self.assertEqual(status, '413 Request Entity Too Large')
+            self.assertEqual(resp['error']['code'], -32600)
+            self.assertIn(str(len(call) + 1), resp['error']['message'])
+
+            # a Content-Length missing, unparsable or shorter than the body: the JSON doesn't parse
+            for content_length in [None, 'many', str(len(call) - 1)]:
+                status, resp = post(call, content_length)
+                self.assertEqual(resp['error']['code'], -32700)
+        finally:
+            application.max_request_size = old_max
+            server_module._READ_CHUNK_SIZE = old_chunk
+
+
+    ### TEST 24: GET /metrics answers the JSON-RPC call counts and durations in the Prometheus text format
+    #
+    def test_metrics_endpoint(self):
+        import re
+        from io import BytesIO
+        from MegaHit_Sets.MegaHit_SetsServer import application
+
+        comment = re.compile(r'^# (HELP [a-zA-Z_:][a-zA-Z0-9_:]* .*|TYPE [a-zA-Z_:][a-zA-Z0-9_:]* '
+                             r'(counter|gauge|histogram|summary|untyped))$')
+        sample = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)'
+                            r'(?:\{((?:[a-zA-Z_][a-zA-Z0-9_]*="(?:[^"\\]|\\.)*",?)*)\})?'
+                            r' ([-+]?(?:[0-9.]+(?:[eE][-+]?[0-9]+)?|Inf|NaN))$')
+        label = re.compile(r'([a-zA-Z_][a-zA-Z0-9_]*)="((?:[^"\\]|\\.)*)"')
+
+        def scrape():
+            started = []
+            body = b''.join(application({'REQUEST_METHOD': 'GET', 'PATH_INFO': '/metrics',
+                                         'REMOTE_ADDR': '127.0.0.1'},
+                                        lambda status, headers: started.append((status, dict(headers)))))
+            self.assertEqual(started[0][0], '200 OK')
+            self.assertTrue(started[0][1]['content-type'].startswith('text/plain; version=0.0.4'))
+            samples = {}
+            for line in body.decode('utf-8').splitlines():
+                if line.startswith('#'):
+                    self.assertTrue(comment.match(line), line)
+                    continue
+                m = sample.match(line)
+                self.assertTrue(m, line)
+                labels = tuple(sorted(label.findall(m.group(2) or '')))
+                samples[(m.group(1), labels)] = float(m.group(3))
+            return body.decode('utf-8'), samples
+
+        method = (('method', 'MegaHit_Sets.status'),)
+        def count(samples, name):
+            return samples.get((name, method), 0.0)
+
+        _, before = scrape()
+        call = json.dumps({'version': '1.1', 'id': '1', 'method': 'MegaHit_Sets.status',
+                           'params': []}).encode('utf-8')
+        application({'REQUEST_METHOD': 'POST', 'CONTENT_LENGTH': str(len(call)),
+                     'wsgi.input': BytesIO(call), 'REMOTE_ADDR': '127.0.0.1'},
+                    lambda status, headers: None)
+        text, after = scrape()
+
+        self.assertIn('# TYPE megahit_sets_requests_total counter', text)
+        self.assertIn('# TYPE megahit_sets_request_duration_seconds histogram', text)
+        self.assertEqual(count(after, 'megahit_sets_requests_total') -
+                         count(before, 'megahit_sets_requests_total'), 1)
+        self.assertEqual(count(after, 'megahit_sets_request_duration_seconds_count') -
+                         count(before, 'megahit_sets_request_duration_seconds_count'), 1)
+        self.assertGreater(count(after, 'megahit_sets_request_duration_seconds_sum'), 0)
+        self.assertEqual(after[('megahit_sets_requests_in_flight', ())], 0)
+
+        # the buckets are cumulative, ending with +Inf at the call count
+        buckets = sorted((float(dict(labels)['le']), value) for (name, labels), value in after.items()
+                         if name == 'megahit_sets_request_duration_seconds_bucket' and
+                         dict(labels).get('method') == 'MegaHit_Sets.status')
+        self.assertEqual(buckets[-1], (float('inf'), count(after, 'megahit_sets_request_duration_seconds_count')))
+        self.assertEqual([value for _, value in buckets], sorted(value for _, value in buckets))
+
+
+    ### TEST 25: timing spans nest, time their wall and CPU seconds, record failures, and are logged and tabled
+    #
+    def test_span_recorder(self):
+        import subprocess
+        import sys
+        logged = []
+        spans = SpanRecorder(log=logged.append)
+
+        @spans.timed('save', bytes_of=len, ref='1/2/3')
+        def save():
+            return 'x' * 2000000
+
+        with spans.span('run', reads='lib & <b>') as run:
+            with spans.span('download') as download:
+                time.sleep(0.2)
+                download.add_bytes(1000)
+                download.add_bytes(500)
+            with spans.span('megahit') as megahit:
+                # CPU time of a subprocess waited for counts towards the span
+                subprocess.check_call([sys.executable, '-c', 'sum(range(10 ** 7))'])
+            self.assertEqual(save(), 'x' * 2000000)
+            try:
+                with spans.span('upload'):
+                    raise ValueError('disk full')
+            except ValueError:
+                pass
+            else:
+                self.fail('the span swallowed the error')
+            run.set('contigs', 3)
+
+        # logged as each finishes, the enclosing span last
+        records = [json.loads(line) for line in logged]
+        self.assertEqual([r['span'] for r in records], ['download', 'megahit', 'save', 'upload', 'run'])
+        by_name = dict((r['span'], r) for r in records)
+        self.assertEqual(by_name['download']['bytes'], 1500)
+        self.assertEqual(by_name['save']['bytes'], 2000000)
+        self.assertEqual(by_name['save']['attrs'], {'ref': '1/2/3'})
+        self.assertEqual(by_name['run']['attrs'], {'reads': 'lib & <b>', 'contigs': 3})
+        self.assertEqual(by_name['upload']['error'], 'ValueError')
+        self.assertNotIn('error', by_name['run'])
+
+        # the enclosing span covers the nested ones; a sleep takes wall time but little CPU
+        self.assertGreaterEqual(download.wall_seconds, 0.2)
+        self.assertLess(download.cpu_seconds, 0.1)
+        self.assertGreater(megahit.cpu_seconds, 0.05)
+        self.assertGreaterEqual(run.wall_seconds, download.wall_seconds + megahit.wall_seconds)
+        self.assertGreaterEqual(run.cpu_seconds, megahit.cpu_seconds)
+        self.assertLessEqual(run.start, download.start)
+
+        # the table lists the spans in the order they started
+        lines = spans.text().splitlines()
+        self.assertEqual(lines[0], 'Timing (wall and CPU seconds, bytes processed):')
+        self.assertEqual([line.split()[0] for line in lines[1:] if line], ['run', 'download', 'megahit', 'save', 'upload'])
+        self.assertTrue(lines[1].endswith('contigs=3 reads=lib & <b>'))
+        self.assertIn('1500 bytes', lines[2])
+        self.assertIn('MB/s', lines[4])
+        self.assertTrue(lines[5].endswith('FAILED: ValueError'))
+        self.assertEqual(SpanRecorder().text(), '')